@@ -0,0 +1,347 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks for plus.py,
+
+Needs the same config.py and client_secrets.json as plus.py. You can run
+all the benchmarks, or just the named ones, by running:
+    $ python -m benchmarks [--bench_json=results.json] [name ...]
+
+The JSON results can be compared between commits.
+"""
+
+import glob
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import timeit
+
+import gflags
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_string(
+    'bench_json', None,
+    'Where to write the results as JSON, "-" for stdout.')
+gflags.DEFINE_integer(
+    'bench_activities', 2000,
+    'How many synthetic activities the sync benchmark syncs.')
+gflags.DEFINE_list(
+    'bench_mix', [],
+    'kind:n pairs for how many of each kind of synthetic activity there '
+    'are, such as "text:4,photo:1". The kinds are gallery, web page, '
+    'photo, video, text and reshare.')
+gflags.DEFINE_float(
+    'bench_latency', 0,
+    'Seconds each request to the fake services takes in the sync '
+    'benchmark.')
+gflags.DEFINE_string(
+    'bench_variant', None,
+    'Run just this variant of the sync benchmark, in this process. The sync '
+    'benchmark runs each variant in a process of its own with this.')
+
+RESULTS = []
+
+
+def load_samples():
+    """The Google+ activities in test_documents."""
+    samples = []
+    for filename in sorted(glob.glob(os.path.join(
+            os.path.dirname(__file__) or '.',
+            'test_documents', 'sample_*.json'))):
+        file_ = open(filename)
+        samples.append(json.load(file_))
+        file_.close()
+    return samples
+
+
+def report(name, seconds, number, unit='post'):
+    print '%-40s %10.1f us/%s' % (name, seconds / number * 1e6, unit)
+    RESULTS.append({
+        'name': name,
+        'seconds': seconds,
+        'count': number,
+        'unit': unit,
+    })
+
+
+def peak_rss():
+    """Peak resident memory of this process so far, in KB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def bench_title_extraction(number=200):
+    """Title extraction with and without the fast path."""
+    import plus
+
+    corpora = [
+        ('samples', [g['object']['content'] for g in load_samples()]),
+        # Most posts are a line or two of plain text.
+        ('short posts', [
+            u'Off to the beach for the weekend!',
+            u'Finally finished the <b>new</b> release.<br />Notes to follow',
+            u'Is anyone else at the conference this week?',
+            u'Great talk by <a href="https://plus.google.com/1">Bob</a>',
+        ]),
+    ]
+
+    for corpus, contents in corpora:
+        for name, extractor in (
+                ('html2text + nltk', plus.TitleExtractor(fast=False)),
+                ('fast path', plus.TitleExtractor())):
+            seconds = timeit.timeit(
+                lambda: [extractor.extract(c) for c in contents],
+                number=number)
+            report('titles, %s, %s' % (corpus, name),
+                   seconds, number * len(contents))
+
+
+def bench_templates(number=2000, loads=50):
+    """Rendering each template, and loading them with and without bytecode."""
+    import shutil
+    import tempfile
+    import plus
+
+    contexts = [
+        ('gallery.html', {'gid': '1', 'attachments': [{
+            'src': 'embedly',
+            'html': '<iframe></iframe>',
+            'thumbnail_url': 'http://example.com/%d.jpg' % i,
+            'description': 'Photo %d' % i,
+            'title': 'Photo %d' % i,
+        } for i in range(8)]}),
+        ('webpage.html', {
+            'webpage': {'url': 'http://example.com/'},
+            'edata': {'title': 'Example', 'description': 'An example',
+                      'thumbnail_url': 'http://example.com/thumb.jpg'},
+            'images': [],
+            'has_preview': True,
+            'has_edata_html': False,
+            'has_edata_image': True,
+            'has_images': False,
+        }),
+        ('geocode.html', {
+            'coordinates': '-33.86,151.21', 'address': '',
+            'placename': 'Sydney'}),
+    ]
+
+    cache = tempfile.mkdtemp()
+    template_cache = FLAGS.template_cache
+    try:
+        for name, flag in [('parsed', ''), ('bytecode cache', cache)]:
+            FLAGS.template_cache = flag
+
+            def load():
+                plus.ENV = None
+                for filename, _ in contexts:
+                    plus.environment().get_template(filename)
+            load()  # Fills the bytecode cache.
+            report('templates, load, %s' % name,
+                   timeit.timeit(load, number=loads),
+                   loads * len(contexts), 'template')
+
+        for filename, context in contexts:
+            plus.render_tmpl(filename, context)
+            report('templates, render %s' % filename,
+                   timeit.timeit(lambda: plus.render_tmpl(filename, context),
+                                 number=number),
+                   number, 'render')
+    finally:
+        FLAGS.template_cache = template_cache
+        plus.ENV = None
+        shutil.rmtree(cache)
+
+
+# The plus.py flags for each way of running the sync benchmark.
+SYNC_VARIANTS = [
+    ('serial', ['--noconcurrent']),
+    ('concurrent', ['--concurrent']),
+]
+
+
+def sync_stages(service, connections):
+    """Time each stage of a sync on its own.
+
+    The stages are run one after another over the whole stream, so each
+    one's time doesn't include waiting on the others.
+    """
+    import fakes
+    import plus
+
+    fakes.install(connections)
+    wp = plus.Client(
+        'http://wordpress.invalid/xmlrpc.php', 'user', 'password',
+        transport=plus.PooledTransport(connections))
+    if FLAGS.concurrent:
+        sync = plus.ConcurrentActivitySync(
+            plus.WordPressPostIndex(), plus.ConcurrentPublisher(
+                wp, FLAGS.batch_size, FLAGS.host_connections),
+            activity_workers=FLAGS.activity_workers)
+    else:
+        sync = plus.ActivitySync(
+            plus.WordPressPostIndex(),
+            plus.WordPressPublisher(wp, FLAGS.batch_size))
+
+    stages = {}
+    start = time.time()
+    items = list(sync.select(sync.fetch(service, 'me')))
+    stages['fetch'] = time.time() - start
+
+    for stage, func in [
+            ('lookup', sync.lookup), ('render', sync.render),
+            ('diff', sync.diff), ('publish', sync.publish)]:
+        start = time.time()
+        items = func(items)
+        if items is not None:
+            items = list(items)
+        stages[stage] = time.time() - start
+    return stages
+
+
+def bench_sync():
+    """Whole syncs of a synthetic stream to a fake blog.
+
+    Each variant is run in a new process, so its peak memory use is its
+    own.
+    """
+    if FLAGS.bench_variant:
+        bench_sync_variant(FLAGS.bench_variant)
+        return
+
+    # The flags given to this process, less those for running a variant.
+    flags = [flag.Serialize() for flag in set(FLAGS.FlagDict().values())
+             if flag.present and flag.name not in (
+                 'bench_json', 'bench_variant')]
+    for variant, _ in SYNC_VARIANTS:
+        process = subprocess.Popen(
+            [sys.executable, '-m', 'benchmarks', '--bench_json=-',
+             '--bench_variant=' + variant] + flags + ['sync'],
+            stdout=subprocess.PIPE, stderr=sys.stdout,
+            cwd=os.path.dirname(__file__) or '.')
+        output = process.communicate()[0]
+        if process.returncode:
+            raise RuntimeError('The %s sync benchmark failed' % variant)
+        RESULTS.extend(json.loads(output)['results'])
+
+
+def bench_sync_variant(variant):
+    import fakes
+
+    mix = None
+    if FLAGS.bench_mix:
+        mix = dict((kind, float(n)) for kind, _, n in (
+            pair.rpartition(':') for pair in FLAGS.bench_mix))
+    activities = fakes.synthetic_activities(FLAGS.bench_activities, mix)
+
+    service, connections = fakes.fake_services(
+        latency=FLAGS.bench_latency, activities=activities)
+    start = time.time()
+    fakes.run(['plus.py', '--state_file=', '--embed_cache=',
+               '--noverbose'] + dict(SYNC_VARIANTS)[variant],
+              service, connections)
+    seconds = time.time() - start
+    # Before the stages are timed, as they hold the whole stream at once.
+    rss = peak_rss()
+
+    wordpress = connections.wordpress
+    posts = len(wordpress.posts)
+    calls = sum(n for method_name, n in wordpress.calls.iteritems()
+                if method_name != 'system.multicall')
+
+    service, connections = fakes.fake_services(
+        latency=FLAGS.bench_latency, activities=activities)
+    stages = sync_stages(service, connections)
+
+    name = 'sync, %s' % variant
+    print '%-40s %10.1f activities/s, %d posts' % (
+        name, len(activities) / seconds, posts)
+    print '%-40s %s' % ('', ', '.join(
+        '%s %.2fs' % (stage, stages[stage])
+        for stage in ('fetch', 'lookup', 'render', 'diff', 'publish')))
+    RESULTS.append({
+        'name': name,
+        'seconds': seconds,
+        'count': len(activities),
+        'unit': 'activity',
+        'activities_per_second': len(activities) / seconds,
+        'posts': posts,
+        'stage_seconds': stages,
+        'peak_rss_kb': rss,
+        'wordpress_calls_per_post': float(calls) / max(posts, 1),
+        'wordpress_requests_per_post':
+            float(wordpress.requests) / max(posts, 1),
+    })
+
+
+BENCHMARKS = [
+    ('titles', bench_title_extraction),
+    ('templates', bench_templates),
+    ('sync', bench_sync),
+]
+
+
+def git_commit():
+    try:
+        commit = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=os.path.dirname(__file__) or '.').communicate()[0].strip()
+    except OSError:
+        commit = None
+    return commit or None
+
+
+def main(argv):
+    import plus  # Defines the flags for the sync.
+
+    try:
+        argv = FLAGS(argv)
+    except gflags.FlagsError, e:
+        print '%s\nUsage: %s ARGS\n%s' % (e, argv[0], FLAGS)
+        sys.exit(1)
+
+    # With the JSON on stdout, everything else goes to stderr.
+    stdout = sys.stdout
+    if FLAGS.bench_json == '-':
+        sys.stdout = sys.stderr
+    try:
+        names = argv[1:]
+        for name, benchmark in BENCHMARKS:
+            if not names or name in names:
+                benchmark()
+    finally:
+        sys.stdout = stdout
+
+    if FLAGS.bench_json:
+        results = {
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'peak_rss_kb': peak_rss(),
+            'results': RESULTS,
+        }
+        if FLAGS.bench_json == '-':
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        else:
+            file_ = open(FLAGS.bench_json, 'w')
+            json.dump(results, file_, indent=2, sort_keys=True)
+            file_.close()
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,654 @@
+#!/usr/bin/python2.7
+# -*- coding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Local stand-ins for Google+, the oEmbed endpoints and Wordpress.
+
+They are seeded from the fixtures in test_documents and can be made slow or
+flaky, so a whole sync can be run and timed without any real services.
+
+Needs the same config.py and client_secrets.json as plus.py. You can sync
+the fixtures to a fake blog, with any of plus.py's flags, by running:
+    $ python -m fakes [--fake_latency=0.05] [--fake_error_rate=0.1] ...
+"""
+
+import collections
+import copy
+import datetime
+import glob
+import hashlib
+import json
+import mimetools
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+import urlparse
+import xmlrpclib
+from StringIO import StringIO
+
+import gflags
+import httplib2
+try:
+    from googleapiclient.errors import HttpError
+except ImportError:
+    from apiclient.errors import HttpError
+
+FLAGS = gflags.FLAGS
+
+gflags.DEFINE_float(
+    'fake_latency', 0, 'Seconds each request to a fake service takes.')
+gflags.DEFINE_float(
+    'fake_error_rate', 0,
+    'The fraction of requests to the fake services which fail with a 503.')
+gflags.DEFINE_integer(
+    'fake_copies', 1, 'How many copies of the sample activities to sync.')
+gflags.DEFINE_integer(
+    'fake_page_size', 20, 'How many activities are on each fake page.')
+gflags.DEFINE_integer(
+    'fake_seed', 0, 'Seed for which fake requests fail.')
+
+
+# Which embedly_*.json fixture has the oEmbed data for which sample_*.json.
+EMBED_FIXTURES = [
+    ('sample_multi_img.json', 'embedly_multiple_photos.json'),
+    ('sample_multi_img_with_content.json',
+     'embedly_multiple_photos_content.json'),
+    ('sample_multi_vid.json', 'embedly_multiple_videos.json'),
+    ('sample_photo_video_content.json', 'embedly_multi_photo_video.json'),
+    ('sample_webpage.json', 'embedly_single_linked.json'),
+    ('sample_webpage_with_content.json', 'embedly_linked_content.json'),
+    ('sample_pic_flickr_without_content.json', 'embedly_flickr.json'),
+    ('sample_pic_flickr_with_content.json',
+     'embedly_flickr_with_content.json'),
+    ('sample_smugmug.json', 'embedly_smugmug.json'),
+    ('sample_smugmug_with_content.json',
+     'embedly_smug_mug_with_content.json'),
+]
+
+
+def load_fixture(name):
+    file_ = open(os.path.join(
+        os.path.dirname(__file__) or '.', 'test_documents', name))
+    try:
+        return json.load(file_)
+    finally:
+        file_.close()
+
+
+def load_activities(copies=1):
+    """The sample activities, newest first.
+
+    Each copy after the first has its own activity ids.
+    """
+    samples = [
+        load_fixture(os.path.basename(filename))
+        for filename in sorted(glob.glob(os.path.join(
+            os.path.dirname(__file__) or '.',
+            'test_documents', 'sample_*.json')))]
+
+    activities = []
+    for i in range(copies):
+        for sample in samples:
+            activity = copy.deepcopy(sample)
+            if i:
+                activity['id'] = '%s-%d' % (activity['id'], i)
+            activities.append(activity)
+
+    activities.sort(key=lambda a: a['published'], reverse=True)
+    return activities
+
+
+# The fixture each kind of synthetic activity is based on.
+SYNTHETIC_TEMPLATES = {
+    'gallery': 'sample_photo_video_content.json',
+    'web page': 'sample_webpage_with_content.json',
+    'photo': 'sample_pic_with_content.json',
+    'video': 'sample_video_youtube_with_content.json',
+    # With its attachments taken off.
+    'text': 'sample_video_youtube_with_content.json',
+    'reshare': 'sample_share.json',
+}
+
+# Mostly text and photos, like most streams.
+DEFAULT_MIX = {
+    'text': 40,
+    'photo': 20,
+    'web page': 15,
+    'reshare': 10,
+    'gallery': 10,
+    'video': 5,
+}
+
+SENTENCES = [
+    u'Off to the beach for the weekend!',
+    u'Finally finished the <b>new</b> release.',
+    u'Is anyone else at the conference this week?',
+    u'Great talk by <a href="https://plus.google.com/1">Bob</a> today.',
+    u'The slides are up now, thanks to everyone who came along.',
+    u'Here are a few more photos from the trip.',
+    u'Not sure what to make of this one.',
+    u'Wrote up some notes on how we sped up the build.',
+]
+
+
+def synthetic_activities(count, mix=None, seed=0):
+    """count activities shaped like the fixtures, newest first.
+
+    mix gives how many of each kind of activity there are relative to the
+    others. Each activity has its own id, date, content and attachment
+    urls, so nothing is cached between them.
+    """
+    mix = mix or DEFAULT_MIX
+    rng = random.Random(seed)
+    templates = dict(
+        (kind, load_fixture(name))
+        for kind, name in SYNTHETIC_TEMPLATES.iteritems())
+
+    kinds = sorted(kind for kind in mix if mix[kind])
+    total = sum(mix[kind] for kind in kinds)
+
+    newest = datetime.datetime(2012, 9, 1)
+    activities = []
+    for i in range(count):
+        choice = rng.uniform(0, total)
+        for kind in kinds:
+            choice -= mix[kind]
+            if choice <= 0:
+                break
+
+        activity = copy.deepcopy(templates[kind])
+        activity['id'] = 'synthetic%d' % i
+        activity['published'] = activity['updated'] = (
+            newest - datetime.timedelta(minutes=7 * i)).strftime(
+                '%Y-%m-%dT%H:%M:%S.000Z')
+
+        obj = activity['object']
+        if kind == 'text':
+            del obj['attachments']
+        obj['content'] = ['', '<br />'][rng.random() < 0.3].join(
+            rng.choice(SENTENCES) for _ in range(rng.randint(1, 6)))
+        for n, attachment in enumerate(obj.get('attachments', [])):
+            if 'url' in attachment:
+                attachment['url'] = '%s#%d-%d' % (attachment['url'], i, n)
+
+        activities.append(activity)
+    return activities
+
+
+def load_embeds():
+    """The oEmbed data in the fixtures, by url."""
+    import plus
+
+    embeds = {}
+    for sample, fixture in EMBED_FIXTURES:
+        datas = load_fixture(fixture)
+        if isinstance(datas, dict):
+            datas = [datas]
+        urls = plus.activity_embed_urls(load_fixture(sample))
+        embeds.update(zip(urls, datas))
+    return embeds
+
+
+class Network(object):
+    """How slow and how flaky the fake services are."""
+
+    def __init__(self, latency=0, error_rate=0, seed=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def request(self):
+        """Wait for a request to be made, returns True if it failed."""
+        with self._lock:
+            self.requests += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+        return failed
+
+
+class FakeRequest(object):
+    """Like an apiclient HttpRequest.
+
+    With an etag, the request fails with a 304 when its If-None-Match
+    header matches.
+    """
+
+    def __init__(self, network, func, *args, **kw):
+        self.network = network
+        self.func = func
+        self.args = args
+        self.etag = kw.get('etag')
+        self.headers = {}
+
+    def execute(self, http=None):
+        if self.network.request():
+            raise HttpError(
+                httplib2.Response({'status': 503}), 'Backend Error')
+        if self.etag and self.headers.get('If-None-Match') == self.etag:
+            raise HttpError(httplib2.Response({'status': 304}), '')
+        return self.respond()
+
+    def respond(self):
+        return self.func(*self.args)
+
+
+class FakeBatch(object):
+    """Like an apiclient BatchHttpRequest, many requests in one."""
+
+    def __init__(self, service):
+        self.service = service
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request_id, request, callback))
+
+    def execute(self, http=None):
+        self.service.batches += 1
+        if self.service.network.request():
+            raise HttpError(
+                httplib2.Response({'status': 503}), 'Backend Error')
+        for request_id, request, callback in self.requests:
+            callback(request_id, request.respond(), None)
+
+
+class FakeComments(object):
+    """The comments resource of FakePlusService."""
+
+    def __init__(self, service):
+        self.service = service
+
+    def list(self, activityId, maxResults=20, sortOrder='ascending',
+             pageToken=None):
+        self.service.comment_pages += 1
+        start = int(pageToken or 0)
+        page_size = min(maxResults, self.service.page_size)
+        comments = self.service.comment_store.get(activityId, [])
+        if sortOrder == 'descending':
+            comments = comments[::-1]
+        page = {
+            'kind': 'plus#commentFeed',
+            'items': comments[start:start + page_size],
+        }
+        if start + page_size < len(comments):
+            page['nextPageToken'] = str(start + page_size)
+        request = FakeRequest(self.service.network, json.loads,
+                              json.dumps(page))
+        request.list_args = (activityId, maxResults, sortOrder)
+        return request
+
+    def list_next(self, previous_request, previous_response):
+        if 'nextPageToken' not in previous_response:
+            return None
+        return self.list(*previous_request.list_args,
+                         pageToken=previous_response['nextPageToken'])
+
+
+class FakePlusService(object):
+    """Enough of the apiclient Google+ service for plus.py.
+
+    Pages of activities go through JSON like the real ones do.
+    """
+
+    def __init__(self, activities, page_size=20, network=None, person=None):
+        self.network = network or Network()
+        self.person = person or {'id': '1', 'displayName': 'Fake Person'}
+        self.page_size = page_size
+        self.stream = []
+        self.comment_store = {}
+        self.activity_pages = 0
+        self.batches = 0
+        self.comment_pages = 0
+        self.add(activities)
+
+    def add(self, activities):
+        """Post some activities, newest first, to the top of the stream."""
+        self.stream = list(activities) + self.stream
+        self.activity_count = len(self.stream)
+        self._paginate()
+
+    def add_comments(self, activity_id, comments):
+        """Comment on an activity, oldest first."""
+        self.comment_store.setdefault(activity_id, []).extend(comments)
+        self._paginate()
+
+    def _paginate(self):
+        self.pages = []
+        for start in range(0, max(len(self.stream), 1), self.page_size):
+            items = []
+            for item in self.stream[start:start + self.page_size]:
+                if item['id'] in self.comment_store:
+                    item = copy.deepcopy(item)
+                    item['object'].setdefault('replies', {})['totalItems'] = (
+                        len(self.comment_store[item['id']]))
+                items.append(item)
+            page = {
+                'kind': 'plus#activityFeed',
+                'items': items,
+            }
+            if start + self.page_size < len(self.stream):
+                page['nextPageToken'] = str(len(self.pages) + 1)
+            page['etag'] = '"%s"' % hashlib.md5(
+                json.dumps(page, sort_keys=True)).hexdigest()
+            self.pages.append(json.dumps(page))
+
+    def activities(self):
+        return self
+
+    def people(self):
+        return self
+
+    def comments(self):
+        return FakeComments(self)
+
+    def new_batch_http_request(self):
+        return FakeBatch(self)
+
+    def list(self, userId, collection, pageToken=None):
+        self.activity_pages += 1
+        page = self.pages[int(pageToken or 0)]
+        return FakeRequest(
+            self.network, json.loads, page, etag=json.loads(page)['etag'])
+
+    def list_next(self, previous_request, previous_response):
+        if 'nextPageToken' not in previous_response:
+            return None
+        return self.list(None, None, previous_response['nextPageToken'])
+
+    def get(self, userId):
+        return FakeRequest(self.network, copy.deepcopy, self.person)
+
+
+class FakeResponse(object):
+    """Like the responses from plus.ConnectionPool.request()."""
+
+    will_close = False
+
+    def __init__(self, status, data, content_type='text/xml', reason='OK'):
+        self.status = status
+        self.reason = reason
+        self.data = data
+        self.msg = mimetools.Message(
+            StringIO('Content-Type: %s\n' % content_type))
+
+    def getheader(self, name, default=None):
+        return self.msg.getheader(name, default)
+
+
+class FakeOEmbed(object):
+    """oEmbed and Embedly endpoints answering from the fixtures.
+
+    Urls which aren't in the fixtures are plain links.
+    """
+
+    def __init__(self, embeds):
+        self.embeds = embeds
+
+    def lookup(self, url):
+        return self.embeds.get(url) or {
+            'type': 'link',
+            'version': '1.0',
+            'url': url,
+            'title': url.rstrip('/').rsplit('/', 1)[-1],
+        }
+
+    def handle(self, url):
+        # Embedly's urls parameter holds escaped urls split by commas.
+        params = dict(
+            param.split('=', 1) for param in
+            urlparse.urlsplit(url).query.split('&') if '=' in param)
+        if 'urls' in params:
+            data = [self.lookup(urllib.unquote(u))
+                    for u in params['urls'].split(',')]
+        else:
+            data = self.lookup(urllib.unquote(params['url']))
+        return FakeResponse(200, json.dumps(data), 'application/json')
+
+
+class FakeWordPress(object):
+    """A Wordpress blog in memory, answering XML-RPC requests."""
+
+    def __init__(self):
+        self.posts = {}
+        self.comments = {}
+        self.requests = 0
+        self.calls = collections.Counter()
+
+        self._lock = threading.Lock()
+        self._ids = 0
+
+    def _next_id(self):
+        self._ids += 1
+        return str(self._ids)
+
+    def handle(self, body, headers):
+        with self._lock:
+            self.requests += 1
+        if headers.get('Content-Encoding') == 'gzip':
+            body = xmlrpclib.gzip_decode(body)
+        params, method_name = xmlrpclib.loads(body)
+        try:
+            response = xmlrpclib.dumps(
+                (self.dispatch(method_name, params),),
+                methodresponse=True, allow_none=True)
+        except xmlrpclib.Fault, fault:
+            response = xmlrpclib.dumps(fault, methodresponse=True)
+        return FakeResponse(200, response)
+
+    def dispatch(self, method_name, params):
+        with self._lock:
+            self.calls[method_name] += 1
+        if method_name not in self.METHODS:
+            raise xmlrpclib.Fault(
+                -32601, 'server error. requested method %s does not '
+                'exist.' % method_name)
+        return self.METHODS[method_name](self, *params)
+
+    def supported_methods(self):
+        return sorted(self.METHODS)
+
+    def multicall(self, calls):
+        results = []
+        for call in calls:
+            try:
+                results.append(
+                    [self.dispatch(call['methodName'], call['params'])])
+            except xmlrpclib.Fault, fault:
+                results.append({
+                    'faultCode': fault.faultCode,
+                    'faultString': fault.faultString,
+                })
+        return results
+
+    def _post(self, post_id):
+        if post_id not in self.posts:
+            raise xmlrpclib.Fault(404, 'Invalid post ID.')
+        return self.posts[post_id]
+
+    def _struct(self, post, fields):
+        if not fields:
+            return copy.deepcopy(post)
+        return dict((key, copy.deepcopy(post[key]))
+                    for key in ['post_id'] + list(fields) if key in post)
+
+    def _set_custom_fields(self, post, custom_fields):
+        existing = post.setdefault('custom_fields', [])
+        for field in custom_fields:
+            field = dict(field)
+            for old in existing:
+                if old['id'] == field.get('id'):
+                    old.update(field)
+                    break
+            else:
+                field['id'] = self._next_id()
+                existing.append(field)
+
+    def get_posts(self, blog_id, username, password, filter=None,
+                  fields=None):
+        filter = filter or {}
+        number = filter.get('number', 10)
+        offset = filter.get('offset', 0)
+        with self._lock:
+            newest_first = sorted(
+                self.posts.itervalues(),
+                key=lambda post: int(post['post_id']), reverse=True)
+            return [self._struct(post, fields)
+                    for post in newest_first[offset:offset + number]]
+
+    def get_post(self, blog_id, username, password, post_id, fields=None):
+        with self._lock:
+            return self._struct(self._post(post_id), fields)
+
+    def new_post(self, blog_id, username, password, content):
+        with self._lock:
+            post = dict(content)
+            post['post_id'] = self._next_id()
+            self._set_custom_fields(post, post.pop('custom_fields', []))
+            self.posts[post['post_id']] = post
+            return post['post_id']
+
+    def edit_post(self, blog_id, username, password, post_id, content):
+        with self._lock:
+            post = self._post(post_id)
+            content = dict(content)
+            self._set_custom_fields(post, content.pop('custom_fields', []))
+            post.update(content)
+            return True
+
+    def new_comment(self, blog_id, username, password, post_id, comment):
+        with self._lock:
+            self._post(post_id)
+            comment = dict(comment)
+            comment['comment_id'] = self._next_id()
+            comment['post_id'] = post_id
+            self.comments[comment['comment_id']] = comment
+            return int(comment['comment_id'])
+
+    METHODS = {
+        'mt.supportedMethods': supported_methods,
+        'system.multicall': multicall,
+        'wp.getPosts': get_posts,
+        'wp.getPost': get_post,
+        'wp.newPost': new_post,
+        'wp.editPost': edit_post,
+        'wp.newComment': new_comment,
+    }
+
+
+class FakeConnections(object):
+    """Stands in for a plus.ConnectionPool.
+
+    XML-RPC requests go to a FakeWordPress, everything else is an oEmbed
+    lookup for a FakeOEmbed.
+    """
+
+    def __init__(self, oembed, wordpress, network=None, limit=4):
+        self.oembed = oembed
+        self.wordpress = wordpress
+        self.network = network or Network()
+        self.limit = limit
+
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.requests = 0
+
+    def host_limit(self, host):
+        return self.limit
+
+    def request(self, method, url, body=None, headers=None):
+        with self._lock:
+            self.requests += 1
+        if self.network.request():
+            return FakeResponse(
+                503, 'Service Unavailable', 'text/plain',
+                'Service Unavailable')
+
+        if method == 'POST':
+            return self.wordpress.handle(body, headers or {})
+        return self.oembed.handle(url)
+
+    def close(self):
+        pass
+
+
+def fake_services(copies=1, latency=0, error_rate=0, page_size=20, seed=0,
+                  activities=None):
+    """Returns the (service, connections) to give plus.main().
+
+    The activities are copies of the samples, unless they are given.
+    """
+    network = Network(latency, error_rate, seed)
+    if activities is None:
+        activities = load_activities(copies)
+    service = FakePlusService(activities, page_size, network)
+    connections = FakeConnections(
+        FakeOEmbed(load_embeds()), FakeWordPress(), network)
+    return service, connections
+
+
+def install(connections):
+    """Make plus.py's oEmbed lookups go to the fakes."""
+    import plus
+    for endpoint in plus.OEMBED_CONSUMER.getEndpoints():
+        endpoint.setUrllib(plus.PooledUrllib(connections))
+
+
+def run(argv, service, connections):
+    """Run plus.main() against the fakes."""
+    import plus
+    install(connections)
+    plus.main(argv, service, connections)
+
+
+def main(argv):
+    import plus  # Defines the flags for the sync.
+
+    # Don't touch the real state or cache, unless asked to.
+    FLAGS.SetDefault('state_file', '')
+    FLAGS.SetDefault('embed_cache', '')
+    try:
+        FLAGS(argv)
+    except gflags.FlagsError, e:
+        print '%s\nUsage: %s ARGS\n%s' % (e, argv[0], FLAGS)
+        sys.exit(1)
+
+    service, connections = fake_services(
+        FLAGS.fake_copies, FLAGS.fake_latency, FLAGS.fake_error_rate,
+        FLAGS.fake_page_size, FLAGS.fake_seed)
+
+    start = time.time()
+    run(argv, service, connections)
+    seconds = time.time() - start
+
+    wordpress = connections.wordpress
+    print "Synced %d activities to %d posts in %.2fs" % (
+        service.activity_count, len(wordpress.posts), seconds)
+    print "%d requests, %d failed" % (
+        connections.network.requests, connections.network.errors)
+    for method_name, calls in sorted(wordpress.calls.iteritems()):
+        print "  %-20s %d" % (method_name, calls)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -38,25 +38,55 @@ import gflags
 import httplib2
 import logging
 import os
+import pstats
 import pprint
 import sys
 import re
+import signal
+import codecs
+import collections
+import contextlib
+import cProfile
+import email.utils
+import errno
+import functools
+import hashlib
+import httplib
+import json
+import multiprocessing
+import Queue
+import random
+import socket
+import StringIO
+import sqlite3
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+import urlparse
+import xmlrpclib
+import zipfile
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape as xml_escape
 
 import oembed
-from apiclient.discovery import build
-from oauth2client.file import Storage
-from oauth2client.client import AccessTokenRefreshError
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.tools import run
-
-import html2text
-import nltk
+try:
+    # The apiclient package imports apiclient.discovery and oauth2client.
+    from googleapiclient.errors import HttpError
+except ImportError:
+    # google-api-python-client from before googleapiclient.
+    from apiclient.errors import HttpError
+
+# apiclient.discovery, oauth2client, html2text, nltk and jinja2 are slow to
+# import, so they are imported by the code which needs them.
 from wordpress_xmlrpc import Client, WordPressPost
 from wordpress_xmlrpc import WordPressComment, AnonymousMethod
 from wordpress_xmlrpc.methods import posts, comments
 import wordpress_xmlrpc
 
 from dateutil.parser import parse as date_parse
+from dateutil.tz import gettz, tzutc
 
 FLAGS = gflags.FLAGS
 
@@ -68,6 +98,156 @@ gflags.DEFINE_boolean(
     'dryrun', False, "Don't upload anything to wordpress yet.")
 gflags.DEFINE_string(
     'post_id', None, 'Google+ post id for the tool to look at.')
+gflags.DEFINE_string(
+    'state_file', 'plus_state.db',
+    'Where to remember which activities have been synced to Wordpress. '
+    'Set to empty to always crawl the Wordpress blog instead.')
+gflags.DEFINE_boolean(
+    'rebuild_state', False,
+    'Rebuild the sync state by crawling all the posts on Wordpress.')
+gflags.DEFINE_boolean(
+    'incremental', False,
+    'Stop looking at Google+ activities once we reach those which were '
+    'already synced by the last run. Needs --state_file.')
+gflags.DEFINE_integer(
+    'embed_workers', 8, 'How many oEmbed lookups to do at once.')
+gflags.DEFINE_integer(
+    'embed_endpoint_workers', 4,
+    'How many oEmbed lookups to do at once against any one endpoint.')
+gflags.DEFINE_string(
+    'embed_cache', 'embed_cache.db',
+    'Where to cache oEmbed lookups. Set to empty to disable the cache.')
+gflags.DEFINE_integer(
+    'embed_cache_ttl', 30 * 24 * 60 * 60,
+    'How many seconds to keep oEmbed lookups in the cache.')
+gflags.DEFINE_integer(
+    'embed_cache_negative_ttl', 24 * 60 * 60,
+    'How many seconds to remember that an oEmbed lookup failed.')
+gflags.DEFINE_enum(
+    'embed_cache_command', None, ['stats', 'prune', 'evict', 'clear'],
+    'Look after the oEmbed cache and exit. "prune" removes expired entries, '
+    '"evict" removes the urls given as arguments, "clear" removes '
+    'everything.')
+gflags.DEFINE_integer(
+    'queue_size', 100,
+    'How many activities to hold between the stages of the sync.')
+gflags.DEFINE_integer(
+    'batch_size', 20,
+    'How many Wordpress calls to send together in one system.multicall.')
+gflags.DEFINE_integer(
+    'workers', 0,
+    'How many processes to render posts in. 0 renders them in this '
+    'process.')
+gflags.DEFINE_boolean(
+    'concurrent', False,
+    'Look up the oEmbed data for several activities at once, and send '
+    'several batches of Wordpress calls at once, over shared keep-alive '
+    'connections.')
+gflags.DEFINE_integer(
+    'activity_workers', 8,
+    'How many activities to look up oEmbed data for at once with '
+    '--concurrent.')
+gflags.DEFINE_integer(
+    'host_connections', 4,
+    'How many connections to open to any one host.')
+gflags.DEFINE_list(
+    'host_limits', [],
+    'host:connections pairs overriding --host_connections for some hosts.')
+gflags.DEFINE_float(
+    'timeout', 60, 'How many seconds to wait on a HTTP connection.')
+gflags.DEFINE_string(
+    'profile', None,
+    'Profile the sync into this file, for pstats. The time each activity '
+    'and url took also goes into this file name with .trace on the end.')
+gflags.DEFINE_float(
+    'plus_rate', 0,
+    'How many Google+ API requests to make a second, 0 for no limit.')
+gflags.DEFINE_float(
+    'embed_rate', 0,
+    'How many oEmbed requests to make a second, 0 for no limit.')
+gflags.DEFINE_float(
+    'wordpress_rate', 0,
+    'How many Wordpress requests to make a second, 0 for no limit.')
+gflags.DEFINE_integer(
+    'retries', 4, 'How many times to retry a request which failed '
+    'with a transient error.')
+gflags.DEFINE_float(
+    'backoff', 1, 'Seconds to wait before the first retry. This doubles '
+    'for every retry after it, up to --max_backoff.')
+gflags.DEFINE_float(
+    'max_backoff', 60, 'The longest to wait before a retry, unless the '
+    'server asks for longer with Retry-After.')
+gflags.DEFINE_integer(
+    'breaker_failures', 5,
+    'How many transient errors in a row stop an endpoint being used. 0 '
+    'never stops using it.')
+gflags.DEFINE_float(
+    'breaker_reset', 60,
+    'Seconds before an endpoint which was stopped is tried again.')
+gflags.DEFINE_boolean(
+    'wordpress_gzip_requests', False,
+    'Gzip the larger requests to Wordpress. Responses are always allowed '
+    'to be gzipped, but not every server understands gzipped requests.')
+gflags.DEFINE_string(
+    'metrics_file', None,
+    'Write metrics about the sync to this file, such as a .prom file in '
+    "node_exporter's textfile collector directory.")
+gflags.DEFINE_enum(
+    'metrics_format', 'prometheus', ['prometheus', 'json'],
+    'What format to write --metrics_file in.')
+gflags.DEFINE_float(
+    'metrics_interval', 60,
+    'How many seconds between writing --metrics_file while the sync runs. '
+    'It is always written at the end, 0 only writes it then.')
+gflags.DEFINE_string(
+    'template_cache', None,
+    'Where to keep the compiled templates between runs. By default this is '
+    "in the system's temporary directory, set to empty to not keep them.")
+gflags.DEFINE_string(
+    'discovery_cache', 'plus_discovery.json',
+    'Where to keep the Google+ API discovery document between runs. Set to '
+    'empty to fetch it every time.')
+gflags.DEFINE_integer(
+    'discovery_cache_ttl', 24 * 60 * 60,
+    'How many seconds to use the cached discovery document for before '
+    'fetching it again.')
+gflags.DEFINE_string(
+    'takeout', None,
+    'Sync the Google+ posts in this Google Takeout archive, a zip or the '
+    'directory it unzipped to, instead of those from the Google+ API.')
+gflags.DEFINE_boolean(
+    'comments', False,
+    'Sync the comments on the Google+ activities too, from the API or '
+    'the --takeout archive. Needs --state_file to remember which comments '
+    'have been synced. WXR files always have the comments from the '
+    'archive.')
+gflags.DEFINE_integer(
+    'comment_batch_size', 50,
+    'How many activities to fetch the comments of in one batch request.')
+gflags.DEFINE_string(
+    'wxr', None,
+    "Write the posts and their comments to WXR files for Wordpress's "
+    'importer, instead of sending them to Wordpress.')
+gflags.DEFINE_integer(
+    'wxr_max_bytes', 2 * 1024 * 1024,
+    'Start a new WXR file when one would grow past this size, numbering '
+    'the files after --wxr, such as export-001.xml. 0 writes one file.')
+gflags.DEFINE_string(
+    'wxr_timezone', None,
+    "The blog's timezone, such as Australia/Sydney, for the local times in "
+    "the WXR files. Without it the importer works out each post's local "
+    "time itself, but the comments' local times are written in UTC.")
+gflags.DEFINE_boolean(
+    'watch', False,
+    'Keep running, polling Google+ for new activities and syncing them, '
+    'until interrupted or sent SIGTERM.')
+gflags.DEFINE_float(
+    'watch_interval', 60,
+    'Seconds between polls with --watch after a poll found something new.')
+gflags.DEFINE_float(
+    'watch_max_interval', 900,
+    'The longest to wait between polls with --watch. The wait doubles for '
+    'every poll which finds nothing new, up to this.')
 
 
 # Fix wordpress_xmlrpc's __repr__ function to use unicode(self) instead of
@@ -78,6 +258,734 @@ def WordPressBase__repr__(self):
 wordpress_xmlrpc.WordPressBase.__repr__ = WordPressBase__repr__
 
 
+# Code to time the sync
+###############################################################################
+
+class Timings(object):
+    """Counts and latency histograms for the parts of the sync.
+
+    With tracing on, the time is also kept for each label given, such as
+    an activity id or a url.
+    """
+
+    # Upper bounds, in seconds, of the histogram buckets.
+    BUCKETS = (0.001, 0.01, 0.1, 1, 10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> [count, total seconds, slowest seconds, histogram]
+        self.stats = {}
+
+        self.tracing = False
+        self.trace = collections.defaultdict(collections.Counter)
+
+    def add(self, name, seconds, label=None):
+        with self._lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = [
+                    0, 0.0, 0.0, [0] * (len(self.BUCKETS) + 1)]
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+            for i, bound in enumerate(self.BUCKETS):
+                if seconds < bound:
+                    break
+            else:
+                i = len(self.BUCKETS)
+            stats[3][i] += 1
+
+            if self.tracing and label is not None:
+                self.trace[label][name] += seconds
+
+    @contextlib.contextmanager
+    def time(self, name, label=None):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start, label)
+
+    def summary(self):
+        """Lines describing the timings, most total time first."""
+        lines = ['%-28s %7s %9s %9s %9s  %s' % (
+            'Timings', 'count', 'total', 'mean', 'max',
+            ' '.join('<%ss' % bound for bound in self.BUCKETS) + ' more')]
+        with self._lock:
+            stats = sorted(self.stats.iteritems(), key=lambda s: -s[1][1])
+            for name, (count, total, slowest, histogram) in stats:
+                lines.append('%-28s %7d %8.3fs %8.4fs %8.4fs  %s' % (
+                    name, count, total, total / count, slowest,
+                    ' '.join(str(n) for n in histogram)))
+        return lines
+
+    def snapshot(self):
+        """A copy of the stats, which the sync can carry on changing."""
+        with self._lock:
+            return dict(
+                (name, (count, total, slowest, list(histogram)))
+                for name, (count, total, slowest, histogram)
+                in self.stats.iteritems())
+
+    def write_trace(self, filename):
+        """Write where the time went for each label, slowest first."""
+        with self._lock:
+            trace = sorted(
+                self.trace.iteritems(), key=lambda t: -sum(t[1].values()))
+
+        file_ = open(filename, 'w')
+        try:
+            file_.write('# seconds, activity id or url, and what the time '
+                        'was spent on.\n')
+            for label, names in trace:
+                file_.write('%.4f\t%s\t%s\n' % (
+                    sum(names.values()), label.encode('utf-8'),
+                    ' '.join('%s=%.4f' % (name, seconds)
+                             for name, seconds in sorted(names.items()))))
+        finally:
+            file_.close()
+
+
+TIMINGS = Timings()
+
+
+class Profiler(object):
+    """Profiles the threads of the sync into one set of pstats."""
+
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._profiles = []
+
+    def wrap(self, func):
+        """Returns func, profiled when the profiler is enabled."""
+        if not self.enabled:
+            return func
+
+        def profiled(*args, **kw):
+            profile = cProfile.Profile()
+            with self._lock:
+                self._profiles.append(profile)
+            return profile.runcall(func, *args, **kw)
+        return profiled
+
+    def dump(self, filename):
+        with self._lock:
+            stats = pstats.Stats(*self._profiles)
+        stats.dump_stats(filename)
+
+
+PROFILER = Profiler()
+
+
+# Code to export metrics about the sync
+###############################################################################
+
+# kind is counter, gauge or histogram. The value of a histogram is
+# ([(upper bound, cumulative count), ...], sum, count).
+Metric = collections.namedtuple('Metric', 'name kind help labels value')
+
+
+def timings_metrics(timings, name='latency_seconds', label='stage'):
+    """Metrics for the latency histograms of a Timings."""
+    metrics = []
+    for stage, (count, total, _, histogram) in sorted(
+            timings.snapshot().iteritems()):
+        buckets = []
+        cumulative = 0
+        for bound, n in zip(timings.BUCKETS + (float('inf'),), histogram):
+            cumulative += n
+            buckets.append((bound, cumulative))
+        metrics.append(Metric(
+            name, 'histogram', 'How long each part of the sync took.',
+            {label: stage}, (buckets, total, count)))
+    return metrics
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, unicode(value).replace('\\', r'\\').replace(
+            '"', r'\"').replace('\n', r'\n'))
+        for key, value in sorted(labels.iteritems()))
+
+
+def format_prometheus(metrics, prefix='plus_'):
+    """The metrics in Prometheus' text exposition format."""
+    lines = []
+    described = set()
+    for metric in metrics:
+        name = prefix + metric.name
+        if name not in described:
+            described.add(name)
+            lines.append('# HELP %s %s' % (name, metric.help))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+
+        if metric.kind == 'histogram':
+            buckets, total, count = metric.value
+            for bound, n in buckets:
+                labels = dict(metric.labels, le=format_value(bound))
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels), n))
+            lines.append('%s_sum%s %s' % (
+                name, format_labels(metric.labels), format_value(total)))
+            lines.append('%s_count%s %d' % (
+                name, format_labels(metric.labels), count))
+        else:
+            lines.append('%s%s %s' % (
+                name, format_labels(metric.labels),
+                format_value(metric.value)))
+    return (u'\n'.join(lines) + u'\n').encode('utf-8')
+
+
+def format_json(metrics, prefix='plus_'):
+    """The metrics as a JSON document."""
+    values = []
+    for metric in metrics:
+        value = metric.value
+        if metric.kind == 'histogram':
+            buckets, total, count = value
+            value = {
+                'buckets': [[format_value(bound), n] for bound, n in buckets],
+                'sum': total,
+                'count': count,
+            }
+        values.append({
+            'name': prefix + metric.name,
+            'kind': metric.kind,
+            'labels': metric.labels,
+            'value': value,
+        })
+    return json.dumps(
+        {'time': time.time(), 'metrics': values}, indent=2, sort_keys=True)
+
+
+METRICS_FORMATS = {
+    'prometheus': format_prometheus,
+    'json': format_json,
+}
+
+
+def write_atomically(filename, data):
+    """Write a file so that readers see either the old or the new one."""
+    directory, basename = os.path.split(os.path.abspath(filename))
+    fd, temp = tempfile.mkstemp(dir=directory, prefix='.%s.' % basename)
+    try:
+        try:
+            os.write(fd, data)
+            os.fchmod(fd, 0644)
+        finally:
+            os.close(fd)
+        os.rename(temp, filename)
+    except:
+        os.unlink(temp)
+        raise
+
+
+class MetricsWriter(object):
+    """Writes metrics to a file every interval seconds, and when stopped.
+
+    collect() is called from the writer's own thread to get a list of
+    Metric. It should only read counters the sync keeps anyway, so the sync
+    does no extra work for the metrics however often they are written.
+    """
+
+    def __init__(self, filename, collect, format='prometheus', interval=60,
+                 labels=None):
+        self.filename = filename
+        self.collect = collect
+        self.format = METRICS_FORMATS[format]
+        self.interval = interval
+        self.labels = labels or {}
+
+        self._stopped = threading.Event()
+        self._thread = None
+        self.writes = 0
+
+    def write(self):
+        metrics = [metric._replace(labels=dict(self.labels, **metric.labels))
+                   for metric in self.collect()]
+        write_atomically(self.filename, self.format(metrics))
+        self.writes += 1
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write()
+            except (IOError, OSError), e:
+                print "Unable to write metrics to %s: %s" % (
+                    self.filename, e)
+
+    def start(self):
+        if self.interval > 0:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop writing every interval, and write the final metrics."""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.write()
+
+
+# Code to pace and retry requests
+###############################################################################
+
+class CircuitOpenError(IOError):
+    """An endpoint has been failing, so it isn't being used for a while."""
+
+
+class TokenBucket(object):
+    """Lets calls through at rate a second, with bursts of up to burst.
+
+    A rate of 0 lets everything straight through.
+    """
+
+    def __init__(self, rate=0, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated = time.time()
+
+    def acquire(self):
+        """Wait for a token, returns how many seconds were spent waiting."""
+        if not self.rate:
+            return 0
+
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.burst,
+                self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            # Going into debt queues the waiting callers up in order.
+            self._tokens -= 1
+            wait = max(0, -self._tokens / self.rate)
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class CircuitBreaker(object):
+    """Stops using an endpoint after failures transient errors in a row.
+
+    Once reset seconds have passed a single call is let through to try the
+    endpoint again. If that works it is used as normal again, otherwise it
+    waits another reset seconds. 0 failures never stops using it.
+    """
+
+    def __init__(self, failures=5, reset=60):
+        self.failures = failures
+        self.reset = reset
+
+        self._lock = threading.Lock()
+        self._failed = 0
+        self._opened = None
+        self._trying = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            if not self._trying and time.time() - self._opened >= self.reset:
+                self._trying = True
+                return True
+            return False
+
+    def succeeded(self):
+        with self._lock:
+            self._failed = 0
+            self._opened = None
+            self._trying = False
+
+    def failed(self):
+        with self._lock:
+            self._failed += 1
+            self._trying = False
+            if self.failures and self._failed >= self.failures:
+                self._opened = time.time()
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# The statuses which mean the server didn't handle the request. A 502 or
+# 504 can come back after the backend has already handled it.
+REFUSED_STATUSES = (429, 503)
+
+# The reasons a Google API gives with a 403 when the request can be retried.
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def error_reasons(content):
+    """The reasons given in the body of a Google API error."""
+    try:
+        errors = json.loads(content)['error'].get('errors', [])
+        return set(error.get('reason') for error in errors)
+    except (ValueError, TypeError, KeyError, AttributeError):
+        return set()
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, or None."""
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+
+    date = email.utils.parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, email.utils.mktime_tz(date) - time.time())
+
+
+def retry_info(e, idempotent=True):
+    """Returns (retryable, retry after seconds or None) for an error.
+
+    Calls which aren't idempotent are only retried when they can't have
+    reached the server, or the server said it didn't handle them.
+    """
+    if isinstance(e, CircuitOpenError):
+        return False, None
+
+    statuses = RETRY_STATUSES if idempotent else REFUSED_STATUSES
+
+    if isinstance(e, HttpError):
+        rate_limited = (
+            e.resp.status == 403 and
+            error_reasons(e.content).intersection(RATE_LIMIT_REASONS))
+        return (e.resp.status in statuses or bool(rate_limited),
+                parse_retry_after(e.resp.get('retry-after')))
+
+    if isinstance(e, urllib2.HTTPError):
+        headers = e.info() or {}
+        return (e.code in statuses,
+                parse_retry_after(headers.get('retry-after')))
+
+    if isinstance(e, xmlrpclib.ProtocolError):
+        headers = e.headers or {}
+        return (e.errcode in statuses,
+                parse_retry_after(headers.get('retry-after')))
+
+    if isinstance(e, socket.error) and e.errno == errno.ECONNREFUSED:
+        return True, None
+
+    if isinstance(e, (socket.error, httplib.HTTPException,
+                      urllib2.URLError)):
+        return idempotent, None
+
+    return False, None
+
+
+class Scheduler(object):
+    """Paces, retries and circuit breaks the calls to a service.
+
+    Every call waits for the service's TokenBucket. Calls failing with a
+    transient error are retried after an exponential backoff with jitter,
+    or after the server's Retry-After if that is longer. Each of the
+    service's endpoints has its own CircuitBreaker.
+
+    The defaults just make the calls.
+    """
+
+    def __init__(self, name, rate=0, retries=0, backoff=1.0,
+                 max_backoff=60.0, failures=0, reset=60.0,
+                 idempotent=True):
+        self.name = name
+        self.bucket = TokenBucket(rate, int(rate))
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = failures
+        self.reset = reset
+        self.idempotent = idempotent
+
+        self._lock = threading.Lock()
+        self._breakers = {}
+
+        self.calls = 0
+        self.retried = 0
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(
+                    self.failures, self.reset)
+            return self._breakers[endpoint]
+
+    def delay(self, attempt, retry_after=None):
+        backoff = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return max(random.uniform(0, backoff), retry_after or 0)
+
+    def call(self, endpoint, func, *args, **kw):
+        """Call func(*args, **kw) for one of the service's endpoints."""
+        breaker = self.breaker(endpoint)
+        attempt = 0
+        while True:
+            if not breaker.allow():
+                raise CircuitOpenError(
+                    '%s endpoint %s is failing, not using it for now' % (
+                        self.name, endpoint))
+
+            self.bucket.acquire()
+            with self._lock:
+                self.calls += 1
+            try:
+                result = func(*args, **kw)
+            except Exception, e:
+                exc_info = sys.exc_info()
+                retryable, retry_after = retry_info(e, self.idempotent)
+                if not retryable:
+                    # The endpoint is working, it just didn't like the call.
+                    breaker.succeeded()
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                breaker.failed()
+                if attempt >= self.retries:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+                delay = self.delay(attempt, retry_after)
+                if FLAGS.verbose:
+                    print "%s call failed (%s), retrying in %.1fs" % (
+                        self.name, e, delay)
+                time.sleep(delay)
+
+                attempt += 1
+                with self._lock:
+                    self.retried += 1
+            else:
+                breaker.succeeded()
+                return result
+
+
+PLUS_SCHEDULER = Scheduler('Google+')
+EMBED_SCHEDULER = Scheduler('oEmbed')
+WORDPRESS_SCHEDULER = Scheduler('Wordpress', idempotent=False)
+
+
+# Code to share HTTP connections
+###############################################################################
+
+class ConnectionPool(object):
+    """Keep-alive HTTP connections which can be shared between threads.
+
+    Connections are kept for each scheme and host, and no more than the
+    host's limit of them are ever in use at once. So the limit is also how
+    many requests can be made to the host at the same time.
+    """
+
+    # Errors from a kept-alive connection the server has since closed.
+    STALE_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+    def __init__(self, limit=4, limits=None, timeout=None):
+        self.limit = limit
+        self.limits = dict(limits or {})
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._idle = collections.defaultdict(list)
+        self._semaphores = {}
+
+        self.connects = 0
+        self.requests = 0
+
+    def host_limit(self, host):
+        return self.limits.get(host, self.limit)
+
+    def _semaphore(self, key):
+        with self._lock:
+            if key not in self._semaphores:
+                self._semaphores[key] = threading.BoundedSemaphore(
+                    self.host_limit(key[1]))
+            return self._semaphores[key]
+
+    def _connect(self, scheme, host):
+        with self._lock:
+            self.connects += 1
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        return httplib.HTTPConnection(host, timeout=self.timeout)
+
+    def _send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        response = conn.getresponse()
+        response.data = response.read()
+        with self._lock:
+            self.requests += 1
+        return response
+
+    def request(self, method, url, body=None, headers=None):
+        """Make a request, the response's body is in its data attribute."""
+        scheme, host, path, query, _ = urlparse.urlsplit(url)
+        if query:
+            path = '%s?%s' % (path, query)
+        key = (scheme, host)
+
+        with self._semaphore(key):
+            with self._lock:
+                idle = self._idle[key]
+                conn = idle.pop() if idle else None
+
+            if conn:
+                try:
+                    response = self._send(
+                        conn, method, path or '/', body, headers or {})
+                except (socket.error, httplib.BadStatusLine), e:
+                    conn.close()
+                    stale = (isinstance(e, httplib.BadStatusLine) or
+                             e.errno in self.STALE_ERRNOS)
+                    if not stale:
+                        raise
+                    conn = None
+
+            if not conn:
+                conn = self._connect(scheme, host)
+                try:
+                    response = self._send(
+                        conn, method, path or '/', body, headers or {})
+                except:
+                    conn.close()
+                    raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                with self._lock:
+                    self._idle[key].append(conn)
+        return response
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.itervalues():
+                for conn in conns:
+                    conn.close()
+            self._idle.clear()
+
+
+def parse_host_limits(pairs):
+    """Turns ['host:n', ...] into {'host': n, ...}."""
+    limits = {}
+    for pair in pairs:
+        host, _, limit = pair.rpartition(':')
+        limits[host] = int(limit)
+    return limits
+
+
+class PooledUrllib(object):
+    """Enough of urllib2 for python-oembed, using a ConnectionPool.
+
+    Use it with OEmbedEndpoint.setUrllib().
+    """
+
+    MAX_REDIRECTS = 5
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.addheaders = []
+
+    def build_opener(self):
+        return PooledUrllib(self.pool)
+
+    def open(self, url, redirects=0):
+        response = self.pool.request('GET', url, headers=dict(self.addheaders))
+        location = response.getheader('location')
+        if (response.status in (301, 302, 303, 307) and location and
+                redirects < self.MAX_REDIRECTS):
+            return self.open(urlparse.urljoin(url, location), redirects + 1)
+
+        fp = StringIO.StringIO(response.data)
+        if response.status >= 400:
+            raise urllib2.HTTPError(
+                url, response.status, response.reason, response.msg, fp)
+        return urllib.addinfourl(fp, response.msg, url, response.status)
+
+
+class PooledTransport(xmlrpclib.Transport):
+    """An xmlrpclib transport using a ConnectionPool.
+
+    Unlike xmlrpclib's own transports it can be used from several threads
+    at once. Responses can be gzipped, and with gzip_requests so are the
+    larger requests.
+
+    How long the calls to each method take is kept in latency, as
+    method name -> [calls, total seconds, slowest seconds].
+    """
+
+    METHOD_NAME_RE = re.compile(r'<methodName>([^<]*)</methodName>')
+
+    # Requests smaller than this aren't worth gzipping.
+    GZIP_THRESHOLD = 1400
+
+    def __init__(self, pool, scheme='http', gzip_requests=False,
+                 scheduler=None, use_datetime=0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self.pool = pool
+        self.scheme = scheme
+        self.gzip_requests = gzip_requests
+        self.scheduler = scheduler or Scheduler('XML-RPC', idempotent=False)
+
+        self._lock = threading.Lock()
+        self.latency = {}
+
+    def request(self, host, handler, request_body, verbose=0):
+        match = self.METHOD_NAME_RE.search(request_body)
+        method_name = match.group(1) if match else '?'
+
+        headers = {
+            'Content-Type': 'text/xml',
+            'User-Agent': self.user_agent,
+            'Accept-Encoding': 'gzip',
+        }
+        if self.gzip_requests and len(request_body) > self.GZIP_THRESHOLD:
+            request_body = xmlrpclib.gzip_encode(request_body)
+            headers['Content-Encoding'] = 'gzip'
+
+        def post():
+            start = time.time()
+            response = self.pool.request(
+                'POST', '%s://%s%s' % (self.scheme, host, handler),
+                request_body, headers)
+            self._timed(method_name, time.time() - start)
+
+            if response.status != 200:
+                raise xmlrpclib.ProtocolError(
+                    host + handler, response.status, response.reason,
+                    response.msg)
+            return response
+
+        response = self.scheduler.call(host + handler, post)
+        data = response.data
+        if response.getheader('content-encoding', '') == 'gzip':
+            data = xmlrpclib.gzip_decode(data)
+
+        parser, unmarshaller = self.getparser()
+        parser.feed(data)
+        parser.close()
+        return unmarshaller.close()
+
+    def _timed(self, method_name, seconds):
+        with self._lock:
+            stats = self.latency.setdefault(method_name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+
 # Code to deal with Google+'s OAuth stuff
 ###############################################################################
 CLIENT_SECRETS = 'client_secrets.json'
@@ -92,9 +1000,61 @@ found at:
 with information from the APIs Console <https://code.google.com/apis/console>.
 
 """ % os.path.join(os.path.dirname(__file__), CLIENT_SECRETS)
-FLOW = flow_from_clientsecrets(CLIENT_SECRETS,
-                               scope='https://www.googleapis.com/auth/plus.me',
-                               message=MISSING_CLIENT_SECRETS_MESSAGE)
+FLOW = None
+
+
+def flow():
+    """The OAuth flow, which reads CLIENT_SECRETS the first time."""
+    global FLOW
+    if FLOW is None:
+        from oauth2client.client import flow_from_clientsecrets
+        FLOW = flow_from_clientsecrets(
+            CLIENT_SECRETS, scope='https://www.googleapis.com/auth/plus.me',
+            message=MISSING_CLIENT_SECRETS_MESSAGE)
+    return FLOW
+
+
+DISCOVERY_URI = (
+    'https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest')
+
+
+def discovery_document(http, api, version, filename=None, ttl=0):
+    """The discovery document for an API, as a string.
+
+    With a filename, the document is kept there and only fetched again once
+    it is ttl seconds old. If it can't be fetched then, the old one is used.
+    """
+    cached = None
+    if filename and os.path.exists(filename):
+        cached = open(filename).read()
+        if time.time() - os.path.getmtime(filename) < ttl:
+            return cached
+
+    url = DISCOVERY_URI.replace('{api}', api).replace('{apiVersion}', version)
+    try:
+        resp, content = http.request(url)
+        if resp.status >= 400:
+            raise HttpError(resp, content, uri=url)
+        json.loads(content)
+    except (IOError, ValueError, HttpError, httplib2.HttpLib2Error), e:
+        if cached is None:
+            raise
+        print "Unable to fetch %s (%s), using %s" % (url, e, filename)
+        return cached
+
+    if filename:
+        write_atomically(filename, content)
+    return content
+
+
+def build_service(http):
+    """The Google+ API service, built from the cached discovery document."""
+    from apiclient.discovery import build_from_document
+    return build_from_document(
+        discovery_document(
+            http, 'plus', 'v1', FLAGS.discovery_cache,
+            FLAGS.discovery_cache_ttl),
+        http=http)
 
 
 # Code to get more information about posted contents using oembed protocol
@@ -125,41 +1085,333 @@ class Embedly(oembed.OEmbedEndpoint):
 
         self.KEY = key
 
+    # The most urls Embedly will look up in one request.
+    MAX_URLS = 20
+
     def request(self, *args, **kw):
         url = oembed.OEmbedEndpoint.request(self, *args, **kw)
         return '%s&key=%s' % (url, self.KEY)
 
+    def request_many(self, urls, **opt):
+        # The urls are escaped, but the commas between them must not be.
+        return '%s?%s&urls=%s&key=%s' % (
+            self._urlApi, urllib.urlencode(opt),
+            ','.join(urllib.quote(url, safe='') for url in urls), self.KEY)
+
+    def get_many(self, urls, **opt):
+        """Look up many urls in one request.
+
+        Returns the data for each url, or False where Embedly had an error.
+        """
+        opener = self._urllib.build_opener()
+        opener.addheaders = self._requestHeaders.items()
+        response = opener.open(self.request_many(urls, **opt))
+        try:
+            raw = response.read()
+        finally:
+            response.close()
+
+        results = []
+        for data in json.loads(raw.decode('utf8')):
+            try:
+                if data.get('type') == 'error':
+                    raise oembed.OEmbedError(data.get('error_message'))
+                results.append(
+                    oembed.OEmbedResponse.createLoad(data).getData())
+            except oembed.OEmbedError, e:
+                print e
+                results.append(False)
+
+        if len(results) != len(urls):
+            raise ValueError(
+                'Embedly returned %d results for %d urls' % (
+                    len(results), len(urls)))
+        return results
+
 # Fallback to embed.ly
 OEMBED_CONSUMER.addEndpoint(Embedly(config.EMBEDLY_KEY))
 
 
-def embed_content(url):
-    """For some content we use oEmbed to get better information."""
+class EmbedCache(object):
+    """On disk cache of oEmbed lookups, keyed by endpoint and url.
+
+    Failed lookups are stored as None, and kept for a shorter time, so they
+    are not retried on every run.
+    """
+
+    def __init__(self, filename, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute("""
+CREATE TABLE IF NOT EXISTS embeds (
+    endpoint TEXT,
+    url TEXT,
+    data TEXT,
+    fetched REAL,
+    PRIMARY KEY (endpoint, url)
+)""")
+        self.db.commit()
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM embeds').fetchone()[0]
+
+    def get(self, endpoint, url):
+        """Returns (found, data), data is False for a failed lookup."""
+        with self.lock:
+            row = self.db.execute(
+                'SELECT data, fetched FROM embeds '
+                'WHERE endpoint = ? AND url = ?', (endpoint, url)).fetchone()
+
+        if row is not None:
+            data, fetched = row
+            ttl = [self.negative_ttl, self.ttl][data is not None]
+            if time.time() - fetched < ttl:
+                if data is None:
+                    self.negative_hits += 1
+                    return True, False
+                self.hits += 1
+                return True, json.loads(data)
+
+        self.misses += 1
+        return False, None
+
+    def put(self, endpoint, url, data):
+        if data is not False:
+            data = json.dumps(data)
+        else:
+            data = None
+
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO embeds (endpoint, url, data, fetched) '
+                'VALUES (?, ?, ?, ?)', (endpoint, url, data, time.time()))
+            self.db.commit()
+
+    def hit_ratio(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        if not lookups:
+            return 0.0
+        return float(self.hits + self.negative_hits) / lookups
+
+    def prune(self):
+        """Remove the expired entries, returns how many were removed."""
+        now = time.time()
+        with self.lock:
+            removed = self.db.execute(
+                'DELETE FROM embeds WHERE '
+                '(data IS NULL AND fetched < ?) OR '
+                '(data IS NOT NULL AND fetched < ?)',
+                (now - self.negative_ttl, now - self.ttl)).rowcount
+            self.db.commit()
+        return removed
+
+    def evict(self, url):
+        """Remove a url from the cache, returns how many were removed."""
+        with self.lock:
+            removed = self.db.execute(
+                'DELETE FROM embeds WHERE url = ?', (url,)).rowcount
+            self.db.commit()
+        return removed
+
+    def clear(self):
+        with self.lock:
+            removed = self.db.execute('DELETE FROM embeds').rowcount
+            self.db.commit()
+        return removed
+
+    def close(self):
+        self.db.close()
+
+
+EMBED_CACHE = None
+
+# oEmbed data already looked up for the post each thread is rendering, in
+# its embeds attribute. The lookups for other posts go on in other threads.
+PRELOADED = threading.local()
+
+
+def endpoint_name(url):
+    endpoint = OEMBED_CONSUMER._endpointFor(url)
+    return getattr(endpoint, '_urlApi', '')
+
+
+def embed_cached(url):
+    """Returns (found, data) for a url from the oEmbed cache."""
+    preloaded = getattr(PRELOADED, 'embeds', {})
+    if url in preloaded:
+        return True, preloaded[url]
+    if EMBED_CACHE is None:
+        return False, None
+    return EMBED_CACHE.get(endpoint_name(url), url)
+
+
+def embed_cache_put(url, data):
+    if EMBED_CACHE is not None:
+        EMBED_CACHE.put(endpoint_name(url), url, data)
+
+
+def fetch_embed(url):
+    """Look up a url on its oEmbed endpoint, skipping the cache."""
     try:
-        response = OEMBED_CONSUMER.embed(url)
+        with TIMINGS.time('embed', url):
+            response = EMBED_SCHEDULER.call(
+                endpoint_name(url), OEMBED_CONSUMER.embed, url)
         data = response.getData()
-
-        return data
     except IOError, e:
         print e
-        return False
+        # Only remember the failure if trying again won't help.
+        if isinstance(e, CircuitOpenError) or retry_info(e)[0]:
+            return False
+        data = False
+
+    embed_cache_put(url, data)
+    return data
+
+
+def embed_content(url):
+    """For some content we use oEmbed to get better information."""
+    found, data = embed_cached(url)
+    if found:
+        return data
+    return fetch_embed(url)
+
+
+EMBED_POOL = None
+ENDPOINT_SEMAPHORES = {}
+ENDPOINT_SEMAPHORES_LOCK = threading.Lock()
+
+
+def endpoint_semaphore(url):
+    """Semaphore limiting the concurrent lookups to the url's endpoint."""
+    endpoint = OEMBED_CONSUMER._endpointFor(url)
+    with ENDPOINT_SEMAPHORES_LOCK:
+        if endpoint not in ENDPOINT_SEMAPHORES:
+            ENDPOINT_SEMAPHORES[endpoint] = threading.BoundedSemaphore(
+                FLAGS.embed_endpoint_workers)
+        return ENDPOINT_SEMAPHORES[endpoint]
+
+
+def fetch_embeds(urls):
+    """Look up urls which all use the same endpoint.
+
+    Several urls are only sent together to Embedly, and if that request
+    fails they are looked up one at a time instead.
+    """
+    endpoint = OEMBED_CONSUMER._endpointFor(urls[0])
+    if len(urls) > 1 and isinstance(endpoint, Embedly):
+        try:
+            with endpoint_semaphore(urls[0]), TIMINGS.time('embed.batch'):
+                results = EMBED_SCHEDULER.call(
+                    endpoint_name(urls[0]), endpoint.get_many, urls)
+        except (IOError, ValueError), e:
+            print e
+        else:
+            for url, data in zip(urls, results):
+                embed_cache_put(url, data)
+            return results
+
+    results = []
+    for url in urls:
+        with endpoint_semaphore(url):
+            results.append(fetch_embed(url))
+    return results
+
+
+def embed_many(urls):
+    """Get the oEmbed information for many urls at once.
+
+    Urls for Embedly are looked up MAX_URLS at a time in one request, the
+    others each get their own request. The results are in the same order
+    as the urls.
+    """
+    global EMBED_POOL
+
+    results = [None] * len(urls)
+
+    batches = collections.defaultdict(list)
+    lookups = []
+    for i, url in enumerate(urls):
+        found, results[i] = embed_cached(url)
+        if found:
+            continue
+
+        endpoint = OEMBED_CONSUMER._endpointFor(url)
+        if isinstance(endpoint, Embedly):
+            batches[endpoint].append(i)
+        else:
+            lookups.append([i])
+
+    for endpoint, indexes in batches.iteritems():
+        for start in range(0, len(indexes), endpoint.MAX_URLS):
+            lookups.append(indexes[start:start + endpoint.MAX_URLS])
+
+    def lookup(indexes):
+        return fetch_embeds([urls[i] for i in indexes])
+
+    if FLAGS.embed_workers <= 1 or len(lookups) <= 1:
+        lookup_results = map(lookup, lookups)
+    else:
+        if EMBED_POOL is None:
+            EMBED_POOL = ThreadPool(FLAGS.embed_workers)
+        lookup_results = EMBED_POOL.map(lookup, lookups)
+
+    for indexes, datas in zip(lookups, lookup_results):
+        for i, data in zip(indexes, datas):
+            results[i] = data
+    return results
 
 
 # Code to render templates
 ###############################################################################
-from jinja2 import Environment, FileSystemLoader
-env = Environment(
-    loader=FileSystemLoader('templates'),
-    comment_start_string='{% comment %}',
-    comment_end_string='{% endcomment %}',
-)
+TEMPLATE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'templates')
+ENV = None
 
 
-def render_tmpl(filename, content):
-    if 'self' in content:
-        del content['self']
-    template = env.get_template(filename)
-    return template.render(**content)
+def environment():
+    """The jinja2 Environment for the templates, made the first time.
+
+    Each template is loaded once, and never checked for changes after that.
+    With a bytecode cache, loading it skips parsing and compiling too.
+    """
+    global ENV
+    if ENV is None:
+        from jinja2 import Environment, FileSystemLoader
+        from jinja2 import FileSystemBytecodeCache
+
+        bytecode_cache = None
+        if FLAGS.template_cache is None:
+            bytecode_cache = FileSystemBytecodeCache()
+        elif FLAGS.template_cache:
+            try:
+                os.makedirs(FLAGS.template_cache)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            bytecode_cache = FileSystemBytecodeCache(FLAGS.template_cache)
+
+        ENV = Environment(
+            loader=FileSystemLoader(TEMPLATE_DIR),
+            bytecode_cache=bytecode_cache,
+            auto_reload=False,
+            comment_start_string='{% comment %}',
+            comment_end_string='{% endcomment %}',
+        )
+    return ENV
+
+
+def render_tmpl(filename, context):
+    """Render one of the templates with the context dict."""
+    with TIMINGS.time('template'):
+        return environment().get_template(filename).render(context)
 
 
 # See https://github.com/maxcutler/python-wordpress-xmlrpc/pull/35
@@ -178,9 +1430,188 @@ class NewAnonymousComment(AnonymousMethod):
     method_args = ('post_id', 'comment')
 
 
+def new_comment(post_id, comment):
+    """The call to add a comment, in config.WORDPRESS_COMMENT_STYLE."""
+    if config.WORDPRESS_COMMENT_STYLE == 'anonymous':
+        return NewAnonymousComment(post_id, comment)
+    return comments.NewComment(post_id, comment)
+
+
+# Code to create a better title then G+ gives us
+###############################################################################
+
+class TitleExtractor(object):
+    """Finds the title of a post, and if it has more content than that.
+
+    The html2text converter and sentence tokenizer are kept for the whole
+    run, one of each per thread. Posts which are just text and line breaks
+    skip both of them.
+    """
+    SIMPLE_TAGS = frozenset(['a', 'b', 'i', 'em', 'strong', 'span'])
+    SIMPLE_ENTITIES = {'&amp;': '&', '&quot;': '"', '&#39;': "'"}
+
+    TAG_RE = re.compile(r'<(/?)([a-zA-Z0-9]+)[^<>]*>')
+    BR_RE = re.compile(r'<br\s*/?>', re.IGNORECASE)
+    OTHER_ENTITY_RE = re.compile(r'&(?!(amp|quot|#39);)')
+    WHITESPACE_RE = re.compile(r'\s+')
+    # Unicode whitespace which html2text doesn't collapse.
+    OTHER_SPACE_RE = re.compile(ur'(?u)[^\S \t\n\r\f\v]')
+    # Things html2text escapes as markdown, anywhere or at the start of a
+    # piece of text between tags and entities.
+    MARKDOWN_RE = re.compile(r'[\\`*_\[\]#<>|]')
+    MARKDOWN_START_RE = re.compile(
+        r'^\s*(([+-]|\d+\.)(?=\s)|-(?=-))', re.MULTILINE)
+    TEXT_SPLIT_RE = re.compile(r'(<[^<>]*>|&(?:amp|quot|#39);)')
+    # Titles with these before their end need the sentence tokenizer.
+    SENTENCE_END_RE = re.compile(r'[.?!]')
+    TITLE_END_RE = re.compile(r'(\.\.\.|[.?!])?[\'")]*$')
+
+    def __init__(self, fast=True):
+        self.fast = fast
+        self._local = threading.local()
+
+    def html2text(self):
+        h2t = getattr(self._local, 'html2text', None)
+        if h2t is None:
+            import html2text
+            h2t = html2text.HTML2Text()
+            h2t.ignore_links = True
+            h2t.ignore_images = True
+            h2t.ignore_emphasis = True
+            h2t.body_width = 0
+            self._local.html2text = h2t
+        return h2t
+
+    def tokenizer(self):
+        tokenizer = getattr(self._local, 'tokenizer', None)
+        if tokenizer is None:
+            import nltk
+            tokenizer = nltk.PunktSentenceTokenizer()
+            self._local.tokenizer = tokenizer
+        return tokenizer
+
+    def extract_simple(self, content):
+        """Like extract, without html2text or nltk.
+
+        Returns False if the content is too complicated to do this way.
+        """
+        lines = []
+        for line in self.BR_RE.split(content):
+            for closing, tag in self.TAG_RE.findall(line):
+                if tag.lower() not in self.SIMPLE_TAGS:
+                    return False
+
+            if self.OTHER_ENTITY_RE.search(line):
+                return False
+
+            if self.OTHER_SPACE_RE.search(line):
+                return False
+
+            # Like html2text, collapse the whitespace in each piece of text
+            # between the tags and entities, with any leading space becoming
+            # a single space before the next text.
+            pieces = []
+            space = False
+            for piece in self.TEXT_SPLIT_RE.split(line):
+                if piece.startswith('<'):
+                    continue
+                if self.MARKDOWN_START_RE.search(piece):
+                    return False
+
+                data = self.SIMPLE_ENTITIES.get(piece) or \
+                    self.WHITESPACE_RE.sub(' ', piece)
+                if data.startswith(' '):
+                    space = True
+                    data = data[1:]
+                if not data:
+                    continue
+
+                if space and pieces:
+                    pieces.append(' ')
+                space = False
+                pieces.append(data)
+
+            line = ''.join(pieces).strip()
+            if line:
+                lines.append(line)
+
+        if not lines:
+            return None
+
+        title = lines[0]
+        if self.MARKDOWN_RE.search(title):
+            return False
+        if self.SENTENCE_END_RE.search(self.TITLE_END_RE.sub('', title)):
+            return False
+
+        # If we just have a link, guess we don't have a title
+        if title.startswith('http://') or title.startswith('https://'):
+            title = None
+
+        return title, bool(lines[1:])
+
+    def extract(self, content):
+        """Returns (title, has_content) for the HTML content of a post.
+
+        Returns None when the post has no text at all.
+        """
+        if self.fast:
+            extracted = self.extract_simple(content)
+            if extracted is not False:
+                return extracted
+
+        # Convert content to text so we can:
+        #  * Determine if the page has content
+        #  * Create a better title
+        txtcontent = self.html2text().handle(content)
+        lines = [x for x in txtcontent.split('\n') if x.strip()]
+
+        if not lines:
+            return None
+
+        # Take the first sentence as the title
+        sentences = self.tokenizer().tokenize(lines[0])
+        title = sentences[0].strip()
+
+        # If we just have a link, guess we don't have a title
+        if title.startswith('http://') or title.startswith('https://'):
+            title = None
+
+        return title, bool(sentences[1:]) or bool(lines[1:])
+
+
+TITLE_EXTRACTOR = TitleExtractor()
+
+
 # Google Plus post types
 ###############################################################################
 
+class RenderedPost(collections.namedtuple(
+        'RenderedPost',
+        'gid type title content has_content published updated')):
+    """The parts of a rendered GooglePlusPost needed to publish it.
+
+    Unlike the post itself this is small and can be pickled, so it is what
+    comes back from the render worker processes.
+    """
+    __slots__ = ()
+
+    def toWordPressPost(self):
+        post = WordPressPost()
+
+        if self.title:
+            post.title = self.title
+
+        if self.content:
+            post.content = self.content
+
+        post.date = self.published
+        post.date_modified = self.updated
+
+        post.post_status = 'publish'
+        return post
+
+
 class GooglePlusPost(object):
     TYPE = None
 
@@ -236,32 +1667,13 @@ class GooglePlusPost(object):
         self.published = date_parse(self.gdata['published'])
         self.updated = date_parse(self.gdata['updated'])
 
-        # Convert content to HTML so we can:
-        #  * Determine if the page has content
-        #  * Create a better title
-        H2T = html2text.HTML2Text()
-        H2T.ignore_links = True
-        H2T.ignore_images = True
-        H2T.ignore_emphasis = True
-        H2T.body_width = 0
-        txtcontent = H2T.handle(self.gdata['object']['content'])
-        lines = [x for x in txtcontent.split('\n') if x.strip()]
-
-        if not lines:
+        with TIMINGS.time('title'):
+            extracted = TITLE_EXTRACTOR.extract(
+                self.gdata['object']['content'])
+        if extracted is None:
             self.has_content = False
-            self.title = None
         else:
-            # Take the first sentence as the title
-            tokenizer = nltk.PunktSentenceTokenizer()
-            sentences = tokenizer.tokenize(lines[0])
-            self.title = sentences[0].strip()
-
-            # If we just have a link, guess we don't have a title
-            if self.title.startswith('http://') \
-                    or self.title.startswith('https://'):
-                self.title = None
-
-            self.has_content = bool(sentences[1:]) or bool(lines[1:])
+            self.title, self.has_content = extracted
 
             # FIXME: Should we strip the title from the content?
             self.content = self.gdata['object']['content']
@@ -275,35 +1687,39 @@ class GooglePlusPost(object):
         coordinates = ",".join(self.gdata['geocode'].split())
         assert len(coordinates.split(',')) == 2
 
-        address = self.gdata.get('address', '')
-        placename = self.gdata.get('placeName', '')
-        return render_tmpl('geocode.html', locals())
-
-    def toWordPressPost(self):
-        post = WordPressPost()
-
-        if self.title:
-            post.title = self.title
+        return render_tmpl('geocode.html', {
+            'coordinates': coordinates,
+            'address': self.gdata.get('address', ''),
+            'placename': self.gdata.get('placeName', ''),
+        })
 
-        if self.content:
-            post.content = self.content
+    @staticmethod
+    def embed_urls(gdata):
+        """The urls render() will want oEmbed information for."""
+        return []
 
-        post.date = self.published
-        post.date_modified = self.updated
+    def rendered(self):
+        return RenderedPost(
+            self.gid, self.TYPE, self.title, self.content,
+            self.has_content, self.published, self.updated)
 
-        post.post_status = 'publish'
-        return post
+    def toWordPressPost(self):
+        return self.rendered().toWordPressPost()
 
 
 class GalleryPost(GooglePlusPost):
     TYPE = 'gallery'
 
+    @staticmethod
+    def embed_urls(gdata):
+        return [nobj['url'] for nobj in gdata['object']['attachments']]
+
     def render(self):
         obj = self.gdata['object']['attachments']
 
         tmpl_data = []
-        for nobj in obj:
-            embed_info = embed_content(nobj['url'])
+        embeds = embed_many([nobj['url'] for nobj in obj])
+        for nobj, embed_info in zip(obj, embeds):
             if embed_info:
                 embed_info['description'] = embed_info.get(
                     'description', embed_info['title'])
@@ -330,6 +1746,11 @@ GooglePlusPost.TYPE2CLASS['gallery'] = GalleryPost
 class WebPagePost(GooglePlusPost):
     TYPE = 'web page'
 
+    @staticmethod
+    def embed_urls(gdata):
+        return [bits['url'] for bits in gdata['object']['attachments']
+                if bits['objectType'] == 'article']
+
     def render(self):
         obj = self.gdata['object']['attachments']
 
@@ -348,7 +1769,7 @@ class WebPagePost(GooglePlusPost):
             pprint.pprint(edata)
 
         if edata:
-            if not self.title and edata['title']:
+            if not self.title and edata.get('title'):
                 self.title = edata['title']
 
             has_edata_html = 'html' in edata
@@ -360,7 +1781,15 @@ class WebPagePost(GooglePlusPost):
         has_images = len(images) > 2
         has_preview = has_edata_html or has_edata_image or has_images
 
-        self.content = render_tmpl('webpage.html', locals())
+        self.content = render_tmpl('webpage.html', {
+            'webpage': webpage,
+            'edata': edata,
+            'images': images,
+            'has_preview': has_preview,
+            'has_edata_html': has_edata_html,
+            'has_edata_image': has_edata_image,
+            'has_images': has_images,
+        })
 
 
 GooglePlusPost.TYPE2CLASS['web page'] = WebPagePost
@@ -369,6 +1798,16 @@ GooglePlusPost.TYPE2CLASS['web page'] = WebPagePost
 class PhotoPost(GooglePlusPost):
     TYPE = 'photo'
 
+    @staticmethod
+    def embed_urls(gdata):
+        obj = gdata['object']['attachments'][0]
+        try:
+            obj['image']['url']
+            obj['fullImage']['url']
+            return []
+        except KeyError:
+            return [obj['url']]
+
     def render(self):
         obj = self.gdata['object']['attachments'][0]
 
@@ -427,6 +1866,9 @@ class GooglePlusComment(object):
         self.author_id = gdata['actor']['id']
         self.author_url = gdata['actor']['url']
         self.author_image = gdata['actor']['image']['url']
+        self.published = None
+        if 'published' in gdata:
+            self.published = date_parse(gdata['published'])
 
     # TODO Comment author must fill out name and
     #      e-mail setting is currently unchecked
@@ -437,180 +1879,1775 @@ class GooglePlusComment(object):
         comment.content = self.content
         comment.author = self.author_name
         comment.author_url = self.author_url
+        if self.published:
+            comment.date_created = self.published
 
         return comment
 
+
+# Code to keep track of what is already on Wordpress
 ###############################################################################
 
+# hash_field_id is the id of the post's content hash custom field, when
+# it is known.
+SyncRecord = collections.namedtuple(
+    'SyncRecord', ['post_id', 'updated', 'content_hash', 'hash_field_id'])
+SyncRecord.__new__.__defaults__ = (None,)
 
-def main(argv):
-    # Let the gflags module process the command-line arguments
-    try:
-        argv = FLAGS(argv)
-    except gflags.FlagsError, e:
-        print '%s\\nUsage: %s ARGS\\n%s' % (e, argv[0], FLAGS)
-        sys.exit(1)
 
-    # If the Credentials don't exist or are invalid run through the native
-    # client flow. The Storage object will ensure that if successful the good
-    # Credentials will get written back to a file.
-    storage = Storage('plus.dat')
-    credentials = storage.get()
+def content_hash(title, content):
+    """Fingerprint the rendered title and content of a post."""
+    digest = hashlib.sha1()
+    for bit in (title, content):
+        if isinstance(bit, unicode):
+            bit = bit.encode('utf-8')
+        digest.update(bit or '')
+        digest.update('\0')
+    return digest.hexdigest()
+
 
-    if credentials is None or credentials.invalid:
-        credentials = run(FLOW, storage)
+class WordPressPostIndex(object):
+    """Lookup of existing Wordpress posts by their Google+ activity id.
 
-    # Create an httplib2.Http object to handle our HTTP requests and authorize
-    # it with our good Credentials.
-    http = httplib2.Http()
-    http = credentials.authorize(http)
+    Built once from the Wordpress post listing (or the sync state), and then
+    kept up to date as posts are published so later activities in the same
+    run see them.
+    """
+    KEY = 'google_plus_activity_id'
+    HASH_KEY = 'google_plus_content_hash'
 
-    service = build("plus", "v1", http=http)
+    def __init__(self, wp_posts=()):
+        self._records = {}
 
-    if not FLAGS.dryrun:
-        wp = Client(
-            config.WORDPRESS_XMLRPC_URI,
-            config.WORDPRESS_USERNAME,
-            config.WORDPRESS_PASSWORD
-        )
+        self.hits = 0
+        self.misses = 0
 
-    try:
-        person = service.people().get(userId=FLAGS.user_id).execute(http)
+        for wp_post in wp_posts:
+            self.add_wordpress_post(wp_post)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __contains__(self, activity_id):
+        return activity_id in self._records
+
+    def iteritems(self):
+        return self._records.iteritems()
+
+    def add_wordpress_post(self, wp_post):
+        """Index a post from Wordpress using its custom fields.
+
+        Posts published before content hashes were stored get a hash of
+        None, so they are updated (and get a hash) on the next sync.
+        """
+        fields = dict(
+            (field['key'], field)
+            for field in getattr(wp_post, 'custom_fields', []))
+        if self.KEY in fields:
+            hash_field = fields.get(self.HASH_KEY, {})
+            self._records[fields[self.KEY]['value']] = SyncRecord(
+                wp_post.id, None, hash_field.get('value'),
+                hash_field.get('id'))
+
+    def add(self, activity_id, record):
+        self._records[activity_id] = record
+
+    def get(self, activity_id):
+        """Find the SyncRecord for an activity, or False."""
+        record = self._records.get(activity_id, False)
+        if record:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return record
+
+    def peek(self, activity_id):
+        """get() without counting it as a lookup."""
+        return self._records.get(activity_id, False)
+
+
+def crawl_wordpress(wp, index, n=100):
+    """Add every post on the Wordpress blog to the index.
+
+    Only the custom fields are requested, never the post bodies.
+    """
+    i = 0
+    while True:
+        more_posts = wp.call(posts.GetPosts(
+            {"number": n, 'offset': i}, ['post_id', 'custom_fields']))
+        if FLAGS.verbose:
+            print "Found ", i, n, more_posts
+
+        i = n + i
+        for wp_post in more_posts:
+            index.add_wordpress_post(wp_post)
+
+        if len(more_posts) == 0:
+            break
+    return index
 
-        post_request = service.activities().list(
-            userId=person['id'], collection='public')
 
-        i = 0
-        n = 100
-        existing_posts = more_posts = []
-        while True and not FLAGS.dryrun:
-            more_posts = wp.call(posts.GetPosts({"number": n, 'offset': i}))
+def content_hash_field(wp, record, value):
+    """Custom field which updates the content hash of an existing post.
+
+    Wordpress only replaces a custom field when given its id, otherwise a
+    second value is added. The id comes from the post's SyncRecord, and is
+    only looked up for posts with a hash but no id, such as those created
+    since the blog was last crawled.
+    """
+    field = {"key": WordPressPostIndex.HASH_KEY, "value": value}
+    field_id = record.hash_field_id
+    if field_id is None and record.content_hash is not None:
+        wp_post = wp.call(posts.GetPost(record.post_id, ['custom_fields']))
+        for existing in getattr(wp_post, 'custom_fields', []):
+            if existing['key'] == field['key']:
+                field_id = existing['id']
+    if field_id is not None:
+        field['id'] = field_id
+    return field
+
+
+class SyncState(object):
+    """On disk record of which activities have been synced to Wordpress.
+
+    Stores a SyncRecord for each activity so a run can load its
+    WordPressPostIndex from here instead of crawling the whole blog.
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute("""
+CREATE TABLE IF NOT EXISTS activities (
+    activity_id TEXT PRIMARY KEY,
+    post_id TEXT NOT NULL,
+    updated TEXT,
+    content_hash TEXT,
+    hash_field_id TEXT
+)""")
+        columns = [row[1] for row in self.db.execute(
+            'PRAGMA table_info(activities)')]
+        if 'hash_field_id' not in columns:
+            self.db.execute(
+                'ALTER TABLE activities ADD COLUMN hash_field_id TEXT')
+        self.db.execute("""
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+)""")
+        self.db.execute("""
+CREATE TABLE IF NOT EXISTS comments (
+    comment_id TEXT PRIMARY KEY,
+    activity_id TEXT NOT NULL,
+    wp_comment_id TEXT
+)""")
+        self.db.execute("""
+CREATE INDEX IF NOT EXISTS comments_activity_id ON comments (activity_id)""")
+        self.db.commit()
+
+    def watermark(self):
+        """The newest activity time seen by the last complete run."""
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'watermark'").fetchone()
+        if row is None:
+            return None
+        return date_parse(row[0])
+
+    def set_watermark(self, when):
+        self.db.execute(
+            "INSERT OR REPLACE INTO meta (key, value) "
+            "VALUES ('watermark', ?)", (when.isoformat(),))
+        self.db.commit()
+
+    def count(self):
+        """How many activities have been synced."""
+        return self.db.execute(
+            'SELECT COUNT(*) FROM activities').fetchone()[0]
+
+    def get(self, activity_id):
+        row = self.db.execute(
+            'SELECT post_id, updated, content_hash, hash_field_id '
+            'FROM activities WHERE activity_id = ?',
+            (activity_id,)).fetchone()
+        if row is None:
+            return False
+        return SyncRecord(*row)
+
+    def record(self, activity_id, record):
+        """Remember the Wordpress post an activity was synced to."""
+        self.db.execute(
+            'INSERT OR REPLACE INTO activities '
+            '(activity_id, post_id, updated, content_hash, hash_field_id) '
+            'VALUES (?, ?, ?, ?, ?)', (activity_id,) + tuple(record))
+        self.db.commit()
+
+    def load(self, index):
+        """Add every synced activity to the index."""
+        for row in self.db.execute(
+                'SELECT activity_id, post_id, updated, content_hash, '
+                'hash_field_id FROM activities'):
+            index.add(row[0], SyncRecord(*row[1:]))
+        return index
+
+    def synced_comments(self, activity_id):
+        """The ids of the comments on an activity which have been synced."""
+        return set(row[0] for row in self.db.execute(
+            'SELECT comment_id FROM comments WHERE activity_id = ?',
+            (activity_id,)))
+
+    def record_comment(self, activity_id, comment_id, wp_comment_id):
+        """Remember the Wordpress comment a comment was synced to."""
+        self.db.execute(
+            'INSERT OR REPLACE INTO comments '
+            '(comment_id, activity_id, wp_comment_id) VALUES (?, ?, ?)',
+            (comment_id, activity_id, wp_comment_id))
+        self.db.commit()
+
+    def rebuild(self, index):
+        """Replace the stored state with the contents of the index.
+
+        The synced comments are kept, as Wordpress doesn't know them.
+        """
+        self.db.execute('DELETE FROM activities')
+        self.db.executemany(
+            'INSERT INTO activities '
+            '(activity_id, post_id, updated, content_hash, hash_field_id) '
+            'VALUES (?, ?, ?, ?, ?)',
+            ((activity_id,) + tuple(record)
+             for activity_id, record in index.iteritems()))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+# Code to send things to Wordpress
+###############################################################################
+
+class WordPressPublisher(object):
+    """Sends Wordpress calls in system.multicall batches.
+
+    Calls are queued with a callback which is given the call's result once
+    the batch holding it has been sent. If a batch is refused, its calls are
+    sent again one at a time. Any other failure is raised, as the server may
+    have already made the calls.
+    """
+
+    def __init__(self, wp, batch_size=20):
+        self.wp = wp
+        self.batch_size = batch_size
+        if 'system.multicall' not in wp.supported_methods:
+            self.batch_size = 1
+
+        self._pending = []
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.round_trips = 0
+
+    def call(self, method, callback=None):
+        self._pending.append((method, callback))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Send all the queued calls."""
+        pending, self._pending = self._pending, []
+        if pending:
+            self._done(pending, self._send(pending))
+
+    def _send(self, pending):
+        """Send a batch, returns the results of its calls."""
+        if len(pending) == 1:
+            results = [None]
+        else:
+            results = self._multicall(pending)
+
+        for i, (method, _) in enumerate(pending):
+            if results[i] is None:
+                results[i] = self._call(method)
+        return results
+
+    def _done(self, pending, results):
+        for (_, callback), result in zip(pending, results):
+            if callback:
+                callback(result)
+
+    def _count(self, calls, round_trips):
+        with self._lock:
+            self.calls += calls
+            self.round_trips += round_trips
+
+    def _call(self, method):
+        self._count(1, 1)
+        with TIMINGS.time('wordpress.' + method.method_name):
+            return self.wp.call(method)
+
+    def _multicall(self, pending):
+        """Send a batch, None marks the calls which need to be resent."""
+        multicall = xmlrpclib.MultiCall(self.wp.server)
+        for method, _ in pending:
+            getattr(multicall, method.method_name)(
+                *method.get_args(self.wp))
+
+        self._count(0, 1)
+        try:
+            with TIMINGS.time('wordpress.system.multicall'):
+                raw_results = multicall()
+        except (xmlrpclib.Fault, socket.error), e:
+            # Only resend the calls if none of them can have been made:
+            # system.multicall itself faulted, or the connection was refused.
+            if (isinstance(e, socket.error) and
+                    e.errno != errno.ECONNREFUSED):
+                raise
             if FLAGS.verbose:
-                print "Found ", i, n, more_posts
+                print "Batch of %d calls failed (%s), resending" % (
+                    len(pending), e)
+            return [None] * len(pending)
+
+        results = []
+        for i, (method, _) in enumerate(pending):
+            try:
+                results.append(method.process_result(raw_results[i]))
+                self._count(1, 0)
+            except xmlrpclib.Fault, e:
+                if FLAGS.verbose:
+                    print "Call to %s failed in batch (%s), resending" % (
+                        method.method_name, e)
+                results.append(None)
+        return results
+
+
+class ConcurrentPublisher(WordPressPublisher):
+    """A WordPressPublisher which sends several batches at once.
+
+    The Wordpress client must be safe to use from several threads, such as
+    one using a PooledTransport. The callbacks are still all called from
+    the thread using the publisher, in the order the calls were made.
+    """
+
+    def __init__(self, wp, batch_size=20, connections=4):
+        WordPressPublisher.__init__(self, wp, batch_size)
+        self.connections = connections
+        self.pool = ThreadPool(connections)
+        self._sending = collections.deque()
+
+    def call(self, method, callback=None):
+        self._pending.append((method, callback))
+        if len(self._pending) >= self.batch_size:
+            self._submit()
+
+        # Pass on the results which have already come back.
+        while self._sending and self._sending[0][1].ready():
+            self._wait()
+
+    def flush(self):
+        """Send all the queued calls, and wait for them all to finish."""
+        self._submit()
+        while self._sending:
+            self._wait()
+
+    def _submit(self):
+        pending, self._pending = self._pending, []
+        if pending:
+            self._sending.append(
+                (pending, self.pool.apply_async(self._send, (pending,))))
+        while len(self._sending) > self.connections:
+            self._wait()
+
+    def _wait(self):
+        pending, result = self._sending.popleft()
+        self._done(pending, result.get())
+
+
+WXR_HEADER = u"""<?xml version="1.0" encoding="UTF-8" ?>
+<rss version="2.0"
+    xmlns:excerpt="http://wordpress.org/export/1.2/excerpt/"
+    xmlns:content="http://purl.org/rss/1.0/modules/content/"
+    xmlns:wfw="http://wellformedweb.org/CommentAPI/"
+    xmlns:dc="http://purl.org/dc/elements/1.1/"
+    xmlns:wp="http://wordpress.org/export/1.2/">
+<channel>
+<title>%(title)s</title>
+<link>%(site_url)s</link>
+<description></description>
+<wp:wxr_version>1.2</wp:wxr_version>
+<wp:base_site_url>%(site_url)s</wp:base_site_url>
+<wp:base_blog_url>%(site_url)s</wp:base_blog_url>
+<wp:author>
+    <wp:author_login>%(author)s</wp:author_login>
+    <wp:author_display_name>%(author)s</wp:author_display_name>
+</wp:author>
+"""
+
+WXR_FOOTER = u"""</channel>
+</rss>
+"""
+
+WXR_ITEM = u"""<item>
+    <title>%(title)s</title>
+    <pubDate>%(pub_date)s</pubDate>
+    <dc:creator>%(author)s</dc:creator>
+    <description></description>
+    <content:encoded>%(content)s</content:encoded>
+    <excerpt:encoded></excerpt:encoded>
+    <wp:post_id>%(post_id)s</wp:post_id>
+    <wp:post_date>%(date)s</wp:post_date>
+    <wp:post_date_gmt>%(date_gmt)s</wp:post_date_gmt>
+    <wp:comment_status>open</wp:comment_status>
+    <wp:ping_status>open</wp:ping_status>
+    <wp:status>%(status)s</wp:status>
+    <wp:post_parent>0</wp:post_parent>
+    <wp:menu_order>0</wp:menu_order>
+    <wp:post_type>post</wp:post_type>
+    <wp:is_sticky>0</wp:is_sticky>
+%(postmeta)s%(comments)s</item>
+"""
+
+WXR_POSTMETA = u"""    <wp:postmeta>
+        <wp:meta_key>%(key)s</wp:meta_key>
+        <wp:meta_value>%(value)s</wp:meta_value>
+    </wp:postmeta>
+"""
+
+WXR_COMMENT = u"""    <wp:comment>
+        <wp:comment_id>%(comment_id)s</wp:comment_id>
+        <wp:comment_author>%(author)s</wp:comment_author>
+        <wp:comment_author_url>%(author_url)s</wp:comment_author_url>
+        <wp:comment_date>%(date)s</wp:comment_date>
+        <wp:comment_date_gmt>%(date_gmt)s</wp:comment_date_gmt>
+        <wp:comment_content>%(content)s</wp:comment_content>
+        <wp:comment_approved>1</wp:comment_approved>
+        <wp:comment_parent>0</wp:comment_parent>
+    </wp:comment>
+"""
 
-            i = n + i
-            existing_posts += more_posts
+# Characters which can't be in XML at all.
+XML_INVALID_RE = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
 
-            if len(more_posts) == 0:
+
+def wxr_cdata(text):
+    text = XML_INVALID_RE.sub(u'', unicode(text or u''))
+    return u'<![CDATA[%s]]>' % text.replace(u']]>', u']]]]><![CDATA[>')
+
+
+def wxr_text(text):
+    return xml_escape(XML_INVALID_RE.sub(u'', unicode(text or u'')))
+
+
+def wxr_date(date, format='%Y-%m-%d %H:%M:%S', timezone=None):
+    """A date for WXR, in UTC unless another timezone is given."""
+    if date is None:
+        return u''
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone or tzutc())
+    return unicode(date.strftime(format))
+
+
+class WXRPublisher(object):
+    """Writes posts and their comments to WXR files for Wordpress's importer.
+
+    It takes the same calls as a WordPressPublisher, but only NewPost and
+    NewComment, and the comments have to follow their post. The posts are
+    numbered as they are written. Each post is written out when the next
+    one starts, so only one post and its comments are held in memory. With
+    max_bytes, a new file is started whenever the next post would take the
+    current one over it.
+
+    The importer takes the local dates as being in the blog's timezone.
+    Without that timezone, the posts' local dates are left for the importer
+    to work out from the UTC ones.
+    """
+
+    wp = None
+
+    def __init__(self, filename, max_bytes=0, site_url='', author='',
+                 title='Google+', timezone=None):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.timezone = timezone
+        self.header = WXR_HEADER % {
+            'title': wxr_text(title),
+            'site_url': wxr_text(site_url),
+            'author': wxr_cdata(author),
+        }
+        self.author = author
+
+        self.filenames = []
+        self._file = None
+        self._size = 0
+
+        # (post id, WordPressPost, [(comment id, WordPressComment), ...])
+        self._post = None
+        self._post_ids = 0
+        self._comment_ids = 0
+
+        self.calls = 0
+        self.round_trips = 0
+
+    def call(self, method, callback=None):
+        if isinstance(method, posts.NewPost):
+            self.flush()
+            self._post_ids += 1
+            result = str(self._post_ids)
+            self._post = (result, method.content, [])
+        elif method.method_name == 'wp.newComment':
+            if self._post is None or self._post[0] != method.post_id:
+                raise ValueError(
+                    'A comment on post %s has to follow the post' % (
+                        method.post_id,))
+            self._comment_ids += 1
+            result = self._comment_ids
+            self._post[2].append((result, method.comment))
+        else:
+            raise ValueError(
+                "%s can't be written to WXR" % method.method_name)
+
+        self.calls += 1
+        if callback:
+            callback(result)
+
+    def render(self, post_id, post, post_comments):
+        """The WXR item for a post, as unicode."""
+        postmeta = u''.join(
+            WXR_POSTMETA % {
+                'key': wxr_text(field['key']),
+                'value': wxr_cdata(field['value']),
+            } for field in getattr(post, 'custom_fields', []))
+        comments_xml = u''.join(
+            WXR_COMMENT % {
+                'comment_id': comment_id,
+                'author': wxr_cdata(getattr(comment, 'author', '')),
+                'author_url': wxr_text(getattr(comment, 'author_url', '')),
+                'date': wxr_date(
+                    getattr(comment, 'date_created', None),
+                    timezone=self.timezone),
+                'date_gmt': wxr_date(getattr(comment, 'date_created', None)),
+                'content': wxr_cdata(comment.content),
+            } for comment_id, comment in post_comments)
+        date = getattr(post, 'date', None)
+        local_date = u''
+        if self.timezone is not None:
+            local_date = wxr_date(date, timezone=self.timezone)
+
+        return WXR_ITEM % {
+            'title': wxr_text(getattr(post, 'title', '')),
+            'pub_date': wxr_date(date, '%a, %d %b %Y %H:%M:%S +0000'),
+            'author': wxr_cdata(self.author),
+            'content': wxr_cdata(getattr(post, 'content', '')),
+            'post_id': post_id,
+            'date': local_date,
+            'date_gmt': wxr_date(date),
+            'status': wxr_text(getattr(post, 'post_status', 'publish')),
+            'postmeta': postmeta,
+            'comments': comments_xml,
+        }
+
+    def _open(self):
+        if self.max_bytes:
+            base, ext = os.path.splitext(self.filename)
+            filename = '%s-%03d%s' % (base, len(self.filenames) + 1, ext)
+        else:
+            filename = self.filename
+        self.filenames.append(filename)
+        self._file = open(filename, 'wb')
+        header = self.header.encode('utf-8')
+        self._file.write(header)
+        self._size = len(header)
+
+    def _close(self):
+        self._file.write(WXR_FOOTER.encode('utf-8'))
+        self._file.close()
+        self._file = None
+
+    def flush(self):
+        """Write out the post being held, and its comments."""
+        if self._post is None:
+            return
+        item = self.render(*self._post).encode('utf-8')
+        self._post = None
+
+        if self._file is not None and self.max_bytes and (
+                self._size + len(item) + len(WXR_FOOTER) > self.max_bytes):
+            self._close()
+        if self._file is None:
+            self._open()
+        self._file.write(item)
+        self._size += len(item)
+
+    def close(self):
+        """Write out the last post and finish the file."""
+        self.flush()
+        if not self.filenames:
+            self._open()
+        if self._file is not None:
+            self._close()
+
+
+# Code to read Google+ posts from a Google Takeout archive
+###############################################################################
+
+JSON_WHITESPACE_RE = re.compile(r'[ \t\n\r]*')
+# What can follow a number which has been read in full.
+JSON_NUMBER_END_RE = re.compile(r'[ \t\n\r,\]}]')
+
+
+def iter_json(file_, chunk_size=64 * 1024):
+    """Yields the values in a JSON file, reading it a chunk at a time.
+
+    A file holding an array yields each of its elements in turn, anything
+    else yields the one value. Only one element is held in memory at a time,
+    however big the array is.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    def read():
+        chunk = file_.read(chunk_size)
+        return utf8.decode(chunk, not chunk), not chunk
+
+    buf, pos, eof = u'', 0, False
+    # start -> [first -> value -> sep -> value ...] -> end
+    state = 'start'
+    while True:
+        pos = JSON_WHITESPACE_RE.match(buf, pos).end()
+        if pos == len(buf):
+            if eof:
                 break
+            text, eof = read()
+            buf, pos = text, 0
+            continue
+
+        char = buf[pos]
+        if state == 'start' and char == '[':
+            state = 'first'
+            pos += 1
+        elif (state == 'first' or state == 'sep') and char == ']':
+            state = 'end'
+            pos += 1
+        elif state == 'sep' and char == ',':
+            state = 'value'
+            pos += 1
+        elif state in ('start', 'first', 'value'):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+                end = None
+            # A number at the end of the buffer may go on in the next chunk,
+            # even when it ends in a '.' or 'e' which raw_decode leaves off.
+            if end is None or (not eof and (
+                    end == len(buf) or
+                    isinstance(value, (int, long, float)) and
+                    not JSON_NUMBER_END_RE.match(buf, end))):
+                text, eof = read()
+                buf, pos = buf[pos:] + text, 0
+                continue
+            yield value
+            pos = end
+            state = ['sep', 'end'][state == 'start']
+        else:
+            raise ValueError('Unexpected %r in JSON' % char)
+
+    if state != 'end':
+        raise ValueError('JSON ended too soon')
+
+
+def takeout_files(path):
+    """Yields (name, file) for each JSON file of posts in a Takeout archive.
+
+    These are the files in directories called Posts, as in "Google+
+    Stream/Posts", or if there are none, every JSON file. path can also be a
+    single JSON file.
+    """
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        names = [name for name in archive.namelist()
+                 if name.lower().endswith('.json')]
+        opener = archive.open
+    elif os.path.isdir(path):
+        names = []
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories.sort()
+            names.extend(os.path.join(directory, filename)
+                         for filename in sorted(filenames)
+                         if filename.lower().endswith('.json'))
+        opener = functools.partial(open, mode='rb')
+        archive = None
+    else:
+        names = [path]
+        opener = functools.partial(open, mode='rb')
+        archive = None
+
+    posts = [name for name in names
+             if 'Posts' in re.split(r'[/\\]', name)[:-1]]
+    try:
+        for name in posts or names:
+            file_ = opener(name)
+            try:
+                yield name, file_
+            finally:
+                file_.close()
+    finally:
+        if archive is not None:
+            archive.close()
+
+
+def takeout_time(value):
+    """A Takeout time, such as "2012-08-24 16:09:35+0000", as RFC 3339."""
+    parsed = date_parse(value)
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(tzutc())
+    return parsed.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def takeout_id(post):
+    return (post.get('resourceName') or post.get('url', '')).rpartition(
+        '/')[2]
+
+
+def takeout_person(author):
+    return {
+        'id': takeout_id(author),
+        'displayName': author.get('displayName', ''),
+        'url': author.get('profilePageUrl', ''),
+        'image': {'url': author.get('avatarImageUrl', '')},
+    }
+
+
+def takeout_media(media):
+    url = media.get('url', '')
+    attachment = {
+        'objectType': 'photo',
+        'url': url,
+        'image': {'url': url},
+    }
+    if media.get('contentType', '').startswith('video/'):
+        attachment['objectType'] = 'video'
+    else:
+        attachment['fullImage'] = {
+            'url': url, 'content': media.get('description', '')}
+    return attachment
+
+
+def takeout_comment(comment):
+    """A comment in a Takeout archive, as a comments().list item."""
+    published = takeout_time(comment['creationTime'])
+    return {
+        'kind': 'plus#comment',
+        'id': takeout_id(comment),
+        'published': published,
+        'updated': published,
+        'actor': takeout_person(comment.get('author', {})),
+        'object': {
+            'objectType': 'comment',
+            'content': comment.get('content', ''),
+        },
+    }
+
+
+def takeout_object(post):
+    attachments = []
+    link = post.get('link')
+    if link and link.get('url'):
+        article = {
+            'objectType': 'article',
+            'url': link['url'],
+            'displayName': link.get('title', ''),
+        }
+        if link.get('imageUrl'):
+            article['image'] = {'url': link['imageUrl']}
+        attachments.append(article)
+    if post.get('media'):
+        attachments.append(takeout_media(post['media']))
+    for media in post.get('album', {}).get('media', []):
+        attachments.append(takeout_media(media))
+
+    return {
+        'objectType': 'note',
+        'content': post.get('content', ''),
+        'url': post.get('url', ''),
+        'attachments': attachments,
+        'replies': {
+            'totalItems': len(post.get('comments', [])),
+            # Not in the API, which needs comments().list for these.
+            'items': [takeout_comment(comment)
+                      for comment in post.get('comments', [])],
+        },
+    }
+
+
+def takeout_activity(post):
+    """A post from a Takeout archive, as an activities().list item."""
+    if 'object' in post:
+        # Already an activity, such as from a saved activities().list.
+        return post
+
+    activity = {
+        'kind': 'plus#activity',
+        'id': takeout_id(post),
+        'url': post.get('url', ''),
+        'published': takeout_time(post['creationTime']),
+        'updated': takeout_time(
+            post.get('updateTime') or post['creationTime']),
+        'actor': takeout_person(post.get('author', {})),
+        'verb': 'post',
+        'object': takeout_object(post),
+    }
+
+    reshared = post.get('resharedPost')
+    if reshared:
+        activity['verb'] = 'share'
+        activity['annotation'] = post.get('content', '')
+        activity['object'] = takeout_object(reshared)
+        activity['object'].update({
+            'objectType': 'activity',
+            'id': takeout_id(reshared) or activity['id'],
+            'actor': takeout_person(reshared.get('author', {})),
+        })
+    return activity
+
+
+def takeout_activities(path):
+    """Yields the posts in a Takeout archive as activities().list items.
+
+    The archive is read one post at a time, so it can be any size.
+    """
+    for name, file_ in takeout_files(path):
+        for post in iter_json(file_):
+            if isinstance(post, dict) and (
+                    'creationTime' in post or 'object' in post):
+                yield takeout_activity(post)
+            elif FLAGS.verbose:
+                print "Skipping %s, it isn't a Google+ post" % name
+
+
+# Code to sync Google+ comments to Wordpress
+###############################################################################
+
+def new_batch(service):
+    """A batch HTTP request for calls to the service."""
+    if hasattr(service, 'new_batch_http_request'):
+        return service.new_batch_http_request()
+    from apiclient.http import BatchHttpRequest
+    return BatchHttpRequest()
+
+
+class CommentSync(object):
+    """Publishes the comments on activities which haven't been synced yet.
+
+    Activities which carry their comments, such as those from Takeout, have
+    them published straight away, unless carried is False. For the rest,
+    given the Google+ service,
+    the comments of batch_size activities at a time are fetched in one
+    batch request, page by page. Only activities with more comments than
+    have been synced are fetched at all, newest first and only until a
+    comment which has already been synced.
+
+    With a SyncState each comment synced is remembered, so it is only ever
+    published once. Without one only the comments on new posts are synced,
+    as there is no telling which of the others are already on Wordpress.
+
+    A WXRPublisher needs each post's comments straight after it, so their
+    comments are fetched one activity at a time.
+
+    The batches are sent with http, when given, as the service's own
+    httplib2.Http is busy paging through the activities in another thread.
+    """
+
+    def __init__(self, publisher, state=None, service=None, batch_size=50,
+                 http=None, carried=True):
+        self.publisher = publisher
+        self.state = state
+        self.service = service
+        self.batch_size = batch_size
+        self.http = http
+        self.carried = carried
+        if isinstance(publisher, WXRPublisher):
+            self.batch_size = 1
+
+        # (activity id, post id, ids of the comments already synced)
+        self._pending = []
+
+        self.fetched = 0
+        self.published = 0
+
+    def add(self, item, post_id, new_post=False):
+        """Sync the comments on an activity, which is post_id on Wordpress."""
+        if new_post:
+            synced = set()
+        elif self.state is not None:
+            synced = self.state.synced_comments(item['id'])
+        else:
+            return
+
+        replies = item['object'].get('replies', {})
+        if 'items' in replies:
+            if not self.carried:
+                return
+            self.publish(item['id'], post_id, replies['items'], synced)
+        elif (self.service is not None and
+                replies.get('totalItems', 0) > len(synced) and
+                item['id'] not in [p[0] for p in self._pending]):
+            self._pending.append((item['id'], post_id, synced))
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        """Fetch and publish the comments of the activities added so far."""
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        fetched = self.fetch(dict(
+            (activity_id, synced) for activity_id, _, synced in pending))
+        for activity_id, post_id, synced in pending:
+            if activity_id in fetched:
+                self.publish(
+                    activity_id, post_id, fetched[activity_id], synced)
+
+    def fetch(self, synced):
+        """The comments on each activity, oldest first, by activity id.
+
+        synced has the ids of the comments already synced for each
+        activity. Activities whose comments can't be fetched are left out,
+        so they are tried again by the next run.
+        """
+        fetched = dict((activity_id, []) for activity_id in synced)
+        requests = dict(
+            (activity_id, self.service.comments().list(
+                activityId=activity_id, maxResults=500,
+                sortOrder='descending'))
+            for activity_id in synced)
+
+        while requests:
+            next_requests = {}
+
+            def callback(activity_id, response, exception):
+                if exception is not None:
+                    print "Unable to fetch the comments on %s: %s" % (
+                        activity_id, exception)
+                    fetched.pop(activity_id, None)
+                    return
+
+                items = response.get('items', [])
+                fetched[activity_id].extend(items)
+                if synced[activity_id].intersection(c['id'] for c in items):
+                    return  # The rest have been synced before.
+
+                next_request = self.service.comments().list_next(
+                    requests[activity_id], response)
+                if next_request is not None:
+                    next_requests[activity_id] = next_request
+
+            batch = new_batch(self.service)
+            for activity_id, request in requests.iteritems():
+                batch.add(request, callback=callback, request_id=activity_id)
+            with TIMINGS.time('plus.comments'):
+                PLUS_SCHEDULER.call(
+                    'comments', batch.execute, http=self.http)
+            self.fetched += len(requests)
+
+            requests = next_requests
+
+        for item_comments in fetched.itervalues():
+            item_comments.reverse()
+        return fetched
+
+    def publish(self, activity_id, post_id, item_comments, synced):
+        for comment in item_comments:
+            if comment['id'] in synced:
+                continue
+            if FLAGS.verbose:
+                print "Publishing new comment to", post_id
+            self.publisher.call(
+                new_comment(
+                    post_id, GooglePlusComment(comment).toWordPressComment()),
+                functools.partial(self.synced, activity_id, comment['id']))
+            self.published += 1
+
+    def synced(self, activity_id, comment_id, result):
+        if self.state is not None:
+            self.state.record_comment(activity_id, comment_id, result)
+
+
+# Code to sync Google+ activities to Wordpress
+###############################################################################
+
+def bounded(iterable, maxsize):
+    """Run an iterable in its own thread, holding at most maxsize results.
+
+    Exceptions from the iterable are raised again for the consumer.
+    """
+    results = Queue.Queue(maxsize)
+    closed = threading.Event()
+    done = object()
+
+    def put(result):
+        while not closed.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for result in iterable:
+                if not put((result, None)):
+                    return
+        except Exception:
+            put((None, sys.exc_info()))
+        else:
+            put((done, None))
+
+    thread = threading.Thread(target=PROFILER.wrap(produce))
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            result, exc_info = results.get()
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+            if result is done:
+                return
+            yield result
+    finally:
+        closed.set()
+
+
+def ordered(pool, func, iterable, window):
+    """Like pool.imap, but yields (arg, result) and queues at most window.
+
+    pool.imap reads all of the iterable straight away, this only reads as
+    far as the results which have been taken.
+    """
+    pending = collections.deque()
+    for arg in iterable:
+        pending.append((arg, pool.apply_async(func, (arg,))))
+        if len(pending) >= window:
+            arg, result = pending.popleft()
+            yield arg, result.get()
+
+    while pending:
+        arg, result = pending.popleft()
+        yield arg, result.get()
+
+
+class ActivitySync(object):
+    """Syncs Google+ activities to Wordpress.
+
+    The sync is a pipeline of generators:
+        fetch -> select -> lookup -> render -> diff -> publish
+    Fetching and rendering each run in their own thread with a bounded
+    queue after them, so only a few activities are held in memory at once
+    however big the stream or the blog is. With --workers the posts are
+    rendered in a pool of processes too.
+    """
+
+    def __init__(self, index, publisher=None, state=None, watermark=None,
+                 comments=None):
+        self.index = index
+        self.publisher = publisher
+        self.state = state
+
+        # Without a CommentSync, only the comments which come with the
+        # activities are synced.
+        if comments is None and publisher is not None:
+            comments = CommentSync(publisher, state)
+        self.comments = comments
+
+        self.watermark = watermark
+        self.newest = watermark
+
+        # The ETag of the first page fetched, so the next fetch can skip
+        # the stream when it hasn't changed.
+        self.etag = None
+
+        # (item, post id, whether the post is new) for the posts whose
+        # comments are still to be synced.
+        self._commented = collections.deque()
+
+        # Plain counters, read by sync_metrics from another thread. seen
+        # counts every activity fetched, selected those past the watermark.
+        self.seen = 0
+        self.selected = 0
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+
+    def fetch(self, service, user_id):
+        """Yields the activities in the stream, newest page first."""
+        post_request = service.activities().list(
+            userId=user_id, collection='public')
+        etag, self.etag = self.etag, None
+        if etag:
+            # New activities are always on the first page.
+            post_request.headers['If-None-Match'] = etag
+        first_request = post_request
 
         while post_request is not None:
-            activities_doc = post_request.execute()
+            with TIMINGS.time('plus.activities'):
+                try:
+                    activities_doc = PLUS_SCHEDULER.call(
+                        'activities', post_request.execute)
+                except HttpError, e:
+                    if etag and e.resp.status == 304:
+                        # Nothing has changed since the last fetch.
+                        self.etag = etag
+                        return
+                    raise
+            if post_request is first_request:
+                self.etag = activities_doc.get('etag')
             items = sorted(
                 activities_doc.get('items', []),
                 key=lambda x: x["id"]
             )
 
+            # Activities come newest first, so once this page reaches back
+            # past the watermark there is nothing new on the later pages.
+            reached_watermark = False
             for item in items:
-                if FLAGS.post_id and FLAGS.post_id != item['id']:
-                    continue
+                if self.watermark:
+                    published = date_parse(item['published'])
+                    if published <= self.watermark:
+                        reached_watermark = True
+                yield item
+
+            if reached_watermark:
+                break
+
+            post_request = service.activities().list_next(
+                post_request, activities_doc
+            )
+
+    def select(self, items):
+        """Yields the activities which need looking at."""
+        for item in items:
+            if FLAGS.post_id and FLAGS.post_id != item['id']:
+                continue
+            self.seen += 1
+
+            updated = date_parse(item['updated'])
+            if self.newest is None or updated > self.newest:
+                self.newest = updated
+
+            if self.watermark and updated <= self.watermark:
+                self.commented(item, self.index.peek(item['id']))
+                continue
+
+            if FLAGS.verbose:
+                print 'Assessing / Publishing ID: %-040s' % item['id']
+
+            self.selected += 1
+            yield item
+
+    def lookup(self, items):
+        """Yields (item, embeds) with the oEmbed data each post needs."""
+        for item in items:
+            yield lookup_embeds(item)
 
+    def render(self, looked_up):
+        """Yields (item, post) with a RenderedPost for each activity."""
+        if FLAGS.workers > 0:
+            rendered = self.render_pool(looked_up)
+        else:
+            rendered = ((item, render_with_embeds((item, embeds)))
+                        for item, embeds in looked_up)
+
+        for item, post in rendered:
+            if FLAGS.verbose:
+                print repr((post.title, post.has_content, post.type))
+                print "=" * 80
+                print post.content
+                print "-" * 80
+            yield item, post
+
+    def render_pool(self, looked_up):
+        """Render activities in worker processes, keeping their order.
+
+        The workers don't share the oEmbed cache or connections, which is
+        why the oEmbed lookups are all done beforehand. Only a couple of
+        activities per worker are in flight at once.
+        """
+        pool = multiprocessing.Pool(FLAGS.workers, render_worker_init)
+        try:
+            for (item, _), post in ordered(
+                    pool, render_with_embeds, looked_up, FLAGS.workers * 2):
+                yield item, post
+        finally:
+            pool.terminate()
+
+    def diff(self, rendered):
+        """Yields (item, post, found, record) for posts needing a write."""
+        for item, post in rendered:
+            #post.author = author
+            if not post.title:
+                if FLAGS.verbose:
+                    print "Cannot find title!"
+
+            if not post.content:
                 if FLAGS.verbose:
-                    print 'Assessing / Publishing ID: %-040s' % item['id']
-
-                otype = GooglePlusPost.type(item['object'])
-
-                # If item['object'] has an id then it's a reshare,
-                if item['object'].get('id', ''):
-                    author = item['object']['actor']['displayName']
-                    post = TextPost(item['id'], item)
-                    post.title = '%sReshared %s from %s' % (
-                        ['', "%s - " % post.title][len(post.title) > 1],
-                        otype, author)
-
-                    if 'annotation' in item:
-                        post.content = item['annotation']
-                    if FLAGS.verbose:
-                        print repr(('Reshare!', post.title, post.content))
-
-                # else, original post
-                else:
-                    post = GooglePlusPost.TYPE2CLASS[otype](
-                        item['id'], item)
-                    if FLAGS.verbose:
-                        print repr((post.title, post.has_content, otype))
-                        print "=" * 80
-                        post.render()
-                        print post.content
-                        print "-" * 80
+                    print "Cannot find content!"
+
+            if not (post.title and post.content):
+                self.skipped += 1
+                continue
+
+            found = self.index.get(item['id'])
+            record = SyncRecord(
+                found and found.post_id, post.updated.isoformat(),
+                content_hash(post.title, post.content),
+                found and found.hash_field_id or None)
+
+            if found and found.content_hash == record.content_hash:
+                self.skipped += 1
+                self.commented(item, found)
+                continue
+
+            yield item, post, found, record
+
+    def publish(self, changes):
+        for item, post, found, record in changes:
+            publishable_post = post.toWordPressPost()
+            # TODO Do we actually support anything which isn't an activity?
+            # TODO Surely a GooglePost object could know its own ID
+            publishable_post.custom_fields = [
+                {"key": 'google_plus_activity_id', "value": item['id']}
+            ]
+
+            if self.publisher is None:
+                continue
+
+            if not found:
+                publishable_post.custom_fields.append({
+                    "key": WordPressPostIndex.HASH_KEY,
+                    "value": record.content_hash,
+                })
+                if FLAGS.verbose:
+                    print "Publishing new post",
+                    print repr(publishable_post).decode('utf-8')
+                # The comments follow once the post has an id.
+                self.publisher.call(
+                    posts.NewPost(publishable_post),
+                    functools.partial(self.posted, item, record))
+
+            else:
+                # The activity id is already set, only the hash changes.
+                field = content_hash_field(
+                    self.publisher.wp, found, record.content_hash)
+                publishable_post.custom_fields = [field]
+                record = record._replace(hash_field_id=field.get('id'))
+                if FLAGS.verbose:
+                    print "Updating existing post"
+                self.publisher.call(
+                    posts.EditPost(found.post_id, publishable_post),
+                    functools.partial(self.posted, item, record))
+
+            self.sync_comments()
+
+        if self.publisher is not None:
+            # Once the posts are all sent their comments can all be synced.
+            self.publisher.flush()
+            self.sync_comments()
+            self.comments.flush()
+            self.publisher.flush()
+
+    def posted(self, item, record, result):
+        self.synced(item['id'], record, result)
+        self._commented.append(
+            (item, record.post_id or result, not record.post_id))
+
+    def commented(self, item, found):
+        """Queue the comments on an unchanged post to be synced."""
+        if self.comments is None or not found:
+            return
+        if not item['object'].get('replies', {}).get('totalItems'):
+            return
+        self._commented.append((item, found.post_id, False))
+
+    def sync_comments(self):
+        """Hand the posts sent so far to the CommentSync."""
+        while self._commented:
+            self.comments.add(*self._commented.popleft())
+
+    def synced(self, activity_id, record, result):
+        # NewPost returns the new post id, EditPost just returns True.
+        if not record.post_id:
+            record = record._replace(post_id=result)
+            self.created += 1
+        else:
+            self.updated += 1
+        self.index.add(activity_id, record)
+        if self.state is not None:
+            self.state.record(activity_id, record)
+
+    def run(self, items):
+        """Sync some activities, such as those from fetch()."""
+        items = bounded(items, FLAGS.queue_size)
+        rendered = bounded(
+            self.render(self.lookup(self.select(items))), FLAGS.queue_size)
+        self.publish(self.diff(rendered))
+
+        if (self.state is not None and self.newest and
+                not FLAGS.post_id):
+            self.state.set_watermark(self.newest)
+
+
+class ConcurrentActivitySync(ActivitySync):
+    """An ActivitySync which does more of its network I/O at once.
+
+    The oEmbed lookups for several activities are made at the same time,
+    and a ConcurrentPublisher can send several batches of Wordpress calls
+    at the same time. Google+ is still paged through one page at a time, as
+    each page needs the token from the one before, but that overlaps with
+    everything else.
+    """
+
+    def __init__(self, index, publisher=None, state=None, watermark=None,
+                 activity_workers=8, comments=None):
+        ActivitySync.__init__(
+            self, index, publisher, state, watermark, comments)
+        self.activity_workers = activity_workers
 
+    def lookup(self, items):
+        pool = ThreadPool(self.activity_workers)
+        try:
+            for _, looked_up in ordered(
+                    pool, lookup_embeds, items, self.activity_workers * 2):
+                yield looked_up
+        finally:
+            pool.terminate()
+
+
+class Watcher(object):
+    """Polls the stream and syncs what is new, until stopped.
+
+    Each poll only fetches the activities since the newest one the last
+    poll saw, and asks for the first page with the ETag it got last time,
+    so an unchanged stream costs a single 304. After a poll finds
+    something the next is interval seconds later; each poll which finds
+    nothing (or fails) doubles the wait, up to max_interval.
+
+    stop() can be used as a signal handler. The poll in progress is
+    finished before run() returns.
+    """
+
+    def __init__(self, sync, service, user_id, interval=60,
+                 max_interval=900):
+        self.sync = sync
+        self.service = service
+        self.user_id = user_id
+        self.interval = interval
+        self.max_interval = max_interval
+        self.wait = interval
+
+        self._stopped = threading.Event()
+        self.polls = 0
+
+    def stop(self, signum=None, frame=None):
+        if FLAGS.verbose and signum is not None:
+            print "Signal %d, stopping after this poll" % signum
+        self._stopped.set()
+
+    def poll(self):
+        """Sync what is new, returns whether there was anything."""
+        sync = self.sync
+        watermark = sync.watermark = sync.newest
+        selected = sync.selected
+        try:
+            sync.run(sync.fetch(self.service, self.user_id))
+        except:
+            # Look at everything since the last good poll again next time.
+            sync.newest = watermark
+            sync.etag = None
+            raise
+        finally:
+            self.polls += 1
+        return sync.selected > selected
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                found = self.poll()
+            except (IOError, HttpError, xmlrpclib.Error), e:
+                print "Poll failed: %s" % e
                 found = False
-                for existing_post in existing_posts:
-                    for field in existing_post.custom_fields:
-                        field_key = field['key'] == 'google_plus_activity_id'
-                        field_value = field['value'] == item['id']
-
-                        if field_key and field_value:
-                            found = existing_post
-
-                publishable_post = post.toWordPressPost()
-                # TODO Do we actually support anything which isn't an activity?
-                # TODO Surely a GooglePost object could know its own ID
-                publishable_post.custom_fields = [
-                    {"key": 'google_plus_activity_id', "value": item['id']}
-                ]
-
-                #post.author = author
-                if not post.title:
-                    if FLAGS.verbose:
-                        print "Cannot find title!"
-
-                if not post.content:
-                    if FLAGS.verbose:
-                        print "Cannot find content!"
-
-                if FLAGS.dryrun:
-                    continue
 
-                if post.title and post.content and not found:
-                    if FLAGS.verbose:
-                        print "Publishing new post",
-                        print repr(publishable_post).decode('utf-8')
-                    wp.call(posts.NewPost(publishable_post))
-
-                # Todo check equality, no point editing if nothing changes
-                if post.title and post.content and found:
-                    content_match = found.content == post.content
-                    title_match = found.title == post.title
-                    if not (content_match and title_match):
-                        if FLAGS.verbose:
-                            print "Updating existing post"
-                        wp.call(posts.EditPost(found.id, publishable_post))
-
-                # Comments
-                """
-                if item['object']['replies']['totalItems'] > 0:
-                    comments_request = service.comments().list(
-                        maxResults=100,
-                        activityId=item['id']
-                    )
-                    comments_document = comments_request.execute()
-
-                    for comment in comments_document['items']:
-                        publishable_comment = GooglePlusComment(
-                            comment).toWordPressComment()
-
-                        # TODO Check post for existing comments nad avoid
-                        # duplication
-                        if FLAGS.verbose:
-                            print "Publishing new comment to " + found.id
-                            wp.call(NewAnonymousComment(
-                                found.id, publishable_comment))
-
-# See
-# https://github.com/maxcutler/python-wordpress-xmlrpc/pull/35
-                        if config.WORDPRESS_COMMENT_STYLE == 'anonymous':
-                            wp.call(NewAnonymousComment(
-                                found.id, publishable_comment))
-                        else:
-                            wp.call(comments.NewComment(
-                                found.id, publishable_comment))
-"""
+            if found:
+                self.wait = self.interval
+            else:
+                self.wait = min(self.wait * 2, self.max_interval)
+            if FLAGS.verbose:
+                print "Next poll in %.0fs" % self.wait
+            self._stopped.wait(self.wait)
 
-                post_request = service.activities().list_next(
-                    post_request, activities_doc
-                )
-            break
+
+def build_post(item):
+    """Create the right GooglePlusPost for an activity."""
+    otype = GooglePlusPost.type(item['object'])
+
+    # If item['object'] has an id then it's a reshare,
+    if item['object'].get('id', ''):
+        author = item['object']['actor']['displayName']
+        post = TextPost(item['id'], item)
+        post.title = '%sReshared %s from %s' % (
+            ['', "%s - " % post.title][len(post.title or '') > 1],
+            otype, author)
+
+        if 'annotation' in item:
+            post.content = item['annotation']
+        if FLAGS.verbose:
+            print repr(('Reshare!', post.title, post.content))
+
+    # else, original post
+    else:
+        post = GooglePlusPost.TYPE2CLASS[otype](item['id'], item)
+
+    return post
+
+
+def activity_embed_urls(item):
+    """The urls the post for an activity will want oEmbed information for."""
+    if item['object'].get('id', ''):
+        return []
+    otype = GooglePlusPost.type(item['object'])
+    return GooglePlusPost.TYPE2CLASS[otype].embed_urls(item)
+
+
+def lookup_embeds(item):
+    """Returns (item, embeds) with the oEmbed data the post will need."""
+    with TIMINGS.time('lookup', item['id']):
+        urls = activity_embed_urls(item)
+        return item, dict(zip(urls, embed_many(urls)))
+
+
+def render_activity(item):
+    """Build and render the post for an activity, returns a RenderedPost."""
+    start = time.time()
+    post = build_post(item)
+    post.render()
+    TIMINGS.add('render.' + post.TYPE, time.time() - start, item['id'])
+    return post.rendered()
+
+
+def render_worker_init():
+    """Forget the parent's oEmbed cache, threads and locks in a worker.
+
+    The worker is forked while the sync's threads are running, so any of
+    the locks the parent's threads use might have been held at the time.
+    """
+    global EMBED_CACHE, EMBED_POOL, ENV, PROFILER, TIMINGS
+    EMBED_CACHE = None
+    EMBED_POOL = None
+    ENV = None
+    PROFILER = Profiler()
+    TIMINGS = Timings()
+
+
+def render_with_embeds(args):
+    """render_activity() with the oEmbed data from lookup_embeds()."""
+    item, PRELOADED.embeds = args
+    try:
+        return render_activity(item)
+    finally:
+        PRELOADED.embeds = {}
+
+
+def sync_metrics(sync, publisher=None):
+    """The metrics for a MetricsWriter about a sync, as it runs."""
+    metrics = [
+        Metric('activities_seen_total', 'counter',
+               'Google+ activities looked at.', {}, sync.seen),
+    ]
+    for action in ('created', 'updated', 'skipped'):
+        metrics.append(Metric(
+            'posts_total', 'counter',
+            'Wordpress posts created, updated, or skipped as unchanged or '
+            'empty.', {'action': action}, getattr(sync, action)))
+
+    if sync.comments is not None:
+        metrics.append(Metric(
+            'comments_published_total', 'counter',
+            'Google+ comments published to Wordpress.', {},
+            sync.comments.published))
+
+    if EMBED_CACHE is not None:
+        for result, n in (('hit', EMBED_CACHE.hits),
+                          ('failure_hit', EMBED_CACHE.negative_hits),
+                          ('miss', EMBED_CACHE.misses)):
+            metrics.append(Metric(
+                'embed_cache_lookups_total', 'counter',
+                'oEmbed cache lookups.', {'result': result}, n))
+
+    for scheduler in (PLUS_SCHEDULER, EMBED_SCHEDULER, WORDPRESS_SCHEDULER):
+        metrics.append(Metric(
+            'api_calls_total', 'counter', 'Requests made to each service.',
+            {'service': scheduler.name}, scheduler.calls))
+    for scheduler in (PLUS_SCHEDULER, EMBED_SCHEDULER, WORDPRESS_SCHEDULER):
+        metrics.append(Metric(
+            'api_retries_total', 'counter',
+            'Requests to each service which were retried.',
+            {'service': scheduler.name}, scheduler.retried))
+
+    if publisher is not None:
+        metrics.append(Metric(
+            'wordpress_calls_total', 'counter',
+            'Wordpress calls, however they were batched.', {},
+            publisher.calls))
+        metrics.append(Metric(
+            'wordpress_round_trips_total', 'counter',
+            'Requests the Wordpress calls were sent in.', {},
+            publisher.round_trips))
+
+    metrics.extend(timings_metrics(TIMINGS))
+    metrics.append(Metric(
+        'last_update_seconds', 'gauge',
+        'When these metrics were written, as a Unix timestamp.', {},
+        time.time()))
+    return metrics
+
+###############################################################################
+
+
+def main(argv, service=None, connections=None):
+    """Sync Google+ to Wordpress.
+
+    The Google+ service and the HTTP connections for oEmbed and Wordpress
+    can be passed in, which is how fakes.py runs without the real ones.
+    """
+    # Let the gflags module process the command-line arguments
+    try:
+        argv = FLAGS(argv)
+    except gflags.FlagsError, e:
+        print '%s\\nUsage: %s ARGS\\n%s' % (e, argv[0], FLAGS)
+        sys.exit(1)
+
+    global EMBED_CACHE
+    if FLAGS.embed_cache:
+        EMBED_CACHE = EmbedCache(
+            FLAGS.embed_cache,
+            FLAGS.embed_cache_ttl, FLAGS.embed_cache_negative_ttl)
+
+    if FLAGS.embed_cache_command:
+        if EMBED_CACHE is None:
+            print "No --embed_cache to look after."
+            sys.exit(1)
+
+        if FLAGS.embed_cache_command == 'stats':
+            print "%d entries in %s" % (len(EMBED_CACHE), FLAGS.embed_cache)
+        elif FLAGS.embed_cache_command == 'prune':
+            print "Pruned %d entries" % EMBED_CACHE.prune()
+        elif FLAGS.embed_cache_command == 'evict':
+            print "Evicted %d entries" % sum(
+                EMBED_CACHE.evict(url) for url in argv[1:])
+        elif FLAGS.embed_cache_command == 'clear':
+            print "Cleared %d entries" % EMBED_CACHE.clear()
+        EMBED_CACHE.close()
+        return
+
+    global PLUS_SCHEDULER, EMBED_SCHEDULER, WORDPRESS_SCHEDULER
+    retrying = dict(
+        retries=FLAGS.retries, backoff=FLAGS.backoff,
+        max_backoff=FLAGS.max_backoff, failures=FLAGS.breaker_failures,
+        reset=FLAGS.breaker_reset)
+    PLUS_SCHEDULER = Scheduler('Google+', FLAGS.plus_rate, **retrying)
+    EMBED_SCHEDULER = Scheduler('oEmbed', FLAGS.embed_rate, **retrying)
+    WORDPRESS_SCHEDULER = Scheduler(
+        'Wordpress', FLAGS.wordpress_rate, idempotent=False, **retrying)
+
+    if FLAGS.watch and (FLAGS.takeout or FLAGS.wxr):
+        print "--watch can't be used with --takeout or --wxr."
+        sys.exit(1)
+    if FLAGS.comments and not (FLAGS.state_file or FLAGS.wxr):
+        print "--comments needs a --state_file to remember the comments in."
+        sys.exit(1)
+    timezone = None
+    if FLAGS.wxr_timezone:
+        timezone = gettz(FLAGS.wxr_timezone)
+        if timezone is None:
+            print "Unknown --wxr_timezone %s." % FLAGS.wxr_timezone
+            sys.exit(1)
+
+    http = comment_http = None
+    if service is None and not FLAGS.takeout:
+        # If the Credentials don't exist or are invalid run through the
+        # native client flow. The Storage object will ensure that if
+        # successful the good Credentials will get written back to a file.
+        from oauth2client.file import Storage
+        storage = Storage('plus.dat')
+        credentials = storage.get()
+
+        if credentials is None or credentials.invalid:
+            from oauth2client.tools import run
+            credentials = run(flow(), storage)
+
+        # Create an httplib2.Http object to handle our HTTP requests and
+        # authorize it with our good Credentials.
+        http = httplib2.Http()
+        http = credentials.authorize(http)
+
+        service = build_service(http)
+
+        # httplib2.Http isn't thread safe, and the activities are fetched
+        # in a thread of their own.
+        if FLAGS.comments:
+            comment_http = credentials.authorize(httplib2.Http())
+
+    if connections is None:
+        connections = ConnectionPool(
+            FLAGS.host_connections, parse_host_limits(FLAGS.host_limits),
+            FLAGS.timeout)
+    if FLAGS.concurrent:
+        for endpoint in OEMBED_CONSUMER.getEndpoints():
+            endpoint.setUrllib(PooledUrllib(connections))
+
+    from oauth2client.client import AccessTokenRefreshError
+
+    wp = publisher = transport = None
+    if FLAGS.wxr:
+        publisher = WXRPublisher(
+            FLAGS.wxr, FLAGS.wxr_max_bytes,
+            urlparse.urljoin(config.WORDPRESS_XMLRPC_URI, '.'),
+            config.WORDPRESS_USERNAME, timezone=timezone)
+    elif not FLAGS.dryrun:
+        wp_url = urlparse.urlsplit(config.WORDPRESS_XMLRPC_URI)
+        transport = PooledTransport(
+            connections, wp_url.scheme, FLAGS.wordpress_gzip_requests,
+            WORDPRESS_SCHEDULER)
+        wp = Client(
+            config.WORDPRESS_XMLRPC_URI,
+            config.WORDPRESS_USERNAME,
+            config.WORDPRESS_PASSWORD,
+            transport=transport
+        )
+        if FLAGS.concurrent:
+            publisher = ConcurrentPublisher(
+                wp, FLAGS.batch_size,
+                connections.host_limit(wp_url.netloc))
+        else:
+            publisher = WordPressPublisher(wp, FLAGS.batch_size)
+
+    try:
+        if FLAGS.takeout:
+            user_id = FLAGS.user_id
+        else:
+            user_id = PLUS_SCHEDULER.call(
+                'people', service.people().get(userId=FLAGS.user_id).execute,
+                http)['id']
+
+        # A WXR export has every post, whatever is already on the blog.
+        state = None
+        if FLAGS.state_file and not FLAGS.wxr:
+            state = SyncState(FLAGS.state_file)
+
+        existing_posts = WordPressPostIndex()
+        if (state is not None and state.count() and
+                not FLAGS.rebuild_state):
+            state.load(existing_posts)
+        elif not (FLAGS.dryrun or FLAGS.wxr):
+            crawl_wordpress(wp, existing_posts)
+            if state is not None:
+                state.rebuild(existing_posts)
+
+        watermark = None
+        if FLAGS.incremental and state is not None:
+            watermark = state.watermark()
+
+        comment_sync = None
+        if publisher is not None:
+            comment_sync = CommentSync(
+                publisher, state,
+                [None, service][FLAGS.comments and not FLAGS.takeout],
+                FLAGS.comment_batch_size, comment_http,
+                bool(FLAGS.comments or FLAGS.wxr))
+
+        if FLAGS.concurrent:
+            sync = ConcurrentActivitySync(
+                existing_posts, publisher, [state, None][FLAGS.dryrun],
+                watermark, FLAGS.activity_workers, comment_sync)
+        else:
+            sync = ActivitySync(
+                existing_posts, publisher, [state, None][FLAGS.dryrun],
+                watermark, comment_sync)
+        if FLAGS.profile:
+            PROFILER.enabled = TIMINGS.tracing = True
+
+        metrics = None
+        if FLAGS.metrics_file:
+            metrics = MetricsWriter(
+                FLAGS.metrics_file,
+                functools.partial(sync_metrics, sync, publisher),
+                FLAGS.metrics_format, FLAGS.metrics_interval,
+                {'user': user_id})
+            metrics.start()
+        handlers = {}
+        try:
+            if FLAGS.watch:
+                watcher = Watcher(
+                    sync, service, user_id, FLAGS.watch_interval,
+                    FLAGS.watch_max_interval)
+                for signum in (signal.SIGINT, signal.SIGTERM):
+                    handlers[signum] = signal.signal(signum, watcher.stop)
+                PROFILER.wrap(watcher.run)()
+            elif FLAGS.takeout:
+                PROFILER.wrap(sync.run)(takeout_activities(FLAGS.takeout))
+            else:
+                PROFILER.wrap(sync.run)(sync.fetch(service, user_id))
+        finally:
+            for signum, handler in handlers.iteritems():
+                signal.signal(signum, handler)
+            if metrics is not None:
+                metrics.stop()
+
+        if FLAGS.wxr:
+            publisher.close()
+            print "Wrote %d posts to %s" % (
+                len(existing_posts), ', '.join(publisher.filenames))
+
+        if publisher is not None and FLAGS.verbose:
+            print "Wordpress: %d calls in %d round trips" % (
+                publisher.calls, publisher.round_trips)
+            print "Comments: %d published, fetched for %d activities" % (
+                comment_sync.published, comment_sync.fetched)
+
+        if transport is not None and FLAGS.verbose:
+            for method_name, (calls, total, slowest) in sorted(
+                    transport.latency.iteritems()):
+                print "Wordpress %s: %d calls, %.0fms mean, %.0fms max" % (
+                    method_name, calls, total / calls * 1000, slowest * 1000)
+
+        if FLAGS.verbose:
+            print "HTTP: %d requests over %d connections" % (
+                connections.requests, connections.connects)
+            for scheduler in (PLUS_SCHEDULER, EMBED_SCHEDULER,
+                              WORDPRESS_SCHEDULER):
+                print "%s: %d calls, %d retries" % (
+                    scheduler.name, scheduler.calls, scheduler.retried)
+
+        if EMBED_CACHE is not None and FLAGS.verbose:
+            print "oEmbed cache: %d hits, %d failure hits, %d misses " \
+                "(%.0f%% hit ratio)" % (
+                    EMBED_CACHE.hits, EMBED_CACHE.negative_hits,
+                    EMBED_CACHE.misses, EMBED_CACHE.hit_ratio() * 100)
+
+        if FLAGS.verbose:
+            print "Post index: %d posts, %d hits, %d misses" % (
+                len(existing_posts), existing_posts.hits,
+                existing_posts.misses)
+
+        print "\n".join(TIMINGS.summary())
+        if FLAGS.profile:
+            PROFILER.dump(FLAGS.profile)
+            TIMINGS.write_trace(FLAGS.profile + '.trace')
+            print "Profile written to %s and %s.trace" % (
+                FLAGS.profile, FLAGS.profile)
+
+        if state is not None:
+            state.close()
+        connections.close()
 
     except AccessTokenRefreshError:
         print ("The credentials have been revoked or expired, please re-run"
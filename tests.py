@@ -23,6 +23,15 @@ __author__ = 'bayuadji@gmail.com'
 
 import json
 import os
+import threading
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+# Imported here so the tests which patch sys.modules don't throw them away.
+try:
+    import googleapiclient.discovery
+except ImportError:
+    import apiclient.discovery
 try:
     import unittest2 as unittest
 except ImportError:
@@ -30,6 +39,11 @@ except ImportError:
 
 from mock import patch, MagicMock, Mock
 
+# Every plus module the tests imported. gflags only lets a module define its
+# flags again when it is a different module object, so none can be freed
+# for a later import to reuse its id.
+PLUS_MODULES = []
+
 
 class TestGooglePost(unittest.TestCase):
     maxDiff = None
@@ -51,6 +65,12 @@ class TestGooglePost(unittest.TestCase):
         self.maxDiff = None
 
     def tearDown(self):
+        # The flags are shared by every import of plus.
+        import gflags
+        import sys
+        gflags.FLAGS.Reset()
+        if 'plus' in sys.modules:
+            PLUS_MODULES.append(sys.modules['plus'])
         self.module_patcher.stop()
 
     def load_data(self, filename, type="json"):
@@ -92,6 +112,8 @@ class TestGooglePost(unittest.TestCase):
         embed = MagicMock()
         embed.getData = MagicMock(side_effect=expected_return_value)
         plus.OEMBED_CONSUMER.embed.return_value = embed
+        # The mocked responses come back in call order, not by url.
+        plus.FLAGS.embed_workers = 1
 
 
 class TestPhoto(TestGooglePost):
@@ -300,6 +322,84 @@ class TestUtils(TestGooglePost):
         self.assertMultiLineEqual("""From mock""", post.title)
 
 
+class TestTitleExtractor(TestGooglePost):
+    def samples(self):
+        import glob
+        for filename in sorted(glob.glob(os.path.join(
+                os.path.dirname(__file__), 'test_documents', 'sample_*.json'))):
+            yield self.load_data(os.path.basename(filename))
+
+    def test_titles(self):
+        from plus import TextPost
+        post = TextPost('', self.load_data('sample_pic_with_content.json'))
+        self.assertEqual(
+            (u'13km long running in rain.', False),
+            (post.title, post.has_content))
+
+        post = TextPost('', self.load_data('sample_picasa.json'))
+        self.assertEqual(
+            (u'Winter a Plenty...', True), (post.title, post.has_content))
+
+        post = TextPost('', self.load_data('sample_multi_img.json'))
+        self.assertEqual(
+            (None, False, None), (post.title, post.has_content, post.content))
+
+    def test_reuse(self):
+        from plus import TitleExtractor
+        shared = TitleExtractor()
+        for gdata in list(self.samples()) * 2:
+            content = gdata['object']['content']
+            self.assertEqual(
+                TitleExtractor().extract(content), shared.extract(content))
+
+    def test_fast_path(self):
+        from plus import TitleExtractor
+        fast = TitleExtractor()
+        self.assertEqual(
+            (u'Off to the beach!', True),
+            fast.extract_simple(u'Off to the <b>beach</b>!<br />Bye'))
+        self.assertEqual(None, fast.extract_simple(u' <br /> '))
+        # Too complicated, so these go through html2text and nltk.
+        self.assertFalse(fast.extract_simple(u'<p>A paragraph</p>'))
+        self.assertFalse(fast.extract_simple(u'Two sentences. Here'))
+        self.assertFalse(fast.extract_simple(u'- a list'))
+        self.assertFalse(fast.extract_simple(u'Fish &rsquo;n chips'))
+
+    def test_fast_path_matches(self):
+        from plus import TitleExtractor
+        fast = TitleExtractor()
+        slow = TitleExtractor(fast=False)
+        contents = [g['object']['content'] for g in self.samples()] + [
+            u'Hello\t<b>  .',
+            u';</i> </i>  "<br>',
+            u'\t;+\n+\t  ',
+            u'&#39;1.\n',
+            u'(&world</i>',
+            u'Really?!',
+            u'Winter a Plenty...',
+            u'x &amp; y &quot;z&quot;',
+            u'http://localhost:8080/foo',
+            u'https://goo/gl<br />more',
+        ]
+        for content in contents:
+            self.assertEqual(slow.extract(content), fast.extract(content))
+        self.assertEqual(
+            (None, False), fast.extract(u'http://localhost:8080/foo'))
+
+    def test_threads(self):
+        from multiprocessing.pool import ThreadPool
+        from plus import TitleExtractor
+        contents = [g['object']['content'] for g in self.samples()] * 4
+        shared = TitleExtractor()
+
+        expected = [TitleExtractor().extract(c) for c in contents]
+        pool = ThreadPool(4)
+        try:
+            self.assertEqual(expected, pool.map(shared.extract, contents))
+        finally:
+            pool.close()
+
+
 class TestGeocode(TestGooglePost):
     def test_post(self):
         from plus import PhotoPost
@@ -308,5 +408,1817 @@ class TestGeocode(TestGooglePost):
         self.do_test_equal(PhotoPost, 'sample_pic_with_geocode.json', result, 'render_geocode')
 
 
+class TestEmbedMany(TestGooglePost):
+    def test_keeps_order(self):
+        import plus
+        import random
+        import time
+
+        data = self.load_data('embedly_multiple_photos.json')
+        gdata = self.load_data('sample_multi_img.json')
+        urls = [att['url'] for att in gdata['object']['attachments']]
+        by_url = dict(zip(urls, data))
+
+        def embed(url):
+            time.sleep(random.random() / 100)
+            response = MagicMock()
+            response.getData.return_value = dict(by_url[url])
+            return response
+
+        plus.OEMBED_CONSUMER = MagicMock()
+        plus.OEMBED_CONSUMER.embed.side_effect = embed
+        plus.FLAGS.embed_workers = 4
+        self.assertEqual(data, plus.embed_many(urls))
+
+        result = self.load_data('result_multiple_photos.html', type='html')
+        self.do_test_equal(
+            plus.GalleryPost, 'sample_multi_img.json', result,
+            equal_function='assertMultiLineEqual')
+
+
+class TestEmbedlyBatch(TestGooglePost):
+    def setUp(self):
+        TestGooglePost.setUp(self)
+        import plus
+        import oembed
+
+        self.requests = []
+        self.responses = []
+        opener = MagicMock()
+        opener.open.side_effect = self.open
+        self.embedly = plus.Embedly('KEY')
+        self.embedly.setUrllib(MagicMock())
+        self.embedly._urllib.build_opener.return_value = opener
+
+        plus.OEMBED_CONSUMER = oembed.OEmbedConsumer()
+        plus.OEMBED_CONSUMER.addEndpoint(self.embedly)
+        # The fake responses come back in request order.
+        plus.FLAGS.embed_workers = 1
+
+    def open(self, url):
+        from StringIO import StringIO
+        self.requests.append(url)
+        return StringIO(json.dumps(self.responses.pop(0)))
+
+    def test_request_many(self):
+        self.assertEqual(
+            'http://api.embed.ly/1/oembed?format=json'
+            '&urls=http%3A%2F%2Fa%2F1,http%3A%2F%2Fb%2F2&key=KEY',
+            self.embedly.request_many(
+                ['http://a/1', 'http://b/2'], format='json'))
+
+    def test_one_request(self):
+        import plus
+        data = self.load_data('embedly_multiple_photos.json')
+        gdata = self.load_data('sample_multi_img.json')
+        urls = [att['url'] for att in gdata['object']['attachments']]
+        self.responses.append(data)
+
+        self.assertEqual(data, plus.embed_many(urls))
+        self.assertEqual(1, len(self.requests))
+
+    def test_chunks(self):
+        import plus
+        self.embedly.MAX_URLS = 2
+        photo = {'type': 'photo', 'version': '1.0', 'url': 'http://x',
+                 'width': 100, 'height': 100}
+        self.responses.extend([[photo, photo], [photo, photo]])
+
+        urls = ['http://a', 'http://b', 'http://c', 'http://d']
+        self.assertEqual([photo] * 4, plus.embed_many(urls))
+        self.assertEqual(2, len(self.requests))
+
+    def test_error_falls_back_to_thumbnail(self):
+        import plus
+        data = self.load_data('embedly_multiple_photos.json')
+        data[1] = {'type': 'error', 'error_code': 404,
+                   'error_message': 'Not Found', 'version': '1.0'}
+        self.responses.append(data)
+
+        gdata = self.load_data('sample_multi_img.json')
+        post = plus.GalleryPost('', gdata)
+        post.render()
+
+        self.assertEqual(1, len(self.requests))
+        thumbnail = gdata['object']['attachments'][1]['image']['url']
+        self.assertTrue(
+            '<img src="%s" class="shashinThumbnailImage"' % thumbnail
+            in post.content)
+
+
+class TestEmbedCache(TestGooglePost):
+    def setUp(self):
+        TestGooglePost.setUp(self)
+        import plus
+        plus.EMBED_CACHE = plus.EmbedCache(':memory:', 100, 10)
+        self.cache = plus.EMBED_CACHE
+
+    def mock_embedly(self, expected_return_value):
+        import plus
+        TestGooglePost.mock_embedly(self, expected_return_value)
+        plus.OEMBED_CONSUMER._endpointFor.return_value.\
+            _urlApi = 'http://api.embed.ly/1/oembed'
+
+    def test_transient_failure_not_cached(self):
+        import urllib2
+        import plus
+        self.mock_embedly([{'title': 'Later'}])
+        embed = plus.OEMBED_CONSUMER.embed
+        embed.side_effect = [
+            urllib2.HTTPError('http://a', 503, 'Unavailable', {}, None),
+            embed.return_value]
+
+        self.assertEqual(False, plus.embed_content('http://a'))
+        self.assertEqual({'title': 'Later'}, plus.embed_content('http://a'))
+
+    def test_cached(self):
+        import plus
+        self.mock_embedly([{'title': 'Cached'}])
+
+        self.assertEqual({'title': 'Cached'}, plus.embed_content('http://a'))
+        self.assertEqual({'title': 'Cached'}, plus.embed_content('http://a'))
+        self.assertEqual(1, plus.OEMBED_CONSUMER.embed.call_count)
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        self.assertEqual(0.5, self.cache.hit_ratio())
+
+    def test_negative(self):
+        import plus
+        self.mock_embedly([IOError('Oops')])
+
+        self.assertFalse(plus.embed_content('http://a'))
+        self.assertFalse(plus.embed_content('http://a'))
+        self.assertEqual(1, plus.OEMBED_CONSUMER.embed.call_count)
+        self.assertEqual(1, self.cache.negative_hits)
+
+    def test_expired(self):
+        import plus
+        self.mock_embedly([{'title': 'Old'}, {'title': 'New'}])
+        self.cache.ttl = -1
+
+        self.assertEqual({'title': 'Old'}, plus.embed_content('http://a'))
+        self.assertEqual({'title': 'New'}, plus.embed_content('http://a'))
+        self.assertEqual(1, self.cache.prune())
+        self.assertEqual(0, len(self.cache))
+
+    def test_evict(self):
+        self.cache.put('endpoint', 'http://a', {'title': 'A'})
+        self.cache.put('endpoint', 'http://b', False)
+
+        self.assertEqual(1, self.cache.evict('http://a'))
+        self.assertEqual((True, False), self.cache.get('endpoint', 'http://b'))
+        self.assertEqual(1, self.cache.clear())
+
+
+class TestScheduler(TestGooglePost):
+    def failing(self, errors, result='ok'):
+        """A function raising each of errors in turn, then returning."""
+        errors = list(errors)
+        self.attempts = 0
+
+        def func():
+            self.attempts += 1
+            if errors:
+                raise errors.pop(0)
+            return result
+        return func
+
+    def http_error(self, code, retry_after=None):
+        import mimetools
+        import urllib2
+        from StringIO import StringIO
+        headers = mimetools.Message(StringIO(
+            'Retry-After: %s\n' % retry_after if retry_after else ''))
+        return urllib2.HTTPError('http://a', code, 'Oops', headers, None)
+
+    def test_retry(self):
+        from plus import Scheduler
+        scheduler = Scheduler('test', retries=3, backoff=0.001)
+        func = self.failing([self.http_error(503), self.http_error(429)])
+
+        self.assertEqual('ok', scheduler.call('a', func))
+        self.assertEqual((3, 2), (self.attempts, scheduler.retried))
+
+    def test_gives_up(self):
+        import urllib2
+        from plus import Scheduler
+        scheduler = Scheduler('test', retries=2, backoff=0.001)
+        func = self.failing([self.http_error(503)] * 5)
+
+        self.assertRaises(urllib2.HTTPError, scheduler.call, 'a', func)
+        self.assertEqual(3, self.attempts)
+
+    def test_not_retryable(self):
+        import urllib2
+        from plus import Scheduler
+        scheduler = Scheduler('test', retries=3)
+        func = self.failing([self.http_error(404)])
+
+        self.assertRaises(urllib2.HTTPError, scheduler.call, 'a', func)
+        self.assertEqual(1, self.attempts)
+
+    def test_retry_after(self):
+        from plus import Scheduler
+        scheduler = Scheduler('test', retries=1, backoff=0.001)
+        func = self.failing([self.http_error(503, retry_after=30)])
+
+        with patch('time.sleep') as sleep:
+            self.assertEqual('ok', scheduler.call('a', func))
+        self.assertEqual(30, sleep.call_args[0][0])
+
+    def test_backoff(self):
+        from plus import Scheduler
+        scheduler = Scheduler('test', backoff=1, max_backoff=5)
+        for attempt, most in [(0, 1), (1, 2), (2, 4), (3, 5), (10, 5)]:
+            self.assertTrue(0 <= scheduler.delay(attempt) <= most)
+
+    def test_not_idempotent(self):
+        import socket
+        import xmlrpclib
+        from plus import retry_info
+        timeout = socket.timeout('timed out')
+        self.assertEqual((True, None), retry_info(timeout))
+        self.assertEqual((False, None), retry_info(timeout, False))
+        self.assertEqual((True, None), retry_info(xmlrpclib.ProtocolError(
+            'a', 503, 'Unavailable', {}), False))
+        for status in (502, 504):
+            error = xmlrpclib.ProtocolError('a', status, 'Gateway', {})
+            self.assertEqual((True, None), retry_info(error))
+            self.assertEqual((False, None), retry_info(error, False))
+
+    def test_plus_rate_limited(self):
+        from plus import HttpError
+        from plus import retry_info
+        resp = MagicMock(status=403)
+        resp.get.return_value = '10'
+        for reason in ('userRateLimitExceeded', 'rateLimitExceeded'):
+            self.assertEqual((True, 10), retry_info(HttpError(
+                resp, '{"error": {"errors": [{"reason": "%s"}]}}' % reason)))
+            self.assertEqual((True, 10), retry_info(HttpError(
+                resp, '{"error": {"errors": [{"reason": "%s"}]}}' % reason),
+                False))
+        self.assertEqual((False, 10), retry_info(HttpError(
+            resp, '{"error": {"errors": [{"reason": "forbidden"}]}}')))
+        self.assertEqual((False, 10), retry_info(HttpError(
+            resp, '{"error": {"message": "RateLimitExceeded"}}')))
+        self.assertEqual((False, 10), retry_info(HttpError(resp, 'Oops')))
+
+    def test_circuit_breaker(self):
+        from plus import CircuitOpenError, Scheduler
+        scheduler = Scheduler('test', failures=2, reset=0.05)
+        func = self.failing([self.http_error(503)] * 2)
+
+        for _ in range(2):
+            self.assertRaises(IOError, scheduler.call, 'a', func)
+        self.assertRaises(CircuitOpenError, scheduler.call, 'a', func)
+        self.assertEqual(2, self.attempts)
+        # Other endpoints are still used.
+        self.assertEqual('b', scheduler.call('b', lambda: 'b'))
+
+        time.sleep(0.05)
+        self.assertEqual('ok', scheduler.call('a', func))
+        self.assertEqual('ok', scheduler.call('a', func))
+
+    def test_token_bucket(self):
+        from plus import TokenBucket
+        bucket = TokenBucket(rate=100, burst=2)
+        start = time.time()
+        for _ in range(7):
+            bucket.acquire()
+        # The first two calls are the burst, the other 5 wait 10ms each.
+        self.assertTrue(0.04 < time.time() - start < 0.5)
+
+        self.assertEqual(0, TokenBucket().acquire())
+
+
+class TestConnectionPool(TestGooglePost):
+    def setUp(self):
+        TestGooglePost.setUp(self)
+        import BaseHTTPServer
+        import SocketServer
+        test = self
+        self.active = self.most_active = 0
+        self.lock = threading.Lock()
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                with test.lock:
+                    test.active += 1
+                    test.most_active = max(test.most_active, test.active)
+                if self.path == '/slow':
+                    time.sleep(0.1)
+                with test.lock:
+                    test.active -= 1
+
+                if self.path == '/moved':
+                    self.send_response(302)
+                    self.send_header('Location', '/here')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                self.send_response([200, 404][self.path == '/missing'])
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', len(self.path))
+                self.end_headers()
+                self.wfile.write(self.path)
+                # Drop the connection without telling the client.
+                if self.path == '/drop':
+                    self.close_connection = 1
+
+            def log_message(self, *args):
+                pass
+
+        class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+            daemon_threads = True
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        TestGooglePost.tearDown(self)
+
+    def test_keep_alive(self):
+        from plus import ConnectionPool
+        pool = ConnectionPool()
+        for path in ['/a', '/b', '/c']:
+            response = pool.request('GET', self.url + path)
+            self.assertEqual((200, path), (response.status, response.data))
+        self.assertEqual((1, 3), (pool.connects, pool.requests))
+
+    def test_stale_connection(self):
+        from plus import ConnectionPool
+        pool = ConnectionPool()
+        pool.request('GET', self.url + '/drop')
+        self.assertEqual('/a', pool.request('GET', self.url + '/a').data)
+        self.assertEqual(2, pool.connects)
+
+    def test_host_limit(self):
+        from plus import ConnectionPool, parse_host_limits
+        host = self.url.split('/')[2]
+        pool = ConnectionPool(8, parse_host_limits(['%s:2' % host]))
+        self.assertEqual(2, pool.host_limit(host))
+
+        ThreadPool(6).map(
+            lambda _: pool.request('GET', self.url + '/slow'), range(6))
+        self.assertEqual(2, self.most_active)
+        self.assertEqual(2, pool.connects)
+
+    def test_urllib(self):
+        import urllib2
+        from plus import ConnectionPool, PooledUrllib
+        opener = PooledUrllib(ConnectionPool()).build_opener()
+
+        response = opener.open(self.url + '/moved')
+        self.assertEqual('/here', response.read())
+        self.assertTrue('Content-Type' in response.info())
+        self.assertRaises(urllib2.HTTPError, opener.open,
+                          self.url + '/missing')
+
+
+class TestPooledTransport(TestGooglePost):
+    def setUp(self):
+        TestGooglePost.setUp(self)
+        import SimpleXMLRPCServer
+        from plus import ConnectionPool
+        test = self
+        self.encodings = []
+
+        class Handler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def decode_request_content(self, data):
+                test.encodings.append(
+                    self.headers.get('content-encoding', 'identity'))
+                return SimpleXMLRPCServer.SimpleXMLRPCRequestHandler.\
+                    decode_request_content(self, data)
+
+        class Pool(ConnectionPool):
+            def request(self, *args, **kw):
+                response = ConnectionPool.request(self, *args, **kw)
+                test.encodings.append(
+                    response.getheader('content-encoding', 'identity'))
+                return response
+
+        self.server = SimpleXMLRPCServer.SimpleXMLRPCServer(
+            ('127.0.0.1', 0), Handler, logRequests=False)
+        self.server.register_function(pow)
+        self.server.register_function(lambda s: s * 2, 'double')
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+        self.pool = Pool()
+
+    def tearDown(self):
+        # The server handles one connection at a time.
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+        TestGooglePost.tearDown(self)
+
+    def proxy(self, **kw):
+        import xmlrpclib
+        from plus import PooledTransport
+        self.transport = PooledTransport(self.pool, **kw)
+        return xmlrpclib.ServerProxy(
+            'http://127.0.0.1:%d/' % self.server.server_address[1],
+            transport=self.transport)
+
+    def test_keep_alive(self):
+        proxy = self.proxy()
+        self.assertEqual(8, proxy.pow(2, 3))
+        self.assertEqual(9, proxy.pow(3, 2))
+        self.assertEqual(1, self.pool.connects)
+
+    def test_gzip(self):
+        proxy = self.proxy(gzip_requests=True)
+        self.assertEqual(9, proxy.pow(3, 2))
+        self.assertEqual('ab' * 2000, proxy.double('ab' * 1000))
+        self.assertEqual(
+            ['identity', 'identity', 'gzip', 'gzip'], self.encodings)
+
+    def test_latency(self):
+        proxy = self.proxy()
+        proxy.pow(2, 3)
+        proxy.pow(3, 2)
+        proxy.double('a')
+
+        self.assertEqual(['double', 'pow'], sorted(self.transport.latency))
+        calls, total, slowest = self.transport.latency['pow']
+        self.assertEqual(2, calls)
+        self.assertTrue(0 < slowest <= total)
+
+
+class TestWordPressPostIndex(TestGooglePost):
+    def wordpress_post(self, post_id, activity_id=None):
+        from wordpress_xmlrpc import WordPressPost
+        wp_post = WordPressPost()
+        wp_post.id = post_id
+        wp_post.title = 'Title %s' % post_id
+        wp_post.content = 'Content %s' % post_id
+        wp_post.custom_fields = [{'key': 'other', 'value': 'x'}]
+        if activity_id:
+            wp_post.custom_fields.append(
+                {'key': 'google_plus_activity_id', 'value': activity_id})
+        return wp_post
+
+    def test_lookup(self):
+        from plus import WordPressPostIndex
+        index = WordPressPostIndex([
+            self.wordpress_post('1', 'z12a'),
+            self.wordpress_post('2'),
+            self.wordpress_post('3', 'z12b'),
+        ])
+
+        self.assertEqual(2, len(index))
+        self.assertEqual('3', index.get('z12b').post_id)
+        self.assertFalse(index.get('z12c'))
+        self.assertEqual(1, index.hits)
+        self.assertEqual(1, index.misses)
+
+    def test_add_new_post(self):
+        from plus import WordPressPostIndex, SyncRecord
+        index = WordPressPostIndex()
+        self.assertFalse(index.get('z12a'))
+
+        index.add('z12a', SyncRecord('4', None, 'abc'))
+        self.assertTrue('z12a' in index)
+        self.assertEqual('4', index.get('z12a').post_id)
+        self.assertEqual((1, 1), (index.hits, index.misses))
+
+        self.assertEqual('4', index.peek('z12a').post_id)
+        self.assertFalse(index.peek('z12b'))
+        self.assertEqual((1, 1), (index.hits, index.misses))
+
+    def test_content_hash(self):
+        from plus import WordPressPostIndex, content_hash
+        wp_post = self.wordpress_post('1', 'z12a')
+        wp_post.custom_fields.append({
+            'key': 'google_plus_content_hash',
+            'value': content_hash(u'Title 1', u'Content 1')})
+        index = WordPressPostIndex([wp_post, self.wordpress_post('2', 'z12b')])
+
+        self.assertEqual(
+            content_hash(u'Title 1', u'Content 1'),
+            index.get('z12a').content_hash)
+        self.assertNotEqual(
+            content_hash(u'Title 1', u'Content 2'),
+            index.get('z12a').content_hash)
+        # Posts from before hashes were stored will always be updated.
+        self.assertEqual(None, index.get('z12b').content_hash)
+
+    def test_content_hash_field(self):
+        from plus import content_hash_field, SyncRecord, WordPressPostIndex
+        wp_post = self.wordpress_post('1', 'z12a')
+        wp_post.custom_fields.append({
+            'id': '42', 'key': 'google_plus_content_hash', 'value': 'old'})
+        wp = MagicMock()
+        wp.call.return_value = wp_post
+        field = {'id': '42', 'key': 'google_plus_content_hash',
+                 'value': 'new'}
+
+        # The crawl finds the field's id.
+        record = WordPressPostIndex([wp_post]).get('z12a')
+        self.assertEqual('42', record.hash_field_id)
+        self.assertEqual(field, content_hash_field(wp, record, 'new'))
+        self.assertFalse(wp.call.called)
+
+        # A post created since has to be looked at.
+        self.assertEqual(field, content_hash_field(
+            wp, SyncRecord('1', None, 'old'), 'new'))
+        self.assertEqual(1, wp.call.call_count)
+
+        # A post without a hash doesn't have the field at all.
+        self.assertEqual(
+            {'key': 'google_plus_content_hash', 'value': 'new'},
+            content_hash_field(wp, SyncRecord('1', None, None), 'new'))
+        self.assertEqual(1, wp.call.call_count)
+
+
+class TestSyncState(TestGooglePost):
+    def test_record_and_load(self):
+        from plus import SyncState, SyncRecord, WordPressPostIndex
+        state = SyncState(':memory:')
+        self.assertEqual(0, state.count())
+        self.assertFalse(state.get('z12a'))
+
+        record = SyncRecord(u'4', u'2012-08-22T06:55:57+00:00', u'abc')
+        state.record('z12a', record)
+        self.assertEqual(record, state.get('z12a'))
+
+        index = state.load(WordPressPostIndex())
+        self.assertEqual(record, index.get('z12a'))
+
+    def test_rebuild(self):
+        from plus import SyncState, SyncRecord, WordPressPostIndex
+        state = SyncState(':memory:')
+        state.record('z12old', SyncRecord(u'1', None, u'abc'))
+
+        index = WordPressPostIndex()
+        index.add('z12a', SyncRecord(u'2', None, u'def'))
+        state.rebuild(index)
+
+        self.assertEqual(1, state.count())
+        self.assertFalse(state.get('z12old'))
+        self.assertEqual(u'2', state.get('z12a').post_id)
+
+    def test_old_state(self):
+        import shutil
+        import sqlite3
+        import tempfile
+        from plus import SyncState, SyncRecord
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'plus.db')
+            db = sqlite3.connect(filename)
+            db.execute('CREATE TABLE activities (activity_id TEXT PRIMARY '
+                       'KEY, post_id TEXT NOT NULL, updated TEXT, '
+                       'content_hash TEXT)')
+            db.execute("INSERT INTO activities VALUES ('z12a', '1', NULL, "
+                       "'abc')")
+            db.commit()
+            db.close()
+
+            state = SyncState(filename)
+            self.assertEqual(SyncRecord(u'1', None, u'abc'), state.get('z12a'))
+            state.record('z12a', SyncRecord(u'1', None, u'def', u'42'))
+            self.assertEqual(u'42', state.get('z12a').hash_field_id)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_watermark(self):
+        from plus import SyncState, date_parse
+        state = SyncState(':memory:')
+        self.assertEqual(None, state.watermark())
+
+        when = date_parse('2012-08-22T06:55:57.000Z')
+        state.set_watermark(when)
+        self.assertEqual(when, state.watermark())
+
+
+class TestWordPressPublisher(TestGooglePost):
+    def publisher(self, multicall_results, batch_size=3,
+                  supported_methods=('wp.newPost', 'system.multicall')):
+        from plus import WordPressPublisher
+        wp = MagicMock()
+        wp.supported_methods = supported_methods
+        wp.server.system.multicall.side_effect = multicall_results
+        wp.call.return_value = 'single'
+        return wp, WordPressPublisher(wp, batch_size)
+
+    def calls(self, publisher, n):
+        from wordpress_xmlrpc.methods import posts
+        results = []
+        for i in range(n):
+            publisher.call(posts.DeletePost(i), results.append)
+        return results
+
+    def test_batch(self):
+        wp, publisher = self.publisher([[['1'], ['2'], ['3']]])
+        results = self.calls(publisher, 3)
+
+        self.assertEqual(['1', '2', '3'], results)
+        self.assertEqual(1, publisher.round_trips)
+        self.assertEqual(3, publisher.calls)
+        self.assertFalse(wp.call.called)
+
+    def test_flush(self):
+        wp, publisher = self.publisher([[['1'], ['2']]])
+        results = self.calls(publisher, 2)
+        self.assertEqual([], results)
+
+        publisher.flush()
+        self.assertEqual(['1', '2'], results)
+
+    def test_fault_in_batch(self):
+        fault = {'faultCode': 500, 'faultString': 'Oops'}
+        wp, publisher = self.publisher([[['1'], fault, ['3']]])
+        results = self.calls(publisher, 3)
+
+        self.assertEqual(['1', 'single', '3'], results)
+        self.assertEqual(1, wp.call.call_count)
+        self.assertEqual(2, publisher.round_trips)
+
+    def test_batch_refused(self):
+        import errno
+        import socket
+        import xmlrpclib
+        for error in [
+                socket.error(errno.ECONNREFUSED, 'Connection refused'),
+                xmlrpclib.Fault(-32601, 'server error. requested method '
+                                'system.multicall does not exist.')]:
+            wp, publisher = self.publisher(error)
+            results = self.calls(publisher, 3)
+
+            self.assertEqual(['single'] * 3, results)
+            self.assertEqual(3, wp.call.call_count)
+
+    def test_batch_failed(self):
+        import socket
+        import xmlrpclib
+        # The server may have made the calls, so they aren't resent.
+        for error in [
+                socket.timeout('timed out'),
+                xmlrpclib.ProtocolError(
+                    'blog.example.com/xmlrpc.php', 504, 'Gateway Timeout',
+                    {})]:
+            wp, publisher = self.publisher(error)
+            self.assertRaises(type(error), self.calls, publisher, 3)
+            self.assertFalse(wp.call.called)
+
+    def test_no_multicall(self):
+        wp, publisher = self.publisher(
+            [], supported_methods=('wp.newPost',))
+
+        self.assertEqual(['single'], self.calls(publisher, 1))
+        self.assertFalse(wp.server.system.multicall.called)
+
+
+class TestConcurrentPublisher(TestGooglePost):
+    def test_batches(self):
+        from plus import ConcurrentPublisher
+        from wordpress_xmlrpc.methods import posts
+        self.active = self.most_active = 0
+        lock = threading.Lock()
+
+        def multicall(calls):
+            with lock:
+                self.active += 1
+                self.most_active = max(self.most_active, self.active)
+            # Make the first batches the slowest to come back.
+            time.sleep(0.2 - 0.02 * calls[0]['params'][-1])
+            with lock:
+                self.active -= 1
+            return [[call['params'][-1]] for call in calls]
+
+        wp = MagicMock()
+        wp.supported_methods = ('system.multicall',)
+        wp.server.system.multicall.side_effect = multicall
+        publisher = ConcurrentPublisher(wp, batch_size=2, connections=3)
+
+        results = []
+        for i in range(10):
+            publisher.call(posts.DeletePost(i), results.append)
+        publisher.flush()
+
+        self.assertEqual(range(10), results)
+        self.assertEqual((10, 5), (publisher.calls, publisher.round_trips))
+        self.assertEqual(3, self.most_active)
+
+
+class TestTimings(TestGooglePost):
+    def test_histogram(self):
+        from plus import Timings
+        timings = Timings()
+        for seconds in [0.0005, 0.005, 0.005, 20]:
+            timings.add('a', seconds)
+        with timings.time('b'):
+            pass
+
+        count, total, slowest, histogram = timings.stats['a']
+        self.assertEqual((4, 20), (count, slowest))
+        self.assertAlmostEqual(20.0105, total)
+        self.assertEqual([1, 2, 0, 0, 0, 1], histogram)
+        self.assertEqual(1, timings.stats['b'][0])
+
+        summary = timings.summary()
+        self.assertEqual(3, len(summary))
+        self.assertTrue(summary[1].startswith('a '))
+
+    def test_trace(self):
+        import tempfile
+        from plus import Timings
+        timings = Timings()
+        timings.add('lookup', 1, 'untraced')
+        timings.tracing = True
+        timings.add('lookup', 0.5, 'slow')
+        timings.add('render.text', 1, 'slow')
+        timings.add('embed', 0.1, u'http://\xe9')
+
+        trace = tempfile.NamedTemporaryFile()
+        timings.write_trace(trace.name)
+        lines = open(trace.name).read().splitlines()
+        self.assertEqual(
+            ['1.5000\tslow\tlookup=0.5000 render.text=1.0000',
+             '0.1000\thttp://\xc3\xa9\tembed=0.1000'], lines[1:])
+
+    def test_sync_timings(self):
+        import plus
+        items = [self.load_data(name) for name in [
+            'sample_video_youtube_with_content.json',
+            'sample_pic_without_content.json']]
+        plus.ActivitySync(plus.WordPressPostIndex()).run(iter(items))
+
+        for name in ['lookup', 'title', 'render.video', 'render.photo']:
+            self.assertTrue(name in plus.TIMINGS.stats, name)
+
+    def test_profiler(self):
+        import pstats
+        import tempfile
+        from plus import Profiler, bounded
+        profiler = Profiler()
+        self.assertTrue(profiler.wrap(sorted) is sorted)
+
+        profiler.enabled = True
+
+        def count():
+            return list(bounded(iter(range(10)), 2))
+        self.assertEqual(range(10), profiler.wrap(count)())
+
+        dump = tempfile.NamedTemporaryFile()
+        profiler.dump(dump.name)
+        functions = [f[2] for f in pstats.Stats(dump.name).stats]
+        self.assertTrue('count' in functions)
+
+
+class TestStartup(TestGooglePost):
+    DOCUMENT = json.dumps({
+        'kind': 'discovery#restDescription',
+        'name': 'plus',
+        'version': 'v1',
+        'rootUrl': 'https://www.googleapis.com/',
+        'servicePath': 'plus/v1/',
+        'resources': {'activities': {'methods': {'list': {
+            'id': 'plus.activities.list',
+            'path': 'people/{userId}/activities/{collection}',
+            'httpMethod': 'GET',
+            'parameters': {
+                'userId': {'type': 'string', 'required': True,
+                           'location': 'path'},
+                'collection': {'type': 'string', 'required': True,
+                               'location': 'path'},
+            },
+            'parameterOrder': ['userId', 'collection'],
+        }}}},
+    })
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        TestGooglePost.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.filename = os.path.join(self.directory, 'discovery.json')
+
+    def http(self, status=200, content=DOCUMENT):
+        import httplib2
+        http = Mock()
+        http.request.return_value = (
+            httplib2.Response({'status': status}), content)
+        return http
+
+    def test_lazy_imports(self):
+        import sys
+        lazy = ['nltk', 'html2text', 'jinja2', 'apiclient.discovery',
+                'googleapiclient.discovery']
+        for name in lazy:
+            sys.modules.pop(name, None)
+        import plus
+        for name in lazy:
+            self.assertFalse(name in sys.modules, name)
+        self.assertTrue(plus.FLOW is None)
+
+    def test_discovery_cache(self):
+        from plus import discovery_document
+        http = self.http()
+        self.assertEqual(self.DOCUMENT, discovery_document(
+            http, 'plus', 'v1', self.filename, 60))
+        self.assertEqual(
+            'https://www.googleapis.com/discovery/v1/apis/plus/v1/rest',
+            http.request.call_args[0][0])
+
+        # Fresh enough to not fetch it again.
+        self.assertEqual(self.DOCUMENT, discovery_document(
+            http, 'plus', 'v1', self.filename, 60))
+        self.assertEqual(1, http.request.call_count)
+
+        # Too old, so it is fetched again.
+        http = self.http(content=self.DOCUMENT.replace('v1', 'v2'))
+        self.assertTrue('v2' in discovery_document(
+            http, 'plus', 'v1', self.filename, 0))
+        self.assertTrue('v2' in open(self.filename).read())
+
+    def test_discovery_failure(self):
+        from plus import HttpError
+        from plus import discovery_document
+        self.assertRaises(
+            HttpError, discovery_document,
+            self.http(503, 'Backend Error'), 'plus', 'v1', self.filename)
+
+        discovery_document(self.http(), 'plus', 'v1', self.filename)
+        self.assertEqual(self.DOCUMENT, discovery_document(
+            self.http(503, 'Backend Error'), 'plus', 'v1', self.filename))
+
+    def test_build_service(self):
+        import plus
+        plus.FLAGS.discovery_cache = self.filename
+        try:
+            service = plus.build_service(self.http())
+        finally:
+            plus.FLAGS.discovery_cache = 'plus_discovery.json'
+        request = service.activities().list(userId='me', collection='public')
+        self.assertEqual(
+            '/plus/v1/people/me/activities/public',
+            urlparse.urlsplit(request.uri).path)
+
+
+class TestTakeout(TestGooglePost):
+    def setUp(self):
+        import shutil
+        import tempfile
+        TestGooglePost.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.posts = self.load_data('takeout_posts.json')
+
+    def write_posts(self, root):
+        """Write the posts as a Takeout archive does, one file each."""
+        posts = os.path.join(root, 'Takeout', 'Google+ Stream', 'Posts')
+        os.makedirs(posts)
+        for i, post in enumerate(self.posts):
+            file_ = open(os.path.join(posts, '%d.json' % i), 'w')
+            json.dump(post, file_)
+            file_.close()
+        # Not a post, and not in Posts.
+        file_ = open(os.path.join(root, 'Takeout', 'archive.json'), 'w')
+        json.dump({'kind': 'archive'}, file_)
+        file_.close()
+
+    def test_iter_json(self):
+        from StringIO import StringIO
+        from plus import iter_json
+        content = self.load_data('takeout_posts.json', type='raw')
+        for chunk_size in [1, 7, 64 * 1024]:
+            self.assertEqual(self.posts, list(
+                iter_json(StringIO(content), chunk_size)))
+
+        self.assertEqual(
+            [12345, {'a': [1]}, u'\xe9'],
+            list(iter_json(StringIO('[12345, {"a": [1]},"\xc3\xa9" ]'), 2)))
+        self.assertEqual([], list(iter_json(StringIO(' [ ] '))))
+
+        # Numbers split after their '.' or 'e' by every chunk size.
+        numbers = '[12.25, -1e+3,0.5e-2 ,7]'
+        for chunk_size in range(1, len(numbers) + 1):
+            self.assertEqual(
+                [12.25, -1000.0, 0.005, 7],
+                list(iter_json(StringIO(numbers), chunk_size)))
+            self.assertEqual(
+                [12.25], list(iter_json(StringIO('12.25'), chunk_size)))
+        self.assertEqual(
+            [{'a': 1}], list(iter_json(StringIO('{"a": 1}\n'), 3)))
+        self.assertRaises(
+            ValueError, list, iter_json(StringIO('[{"a": 1}, {"b"'), 4))
+        self.assertRaises(
+            ValueError, list, iter_json(StringIO('[{"a": 1}'), 4))
+
+    def test_activities(self):
+        from plus import GooglePlusPost, build_post, takeout_activity
+        activities = [takeout_activity(post) for post in self.posts]
+
+        self.assertEqual(
+            ['Ab1LinkPost', 'Ab2PhotoPost', 'Ab3AlbumPost', 'Ab4Reshare',
+             'Ab5TextPost'], [a['id'] for a in activities])
+        self.assertEqual(
+            ['web page', 'photo', 'gallery', 'text', 'text'],
+            [GooglePlusPost.type(a['object']) for a in activities])
+
+        link, photo = activities[:2]
+        self.assertEqual('2012-09-03T05:54:11.000Z', link['published'])
+        self.assertEqual('2012-09-03T06:10:02.000Z', link['updated'])
+        self.assertEqual('2012-08-30T00:00:00.000Z', photo['published'])
+        self.assertEqual(photo['published'], photo['updated'])
+        self.assertEqual('Tim Ansell', photo['actor']['displayName'])
+        self.assertEqual(1, photo['object']['replies']['totalItems'])
+
+        reshare = build_post(activities[3])
+        self.assertEqual(
+            'Why every project needs a test suite. - Reshared text from '
+            'Someone Else', reshare.title)
+        self.assertEqual('Worth a read.', reshare.content)
+
+        # Activities from the API are used as they are.
+        sample = self.load_data('sample_pic_share.json')
+        self.assertTrue(takeout_activity(sample) is sample)
+
+    def test_directory(self):
+        from plus import takeout_activities
+        self.write_posts(self.directory)
+        self.assertEqual(
+            [post['resourceName'].rpartition('/')[2] for post in self.posts],
+            [a['id'] for a in takeout_activities(self.directory)])
+
+    def test_zip(self):
+        import zipfile
+        from plus import takeout_activities
+        self.write_posts(self.directory)
+        filename = os.path.join(self.directory, 'takeout.zip')
+        archive = zipfile.ZipFile(filename, 'w')
+        for directory, _, filenames in os.walk(
+                os.path.join(self.directory, 'Takeout')):
+            for name in filenames:
+                path = os.path.join(directory, name)
+                archive.write(path, os.path.relpath(path, self.directory))
+        archive.close()
+
+        self.assertEqual(
+            sorted(post['resourceName'].rpartition('/')[2]
+                   for post in self.posts),
+            sorted(a['id'] for a in takeout_activities(filename)))
+
+    def test_single_file(self):
+        from plus import takeout_activities
+        filename = os.path.join(os.path.dirname(__file__), 'test_documents',
+                                'takeout_posts.json')
+        self.assertEqual(5, len(list(takeout_activities(filename))))
+
+
+class TestTemplates(TestGooglePost):
+    def setUp(self):
+        import shutil
+        import tempfile
+        TestGooglePost.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_any_directory(self):
+        from plus import render_tmpl
+        cwd = os.getcwd()
+        os.chdir(self.directory)
+        try:
+            html = render_tmpl('geocode.html', {
+                'coordinates': '1,2', 'address': '', 'placename': 'Home'})
+        finally:
+            os.chdir(cwd)
+        self.assertTrue('ll=1,2' in html)
+        self.assertTrue('Home' in html)
+
+    def test_bytecode_cache(self):
+        import plus
+        cache = os.path.join(self.directory, 'cache')
+        plus.FLAGS.template_cache = cache
+        try:
+            plus.render_tmpl('gallery.html', {'gid': '1', 'attachments': []})
+            self.assertEqual(1, len(os.listdir(cache)))
+
+            # Another run loads the template from the cache.
+            plus.ENV = None
+            plus.render_tmpl('gallery.html', {'gid': '1', 'attachments': []})
+            self.assertEqual(1, len(os.listdir(cache)))
+        finally:
+            plus.FLAGS.template_cache = None
+
+    def test_loaded_once(self):
+        import plus
+        plus.FLAGS.template_cache = ''
+        try:
+            env = plus.environment()
+            self.assertTrue(env.bytecode_cache is None)
+            self.assertFalse(env.auto_reload)
+            self.assertTrue(
+                env.get_template('webpage.html') is
+                env.get_template('webpage.html'))
+        finally:
+            plus.FLAGS.template_cache = None
+
+
+class TestCommentSync(TestGooglePost):
+    def test_own_http(self):
+        from plus import CommentSync
+        service = MagicMock()
+        batch = service.new_batch_http_request.return_value
+        http = object()
+        sync = CommentSync(MagicMock(), service=service, http=http)
+        sync.add({'id': 'z12a', 'object': {'replies': {'totalItems': 1}}},
+                 '4', True)
+        sync.flush()
+        batch.execute.assert_called_once_with(http=http)
+
+
+class TestWXRPublisher(TestGooglePost):
+    WP = '{http://wordpress.org/export/1.2/}'
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        TestGooglePost.setUp(self)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def post(self, title, content=u'<p>Hello</p>'):
+        from plus import RenderedPost, date_parse
+        post = RenderedPost(
+            'gid', 'text', title, content, True,
+            date_parse('2012-09-03T05:54:11.573+10:00'),
+            date_parse('2012-09-03T05:54:11.573+10:00')).toWordPressPost()
+        post.custom_fields = [
+            {'key': 'google_plus_activity_id', 'value': title}]
+        return post
+
+    def comment(self, content):
+        from plus import GooglePlusComment
+        return GooglePlusComment({
+            'id': 'c1',
+            'published': '2012-09-04T00:00:00.000Z',
+            'actor': {'displayName': 'Bob', 'id': '2',
+                      'url': 'https://plus.google.com/2',
+                      'image': {'url': ''}},
+            'object': {'content': content},
+        }).toWordPressComment()
+
+    def items(self, filename):
+        import xml.etree.ElementTree as ElementTree
+        return ElementTree.parse(filename).find('channel').findall('item')
+
+    def test_posts(self):
+        from wordpress_xmlrpc.methods import posts, comments
+        from plus import WXRPublisher
+        filename = os.path.join(self.directory, 'export.xml')
+        publisher = WXRPublisher(
+            filename, site_url='http://blog.example.com/', author='admin')
+
+        post_ids = []
+        publisher.call(posts.NewPost(self.post(u'Caf\xe9')), post_ids.append)
+        publisher.call(comments.NewComment(
+            post_ids[0], self.comment(u'Nice ]]> post\x0c')))
+        publisher.call(posts.NewPost(self.post(u'Second')), post_ids.append)
+        publisher.close()
+        self.assertEqual(['1', '2'], post_ids)
+        self.assertRaises(
+            ValueError, publisher.call, posts.EditPost(1, self.post('x')))
+
+        first, second = self.items(filename)
+        wp = self.WP
+        self.assertEqual(u'Caf\xe9', first.find('title').text)
+        self.assertEqual('Sun, 02 Sep 2012 19:54:11 +0000',
+                         first.find('pubDate').text)
+        self.assertEqual(
+            '2012-09-02 19:54:11', first.find(wp + 'post_date_gmt').text)
+        # Left for the importer to work out in the blog's timezone.
+        self.assertEqual(None, first.find(wp + 'post_date').text)
+        self.assertEqual(
+            u'<p>Hello</p>',
+            first.find('{http://purl.org/rss/1.0/modules/content/}encoded')
+            .text)
+        self.assertEqual(
+            [('google_plus_activity_id', u'Caf\xe9')],
+            [(meta.find(wp + 'meta_key').text,
+              meta.find(wp + 'meta_value').text)
+             for meta in first.findall(wp + 'postmeta')])
+
+        comment, = first.findall(wp + 'comment')
+        self.assertEqual('Bob', comment.find(wp + 'comment_author').text)
+        self.assertEqual(
+            'Nice ]]> post', comment.find(wp + 'comment_content').text)
+        self.assertEqual(
+            '2012-09-04 00:00:00', comment.find(wp + 'comment_date').text)
+        self.assertEqual([], second.findall(wp + 'comment'))
+
+    def test_timezone(self):
+        from dateutil.tz import gettz
+        from wordpress_xmlrpc.methods import posts, comments
+        from plus import WXRPublisher
+        filename = os.path.join(self.directory, 'export.xml')
+        publisher = WXRPublisher(
+            filename, timezone=gettz('Australia/Sydney'))
+        publisher.call(posts.NewPost(self.post(u'Title')))
+        publisher.call(comments.NewComment('1', self.comment(u'Nice')))
+        publisher.close()
+
+        item, = self.items(filename)
+        wp = self.WP
+        self.assertEqual(
+            '2012-09-03 05:54:11', item.find(wp + 'post_date').text)
+        self.assertEqual(
+            '2012-09-02 19:54:11', item.find(wp + 'post_date_gmt').text)
+        comment, = item.findall(wp + 'comment')
+        self.assertEqual(
+            '2012-09-04 10:00:00', comment.find(wp + 'comment_date').text)
+        self.assertEqual(
+            '2012-09-04 00:00:00', comment.find(wp + 'comment_date_gmt').text)
+
+    def test_comment_without_post(self):
+        from wordpress_xmlrpc.methods import comments
+        from plus import WXRPublisher
+        publisher = WXRPublisher(os.path.join(self.directory, 'export.xml'))
+        self.assertRaises(ValueError, publisher.call, comments.NewComment(
+            '1', self.comment('Hello')))
+
+    def test_split(self):
+        from wordpress_xmlrpc.methods import posts
+        from plus import WXRPublisher
+        publisher = WXRPublisher(
+            os.path.join(self.directory, 'export.xml'), max_bytes=4096)
+        for i in range(20):
+            publisher.call(posts.NewPost(self.post('Post %d' % i)))
+        publisher.close()
+
+        self.assertTrue(len(publisher.filenames) > 2)
+        self.assertEqual(
+            sorted(publisher.filenames),
+            sorted(os.path.join(self.directory, name)
+                   for name in os.listdir(self.directory)))
+        titles = []
+        for filename in publisher.filenames:
+            self.assertTrue(os.path.getsize(filename) <= 4096)
+            titles.extend(
+                item.find('title').text for item in self.items(filename))
+        self.assertEqual(['Post %d' % i for i in range(20)], titles)
+
+    def test_empty(self):
+        from plus import WXRPublisher
+        filename = os.path.join(self.directory, 'export.xml')
+        publisher = WXRPublisher(filename)
+        publisher.close()
+        self.assertEqual([], self.items(filename))
+
+
+class TestMetrics(TestGooglePost):
+    def metrics(self):
+        from plus import Metric, Timings, timings_metrics
+        timings = Timings()
+        for seconds in [0.0005, 0.005, 0.005, 20]:
+            timings.add('embed', seconds)
+        return [
+            Metric('posts_total', 'counter', 'Posts.', {'action': 'created'},
+                   3),
+            Metric('posts_total', 'counter', 'Posts.', {'action': 'a"\\b'},
+                   0),
+        ] + timings_metrics(timings)
+
+    def test_prometheus(self):
+        from plus import format_prometheus
+        lines = format_prometheus(self.metrics()).splitlines()
+        self.assertEqual([
+            '# HELP plus_posts_total Posts.',
+            '# TYPE plus_posts_total counter',
+            'plus_posts_total{action="created"} 3',
+            'plus_posts_total{action="a\\"\\\\b"} 0',
+            '# HELP plus_latency_seconds How long each part of the sync took.',
+            '# TYPE plus_latency_seconds histogram',
+            'plus_latency_seconds_bucket{le="0.001",stage="embed"} 1',
+            'plus_latency_seconds_bucket{le="0.01",stage="embed"} 3',
+            'plus_latency_seconds_bucket{le="0.1",stage="embed"} 3',
+            'plus_latency_seconds_bucket{le="1",stage="embed"} 3',
+            'plus_latency_seconds_bucket{le="10",stage="embed"} 3',
+            'plus_latency_seconds_bucket{le="+Inf",stage="embed"} 4',
+            'plus_latency_seconds_sum{stage="embed"} 20.0105',
+            'plus_latency_seconds_count{stage="embed"} 4',
+        ], lines)
+
+    def test_json(self):
+        from plus import format_json
+        metrics = json.loads(format_json(self.metrics()))['metrics']
+        self.assertEqual(3, metrics[0]['value'])
+        self.assertEqual(
+            ['+Inf', 4], metrics[2]['value']['buckets'][-1])
+
+    def test_writer(self):
+        import shutil
+        import tempfile
+        from plus import Metric, MetricsWriter
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'plus.prom')
+            counter = [0]
+
+            def collect():
+                counter[0] += 1
+                return [Metric('runs', 'gauge', 'Runs.', {}, counter[0])]
+
+            writer = MetricsWriter(filename, collect, interval=0.01,
+                                   labels={'user': '123'})
+            writer.start()
+            time.sleep(0.1)
+            writer.stop()
+
+            self.assertTrue(writer.writes > 1)
+            self.assertEqual(['plus.prom'], os.listdir(directory))
+            self.assertEqual(
+                'plus_runs{user="123"} %d' % counter[0],
+                open(filename).read().splitlines()[-1])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_sync_metrics(self):
+        import plus
+        items = [self.load_data(name) for name in [
+            'sample_video_youtube_with_content.json',
+            'sample_pic_without_content.json']]
+        sync = plus.ActivitySync(plus.WordPressPostIndex())
+        sync.run(iter(items))
+
+        metrics = dict(
+            ((m.name, tuple(sorted(m.labels.items()))), m.value)
+            for m in plus.sync_metrics(sync))
+        self.assertEqual(2, metrics['activities_seen_total', ()])
+        self.assertEqual(
+            1, metrics['posts_total', (('action', 'skipped'),)])
+        self.assertTrue(('latency_seconds', (('stage', 'lookup'),))
+                        in metrics)
+
+
+class TestBounded(TestGooglePost):
+    def test_bounded(self):
+        from plus import bounded
+        self.assertEqual(range(50), list(bounded(iter(range(50)), 5)))
+
+    def test_exception(self):
+        from plus import bounded
+
+        def broken():
+            yield 1
+            raise ValueError('Oops')
+
+        results = bounded(broken(), 5)
+        self.assertEqual(1, next(results))
+        self.assertRaises(ValueError, next, results)
+
+
+class TestActivitySync(TestGooglePost):
+    SAMPLES = [
+        'sample_video_youtube_with_content.json',
+        'sample_video_vimeo_with_content.json',
+        'sample_video_youtube.json',
+    ]
+
+    def sync(self, index=None):
+        from plus import ActivitySync, WordPressPostIndex
+        self.publisher = MagicMock()
+        self.publisher.call.side_effect = \
+            lambda method, callback: callback('42')
+        return ActivitySync(index or WordPressPostIndex(), self.publisher)
+
+    def test_new_posts(self):
+        sync = self.sync()
+        items = [self.load_data(name) for name in self.SAMPLES]
+        sync.run(iter(items))
+
+        # The last sample has no title, so isn't published.
+        methods = [c[0][0] for c in self.publisher.call.call_args_list]
+        self.assertEqual(
+            ['wp.newPost', 'wp.newPost'],
+            [method.method_name for method in methods])
+        self.assertEqual(
+            'http://www.youtube.com/watch?v=YcFHeTaS9ew',
+            methods[0].content.content)
+        self.assertEqual('42', sync.index.get(items[0]['id']).post_id)
+        self.assertTrue(self.publisher.flush.called)
+
+    def test_unchanged(self):
+        sync = self.sync()
+        items = [self.load_data(name) for name in self.SAMPLES]
+        sync.run(iter(items))
+
+        sync = self.sync(sync.index)
+        sync.run(iter(items))
+        self.assertFalse(self.publisher.call.called)
+
+    def published(self, items):
+        sync = self.sync()
+        sync.run(iter(items))
+        return [c[0][0].content.content
+                for c in self.publisher.call.call_args_list]
+
+    def test_workers(self):
+        import plus
+        items = [self.load_data(name) for name in
+                 ['sample_multi_img.json'] + self.SAMPLES]
+        embeds = self.load_data('embedly_multiple_photos.json')
+
+        self.mock_embedly(embeds)
+        expected = self.published(items)
+
+        self.mock_embedly(embeds)
+        plus.FLAGS.workers = 2
+        try:
+            self.assertEqual(expected, self.published(items))
+        finally:
+            plus.FLAGS.workers = 0
+        # The oEmbed lookups all happen in this process.
+        self.assertEqual(
+            len(embeds), plus.OEMBED_CONSUMER.embed.call_count)
+
+    def test_concurrent(self):
+        from plus import ConcurrentActivitySync, WordPressPostIndex
+        items = [self.load_data(name) for name in
+                 ['sample_multi_img.json'] + self.SAMPLES]
+        embeds = self.load_data('embedly_multiple_photos.json')
+
+        self.mock_embedly(embeds)
+        expected = self.published(items)
+
+        self.mock_embedly(embeds)
+        sync = ConcurrentActivitySync(
+            WordPressPostIndex(), self.publisher, activity_workers=3)
+        self.publisher.reset_mock()
+        sync.run(iter(items))
+        self.assertEqual(expected, [
+            c[0][0].content.content
+            for c in self.publisher.call.call_args_list])
+
+    def test_embed_urls(self):
+        from plus import activity_embed_urls
+        self.assertEqual(
+            2, len(activity_embed_urls(
+                self.load_data('sample_multi_img.json'))))
+        self.assertEqual(
+            [], activity_embed_urls(self.load_data('sample_share.json')))
+        self.assertEqual(
+            [], activity_embed_urls(self.load_data(self.SAMPLES[0])))
+
+    def test_preloaded_embeds(self):
+        import plus
+        self.mock_embedly([])
+        plus.PRELOADED.embeds = {'http://a': {'title': 'A'}}
+        try:
+            self.assertEqual({'title': 'A'}, plus.embed_content('http://a'))
+
+            # Each thread only sees the embeds for the post it renders.
+            found = []
+            thread = threading.Thread(
+                target=lambda: found.append(plus.embed_cached('http://a')))
+            thread.start()
+            thread.join()
+            self.assertEqual([(False, None)], found)
+        finally:
+            plus.PRELOADED.embeds = {}
+        self.assertFalse(plus.OEMBED_CONSUMER.embed.called)
+
+    def test_render_worker_init(self):
+        import plus
+        timings = plus.TIMINGS
+        with timings._lock:
+            plus.render_worker_init()
+            self.assertFalse(plus.TIMINGS is timings)
+            plus.TIMINGS.add('render.text', 0.1)
+
+
+
+class TestFakes(TestGooglePost):
+    def setUp(self):
+        TestGooglePost.setUp(self)
+        self.config.WORDPRESS_XMLRPC_URI = 'http://blog.example.com/xmlrpc.php'
+        self.config.WORDPRESS_USERNAME = 'user'
+        self.config.WORDPRESS_PASSWORD = 'password'
+
+    def sync(self, service, connections, *flags):
+        import fakes
+        fakes.run(['plus.py', '--state_file=', '--embed_cache=',
+                   '--batch_size=5'] + list(flags), service, connections)
+        return connections.wordpress
+
+    def test_sync(self):
+        import fakes
+        service, connections = fakes.fake_services(page_size=5)
+        wordpress = self.sync(service, connections)
+
+        # Half the samples have no title or no content.
+        self.assertEqual(13, len(wordpress.posts))
+        self.assertEqual(
+            ['google_plus_activity_id', 'google_plus_content_hash'],
+            sorted(field['key'] for field in
+                   wordpress.posts['1']['custom_fields']))
+
+        # Syncing again finds nothing has changed.
+        new_posts = wordpress.calls['wp.newPost']
+        self.sync(service, connections)
+        self.assertEqual(new_posts, wordpress.calls['wp.newPost'])
+        self.assertFalse(wordpress.calls['wp.editPost'])
+
+    def test_state(self):
+        import shutil
+        import tempfile
+        import fakes
+        import plus
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'plus.db')
+            service, connections = fakes.fake_services(page_size=5)
+            wordpress = self.sync(
+                service, connections, '--state_file=' + filename)
+            self.assertEqual(13, plus.SyncState(filename).count())
+
+            # The second run loads the state instead of crawling Wordpress.
+            crawls = wordpress.calls['wp.getPosts']
+            self.sync(service, connections, '--state_file=' + filename)
+            self.assertEqual(crawls, wordpress.calls['wp.getPosts'])
+            self.assertEqual(13, wordpress.calls['wp.newPost'])
+
+            # A new state can be rebuilt from what is on Wordpress.
+            rebuilt = os.path.join(directory, 'rebuilt.db')
+            self.sync(service, connections, '--state_file=' + rebuilt,
+                      '--rebuild_state')
+            self.assertEqual(13, plus.SyncState(rebuilt).count())
+            self.assertEqual(13, wordpress.calls['wp.newPost'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_edit(self):
+        import shutil
+        import tempfile
+        import fakes
+        directory = tempfile.mkdtemp()
+        try:
+            state = '--state_file=' + os.path.join(directory, 'plus.db')
+            service, connections = fakes.fake_services(page_size=5)
+            wordpress = self.sync(service, connections, state)
+            activity_id = [
+                field['value'] for field in wordpress.posts['1'][
+                    'custom_fields']
+                if field['key'] == 'google_plus_activity_id'][0]
+            activity = [a for a in service.stream if a['id'] == activity_id][0]
+
+            for n in range(2):
+                activity['object']['content'] = 'Edited %d times' % (n + 1)
+                service.add([])
+                self.sync(service, connections, state)
+            self.assertEqual(2, wordpress.calls['wp.editPost'])
+
+            # Only the first edit has to look up the hash field's id.
+            self.assertEqual(1, wordpress.calls['wp.getPost'])
+            self.assertEqual(1, len([
+                field for field in wordpress.posts['1']['custom_fields']
+                if field['key'] == 'google_plus_content_hash']))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_incremental(self):
+        import shutil
+        import tempfile
+        import fakes
+        import plus
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'plus.db')
+            flags = ['--state_file=' + filename, '--incremental']
+            service, connections = fakes.fake_services(page_size=5)
+            self.sync(service, connections, *flags)
+            self.assertEqual(6, service.activity_pages)
+            self.assertTrue(plus.SyncState(filename).watermark())
+
+            # Everything after the first page is older than the watermark.
+            wordpress = self.sync(service, connections, *flags)
+            self.assertEqual(7, service.activity_pages)
+            self.assertEqual(13, wordpress.calls['wp.newPost'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_flaky(self):
+        import fakes
+        service, connections = fakes.fake_services(
+            copies=2, page_size=5, error_rate=0.2, seed=1)
+        wordpress = self.sync(
+            service, connections, '--concurrent', '--retries=20',
+            '--backoff=0.001', '--breaker_failures=0')
+
+        self.assertEqual(26, len(wordpress.posts))
+        self.assertTrue(connections.network.errors)
+
+    def test_synthetic_activities(self):
+        import fakes
+        from plus import GooglePlusPost
+        activities = fakes.synthetic_activities(
+            60, {'gallery': 1, 'text': 1, 'reshare': 1}, seed=3)
+
+        self.assertEqual(60, len(set(a['id'] for a in activities)))
+        self.assertEqual(
+            sorted(activities, key=lambda a: a['published'], reverse=True),
+            activities)
+
+        kinds = set()
+        for activity in activities:
+            if activity['object'].get('id'):
+                kinds.add('reshare')
+            else:
+                kinds.add(GooglePlusPost.type(activity['object']))
+        self.assertEqual(set(['gallery', 'text', 'reshare']), kinds)
+
+        # Nothing is shared between activities for the cache to hit.
+        urls = [att['url'] for a in activities
+                for att in a['object'].get('attachments', [])
+                if 'url' in att]
+        self.assertEqual(len(urls), len(set(urls)))
+
+        self.assertEqual(
+            activities, fakes.synthetic_activities(
+                60, {'gallery': 1, 'text': 1, 'reshare': 1}, seed=3))
+
+    def test_profile(self):
+        import pstats
+        import shutil
+        import tempfile
+        import fakes
+        directory = tempfile.mkdtemp()
+        try:
+            profile = os.path.join(directory, 'sync.prof')
+            service, connections = fakes.fake_services()
+            self.sync(service, connections, '--profile=' + profile)
+
+            functions = [f[2] for f in pstats.Stats(profile).stats]
+            self.assertTrue('render_activity' in functions)
+            trace = open(profile + '.trace').read()
+            self.assertTrue('render.gallery=' in trace)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_metrics(self):
+        import shutil
+        import tempfile
+        import fakes
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, 'plus.json')
+            service, connections = fakes.fake_services()
+            self.sync(service, connections, '--metrics_file=' + filename,
+                      '--metrics_format=json')
+
+            metrics = dict(
+                ((m['name'], m['labels'].get('action') or
+                  m['labels'].get('service')), m['value'])
+                for m in json.load(open(filename))['metrics'])
+            self.assertEqual(26, metrics['plus_activities_seen_total', None])
+            self.assertEqual(13, metrics['plus_posts_total', 'created'])
+            self.assertEqual(0, metrics['plus_posts_total', 'updated'])
+            self.assertTrue(metrics['plus_api_calls_total', 'Wordpress'])
+        finally:
+            shutil.rmtree(directory)
+
+    def new_activity(self, activity_id):
+        import fakes
+        activity = fakes.load_fixture('sample_video_youtube_with_content.json')
+        activity['id'] = activity_id
+        activity['published'] = activity['updated'] = (
+            '2013-01-01T00:00:00.000Z')
+        return activity
+
+    def test_etag(self):
+        import fakes
+        import plus
+        service, _ = fakes.fake_services(page_size=5)
+        sync = plus.ActivitySync(plus.WordPressPostIndex())
+        self.assertEqual(26, len(list(sync.fetch(service, 'me'))))
+        etag = sync.etag
+        self.assertTrue(etag)
+
+        # The stream hasn't changed, so the first page is a 304.
+        self.assertEqual([], list(sync.fetch(service, 'me')))
+        self.assertEqual(etag, sync.etag)
+
+        service.add([self.new_activity('new')])
+        sync.watermark = sync.newest = plus.date_parse(
+            '2012-12-01T00:00:00.000Z')
+        self.assertEqual(['new'], [
+            item['id'] for item in sync.select(sync.fetch(service, 'me'))])
+        self.assertNotEqual(etag, sync.etag)
+
+    def test_watch(self):
+        import signal
+        import fakes
+        import plus
+        service, connections = fakes.fake_services(page_size=5)
+        run = plus.Watcher.run
+        handlers = []
+        waits = []
+
+        def scripted_run(watcher):
+            handlers.append(signal.getsignal(signal.SIGTERM))
+
+            def wait(seconds):
+                waits.append(seconds)
+                if len(waits) == 1:
+                    service.add([self.new_activity('new')])
+                elif len(waits) == 3:
+                    # As if the server ignored If-None-Match.
+                    watcher.sync.etag = None
+                elif len(waits) == 4:
+                    watcher.stop()
+            watcher._stopped.wait = wait
+            run(watcher)
+
+        handler = signal.getsignal(signal.SIGTERM)
+        with patch.object(plus.Watcher, 'run', scripted_run):
+            wordpress = self.sync(
+                service, connections, '--watch', '--watch_interval=1',
+                '--watch_max_interval=4')
+
+        # Only the polls which found new activities reset the wait.
+        self.assertEqual([1, 1, 2, 4], waits)
+        self.assertEqual(14, len(wordpress.posts))
+        self.assertEqual(14, wordpress.calls['wp.newPost'])
+
+        self.assertNotEqual(handler, handlers[0])
+        self.assertEqual(handler, signal.getsignal(signal.SIGTERM))
+
+    def test_watch_interval(self):
+        import plus
+        watcher = plus.Watcher(Mock(), None, 'me', 1, 4)
+        found = [True, False, False, False, True]
+        watcher.poll = lambda: found.pop(0)
+        waits = []
+
+        def wait(seconds):
+            waits.append(seconds)
+            if not found:
+                watcher.stop()
+        watcher._stopped.wait = wait
+        watcher.run()
+        self.assertEqual([1, 2, 4, 4, 1], waits)
+
+    def test_takeout(self):
+        import shutil
+        import tempfile
+        import fakes
+        takeout = '--takeout=' + os.path.join(
+            os.path.dirname(__file__), 'test_documents', 'takeout_posts.json')
+        _, connections = fakes.fake_services()
+        wordpress = self.sync(None, connections, takeout)
+
+        self.assertEqual(5, len(wordpress.posts))
+        self.assertEqual(
+            ['Ab1LinkPost', 'Ab2PhotoPost', 'Ab3AlbumPost', 'Ab4Reshare',
+             'Ab5TextPost'],
+            sorted(field['value'] for post in wordpress.posts.values()
+                   for field in post['custom_fields']
+                   if field['key'] == 'google_plus_activity_id'))
+        # The comments in the archive are only synced with --comments.
+        self.assertEqual({}, wordpress.comments)
+
+        directory = tempfile.mkdtemp()
+        try:
+            _, connections = fakes.fake_services()
+            wordpress = self.sync(
+                None, connections, takeout, '--comments',
+                '--state_file=' + os.path.join(directory, 'plus.db'))
+        finally:
+            shutil.rmtree(directory)
+        self.assertEqual(
+            ['Lovely!'],
+            [c['content'] for c in wordpress.comments.values()])
+
+    def test_wxr(self):
+        import shutil
+        import tempfile
+        import xml.etree.ElementTree as ElementTree
+        import fakes
+        directory = tempfile.mkdtemp()
+        try:
+            _, connections = fakes.fake_services()
+            wordpress = self.sync(
+                None, connections, '--takeout=' + os.path.join(
+                    os.path.dirname(__file__), 'test_documents',
+                    'takeout_posts.json'),
+                '--wxr=' + os.path.join(directory, 'export.xml'))
+
+            self.assertFalse(wordpress.requests)
+            self.assertEqual(['export-001.xml'], os.listdir(directory))
+            channel = ElementTree.parse(
+                os.path.join(directory, 'export-001.xml')).find('channel')
+            self.assertEqual(
+                'http://blog.example.com/', channel.find('link').text)
+            self.assertEqual(5, len(channel.findall('item')))
+        finally:
+            shutil.rmtree(directory)
+
+    def new_comment(self, comment_id):
+        return {
+            'id': comment_id,
+            'published': '2013-01-02T00:00:00.000Z',
+            'actor': {
+                'id': '2',
+                'displayName': 'Bob',
+                'url': 'https://plus.google.com/2',
+                'image': {'url': 'https://example.com/bob.jpg'},
+            },
+            'object': {'content': 'Comment %s' % comment_id},
+        }
+
+    def test_comments(self):
+        import shutil
+        import tempfile
+        import fakes
+        directory = tempfile.mkdtemp()
+        try:
+            flags = ['--state_file=' + os.path.join(directory, 'plus.db'),
+                     '--comments']
+            service, connections = fakes.fake_services(page_size=2)
+            service.add([self.new_activity('new')])
+            service.add_comments(
+                'new', [self.new_comment(str(i)) for i in range(5)])
+            wordpress = self.sync(service, connections, *flags)
+
+            # Three pages of comments, one batch request for each.
+            self.assertEqual(
+                ['Comment %d' % i for i in range(5)],
+                [wordpress.comments[comment_id]['content']
+                 for comment_id in sorted(wordpress.comments, key=int)])
+            self.assertEqual(3, service.batches)
+            self.assertEqual(3, service.comment_pages)
+
+            # Nothing new, so nothing is fetched or published.
+            self.sync(service, connections, *flags)
+            self.assertEqual(5, wordpress.calls['wp.newComment'])
+            self.assertEqual(3, service.batches)
+
+            # Only the pages down to the first synced comment are fetched.
+            service.add_comments(
+                'new', [self.new_comment(str(i)) for i in range(5, 7)])
+            self.sync(service, connections, *flags)
+            self.assertEqual(7, wordpress.calls['wp.newComment'])
+            self.assertEqual(5, service.comment_pages)
+            self.assertEqual(
+                ['Comment 5', 'Comment 6'],
+                sorted(comment['content']
+                       for comment in wordpress.comments.values())[-2:])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_comments_need_state(self):
+        import fakes
+        service, connections = fakes.fake_services()
+        self.assertRaises(SystemExit, self.sync, service, connections,
+                          '--comments')
+
+    def test_wxr_comments(self):
+        import shutil
+        import tempfile
+        import xml.etree.ElementTree as ElementTree
+        import fakes
+        directory = tempfile.mkdtemp()
+        try:
+            service, connections = fakes.fake_services(page_size=5)
+            service.add([self.new_activity('new1'), self.new_activity('new2')])
+            service.add_comments('new1', [self.new_comment('1')])
+            service.add_comments('new2', [self.new_comment('2')])
+            self.sync(service, connections, '--comments',
+                      '--wxr=' + os.path.join(directory, 'export.xml'))
+
+            comments = [
+                [comment.text for comment in item.findall(
+                    '{http://wordpress.org/export/1.2/}comment/'
+                    '{http://wordpress.org/export/1.2/}comment_content')]
+                for item in ElementTree.parse(os.path.join(
+                    directory, 'export-001.xml')).iter('item')]
+            self.assertEqual(['Comment 1'], comments[0])
+            self.assertEqual(['Comment 2'], comments[1])
+            self.assertEqual(2, sum(len(c) for c in comments))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_latency(self):
+        import fakes
+        network = fakes.Network(latency=0.01)
+        start = time.time()
+        self.assertFalse(network.request())
+        self.assertTrue(time.time() - start >= 0.01)
+
+
 if __name__ == '__main__':
     unittest.main()